@@ -21,6 +21,9 @@ interface SegmentInfo {
   segment: number;
   filename: string;
   size: number;
+  // Segments are cut on keyframes, so their lengths vary; null for segments of old movies
+  start: number | null;
+  duration: number | null;
 }
 
 interface SegmentsData {
@@ -49,6 +52,24 @@ interface MoviePlayerComponentProps {
 
 const BUFFER_SEGMENTS = 2;
 
+// --- Segment timeline, from each segment's own start and duration ---
+const findSegment = (data: SegmentsData, segment: number) =>
+  data.available_segments.find(seg => seg.segment === segment);
+
+const segmentStart = (data: SegmentsData, segment: number) =>
+  findSegment(data, segment)?.start ?? segment * data.segment_duration;
+
+const segmentDuration = (data: SegmentsData, segment: number) =>
+  findSegment(data, segment)?.duration ?? data.segment_duration;
+
+// The available segment playing at a movie time, else the one a fixed grid would put there
+const segmentAt = (data: SegmentsData, time: number) => {
+  const found = data.available_segments.find(seg =>
+    seg.start !== null && seg.duration !== null && time >= seg.start && time < seg.start + seg.duration
+  );
+  return found ? found.segment : Math.floor(time / data.segment_duration);
+};
+
 const MoviePlayer: React.FC<MoviePlayerComponentProps> = ({ movieId }) => {
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState<string | null>(null);
@@ -68,7 +89,7 @@ const MoviePlayer: React.FC<MoviePlayerComponentProps> = ({ movieId }) => {
   const [virtualTime, setVirtualTime] = useState(0);
   const [totalDuration, setTotalDuration] = useState(0);
   const [isBuffering, setIsBuffering] = useState(false);
-  const [bufferedSegments, setBufferedSegments] = useState<number[]>([]);
+  const [, setBufferedSegments] = useState<number[]>([]);
   const [isTransitioning, setIsTransitioning] = useState(false);
   
   // UI Controls
@@ -243,7 +264,7 @@ const MoviePlayer: React.FC<MoviePlayerComponentProps> = ({ movieId }) => {
       if (response.data.total_duration) setTotalDuration(response.data.total_duration);
       
       const lastAvailableSegment = Math.max(...response.data.available_segments.map(seg => seg.segment));
-      setAvailableTime((lastAvailableSegment + 1) * response.data.segment_duration);
+      setAvailableTime(segmentStart(response.data, lastAvailableSegment) + segmentDuration(response.data, lastAvailableSegment));
       
       // Init first segment
       if (currentVideoRef.current && !currentVideoRef.current.src && response.data.available_segments.length > 0) {
@@ -261,36 +282,46 @@ const MoviePlayer: React.FC<MoviePlayerComponentProps> = ({ movieId }) => {
     }
   }, [movieId, retryCount, preloadSegments]);
 
-  // Check Status Poll
+  // Apply a status snapshot, from the event stream or a direct request
+  const lastSegmentCount = useRef<number | undefined>(undefined);
+  const handleStatus = useCallback((data: MovieStatus) => {
+    setStatusData(data);
+
+    if (data.total_duration) setTotalDuration(data.total_duration);
+
+    if (data.status === 'READY' || data.status === 'PLAYABLE' || data.ready) {
+      setFilePath(data.file_path);
+      setLoading(false);
+      // Segment details only change when more segments become available
+      if (lastSegmentCount.current === undefined || data.available_segments !== lastSegmentCount.current) {
+        lastSegmentCount.current = data.available_segments;
+        fetchSegmentInfo();
+      }
+    }
+    // Note: We removed the auto-POST to start download here.
+    // We assume App.tsx already started it. We just wait for status to become READY/PLAYABLE.
+  }, [fetchSegmentInfo]);
+
+  // Check Status
   const checkStatus = useCallback(async () => {
     try {
       const response = await api.get<MovieStatus>(`/video/${movieId}/status/`);
-      setStatusData(response.data);
-      
-      if (response.data.total_duration) setTotalDuration(response.data.total_duration);
-      
-      if (response.data.status === 'READY' || response.data.status === 'PLAYABLE' || response.data.ready) {
-        setFilePath(response.data.file_path);
-        setLoading(false);
-        fetchSegmentInfo();
-      } 
-      // Note: We removed the auto-POST to start download here. 
-      // We assume App.tsx already started it. We just wait for status to become READY/PLAYABLE.
-      
+      lastSegmentCount.current = undefined;
+      handleStatus(response.data);
     } catch (err) {
       setError(`Failed to check movie status: ${err instanceof Error ? err.message : 'Unknown error'}`);
       setLoading(false);
     }
-  }, [movieId, fetchSegmentInfo]);
+  }, [movieId, handleStatus]);
 
   // Segment Switching
-  const switchToSegment = useCallback((targetSegment: number, seekTime?: number) => {
+  const switchToSegment = useCallback((targetSegment: number, seekTime?: number, play?: boolean) => {
     if (!currentVideoRef.current || !segmentsData || isTransitioning) return;
     setIsTransitioning(true);
     setIsBuffering(true);
       
     const newSrc = `${API_BASE_URL}/video/${movieId}/stream/?segment=${targetSegment}&t=${retryCount}`;
-    const wasPlaying = !currentVideoRef.current.paused;
+    const wasPlaying = play ?? !currentVideoRef.current.paused;
       
     currentVideoRef.current.style.opacity = '0.8';
     currentVideoRef.current.src = newSrc;
@@ -314,8 +345,8 @@ const MoviePlayer: React.FC<MoviePlayerComponentProps> = ({ movieId }) => {
 
   const handleSeek = useCallback((newTime: number) => {
     if (!segmentsData || !isTimeAvailable(newTime)) return;
-    const targetSegment = Math.floor(newTime / segmentsData.segment_duration);
-    const segmentTime = newTime % segmentsData.segment_duration;
+    const targetSegment = segmentAt(segmentsData, newTime);
+    const segmentTime = Math.max(0, newTime - segmentStart(segmentsData, targetSegment));
     setVirtualTime(newTime);
     if (targetSegment !== currentSegment) {
       switchToSegment(targetSegment, segmentTime);
@@ -335,30 +366,26 @@ const MoviePlayer: React.FC<MoviePlayerComponentProps> = ({ movieId }) => {
     if (currentVideoRef.current?.requestFullscreen) currentVideoRef.current.requestFullscreen();
   };
 
-  // Poll Interval
+  // Status pushed by the server as it changes
+  const handleStatusRef = useRef(handleStatus);
+  handleStatusRef.current = handleStatus;
   useEffect(() => {
-    const interval = setInterval(() => {
-      checkStatus();
-      if (segmentsData) fetchSegmentInfo();
-    }, 5000); // Poll every 5 seconds
-    checkStatus();
-    return () => clearInterval(interval);
-  }, [checkStatus, fetchSegmentInfo, segmentsData]);
+    const events = new EventSource(`${API_BASE_URL}/video/${movieId}/events/`);
+    events.addEventListener('status', (event) => {
+      const data: MovieStatus = JSON.parse((event as MessageEvent).data);
+      handleStatusRef.current(data);
+      // The server ends the stream once nothing can change any more
+      if (data.status === 'READY' || data.status === 'ERROR') events.close();
+    });
+    return () => events.close();
+  }, [movieId]);
 
   // Time Update Loop
   useEffect(() => {
     const updateTime = () => {
       if (!currentVideoRef.current || !segmentsData || isDragging || isTransitioning) return;
       const segmentTime = currentVideoRef.current.currentTime;
-      const baseTime = currentSegment * segmentsData.segment_duration;
-      const newVirtualTime = baseTime + segmentTime;
-      setVirtualTime(newVirtualTime);
-      if (segmentTime >= segmentsData.segment_duration - 0.5) {
-        const nextSegment = currentSegment + 1;
-        if (nextSegment < segmentsData.total_segments && bufferedSegments.includes(nextSegment)) {
-          switchToSegment(nextSegment);
-        }
-      }
+      setVirtualTime(segmentStart(segmentsData, currentSegment) + segmentTime);
     };
     if (isPlaying) {
       intervalRef.current = window.setInterval(updateTime, 100);
@@ -366,7 +393,27 @@ const MoviePlayer: React.FC<MoviePlayerComponentProps> = ({ movieId }) => {
       clearInterval(intervalRef.current);
     }
     return () => { if (intervalRef.current) clearInterval(intervalRef.current); };
-  }, [isPlaying, currentSegment, segmentsData, isDragging, isTransitioning, bufferedSegments, switchToSegment]);
+  }, [isPlaying, currentSegment, segmentsData, isDragging, isTransitioning]);
+
+  // Next segment once the current one has played to its real end, or as soon as it is out
+  const waitingForNext = useRef(false);
+  const handleEnded = useCallback(() => {
+    if (!segmentsData) return;
+    const nextSegment = currentSegment + 1;
+    waitingForNext.current = !findSegment(segmentsData, nextSegment);
+    if (waitingForNext.current) {
+      setIsBuffering(true);
+    } else {
+      switchToSegment(nextSegment, undefined, true);
+    }
+  }, [segmentsData, currentSegment, switchToSegment]);
+
+  useEffect(() => {
+    if (waitingForNext.current && segmentsData && findSegment(segmentsData, currentSegment + 1)) {
+      waitingForNext.current = false;
+      switchToSegment(currentSegment + 1, undefined, true);
+    }
+  }, [segmentsData, currentSegment, switchToSegment]);
 
   // Keyboard
   useEffect(() => {
@@ -458,6 +505,7 @@ const MoviePlayer: React.FC<MoviePlayerComponentProps> = ({ movieId }) => {
           onPause={() => setIsPlaying(false)}
           onWaiting={() => setIsBuffering(true)}
           onCanPlay={() => setIsBuffering(false)}
+          onEnded={handleEnded}
           onError={(e) => { console.error('Video error:', e); setError('Failed to load video segment'); }}
           playsInline preload="auto" crossOrigin="anonymous" muted={isMuted}
         />
@@ -1,7 +1,8 @@
 import axios from 'axios';
 
-// Change this to your actual Django backend URL
-export const API_BASE_URL = 'http://localhost:8000/api';
+// Django behind nginx, which also sends the video segments Django hands over with
+// X-Accel-Redirect; calling Django directly would get those responses without a body
+export const API_BASE_URL = '/api';
 
 export const api = axios.create({
   baseURL: API_BASE_URL,
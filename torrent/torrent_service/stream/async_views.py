@@ -0,0 +1,238 @@
+import asyncio
+import json
+import logging
+import math
+import os
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.views.decorators.http import require_safe
+
+from .daemon import torrent_daemon
+from .events import event_bus
+from .models import MovieFile
+from .progress import progress_flusher
+from .services import VideoService
+from .subtitles import vtt_cache, vtt_response
+from .views import (
+    master_playlist,
+    media_playlist,
+    movie_manifest,
+    movie_status_data,
+    prepare_rendition,
+    rendition_file_path,
+    segment_file_path,
+    update_playhead,
+)
+
+# Async views for the endpoints that hold a connection for a long time or are polled
+# constantly. Under an ASGI server (gunicorn with uvicorn workers) a slow viewer only
+# costs a coroutine: ORM access uses async queries and file I/O runs in worker threads.
+
+
+@require_safe
+async def video_status(request, pk):
+    """GET /video/:id/status - Get movie streaming status"""
+    try:
+        movie_file = await MovieFile.objects.aget(id=pk)
+    except MovieFile.DoesNotExist:
+        return JsonResponse({"error": "Movie not found"}, status=404)
+
+    # Duration lookups and segment counting touch the disk
+    return JsonResponse(await asyncio.to_thread(movie_status_data, movie_file))
+
+
+# Idle connections get a comment line this often so proxies do not time them out
+EVENTS_KEEPALIVE = 15
+
+
+def _sse(data: dict) -> str:
+    return f"event: status\ndata: {json.dumps(data)}\n\n"
+
+
+async def _status_events(movie_file):
+    if torrent_daemon:
+        torrent_daemon.ensure_relay()
+    subscription = event_bus.subscribe(movie_file.id)
+    try:
+        data = event_bus.latest(movie_file.id) or await asyncio.to_thread(movie_status_data, movie_file)
+        yield _sse(data)
+        # Nothing changes any more once a movie is fully processed or has failed
+        while data["status"] not in ["READY", "ERROR"]:
+            try:
+                data = await subscription.get(EVENTS_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            yield _sse(data)
+    finally:
+        subscription.close()
+
+
+@require_safe
+async def video_events(request, pk):
+    """
+    GET /video/:id/events - Server-sent events with the movie status
+
+    Sends the current status right away and then a new ``status`` event whenever
+    the status, progress, available segment count or duration changes. Replaces
+    polling /status: an idle player costs one open connection and no queries.
+    """
+    try:
+        movie_file = await MovieFile.objects.aget(id=pk)
+    except MovieFile.DoesNotExist:
+        return JsonResponse({"error": "Movie not found"}, status=404)
+
+    response = StreamingHttpResponse(_status_events(movie_file), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Let nginx pass events through as they are written
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+def client_throughput(request):
+    """
+    Bits per second the player measured, from ``?bandwidth=`` or else the ``Downlink``
+    client hint (in Mb/s); None when it sent neither.
+    """
+    try:
+        if "bandwidth" in request.GET:
+            throughput = float(request.GET["bandwidth"])
+        elif "HTTP_DOWNLINK" in request.META:
+            throughput = float(request.META["HTTP_DOWNLINK"]) * 1_000_000
+        else:
+            return None
+    except ValueError:
+        return None
+    return throughput if throughput > 0 else None
+
+
+async def _playable_movie(pk):
+    """The movie if it can be streamed, else the error response to send."""
+    try:
+        movie_file = await MovieFile.objects.aget(id=pk)
+    except MovieFile.DoesNotExist:
+        return None, JsonResponse({"error": "Movie not found"}, status=404)
+
+    if movie_file.download_status not in ["READY", "PLAYABLE"]:
+        return None, JsonResponse(
+            {"error": f"Movie is not ready for streaming (status: {movie_file.download_status})"},
+            status=400,
+        )
+    return movie_file, None
+
+
+def _playlist_response(text):
+    response = HttpResponse(text, content_type="application/vnd.apple.mpegurl")
+    # Playlists grow while the movie is still being segmented
+    response["Cache-Control"] = "no-cache"
+    response["Access-Control-Allow-Origin"] = "*"
+    return response
+
+
+@require_safe
+async def video_master_playlist(request, pk):
+    """GET /video/:id/master.m3u8 - HLS master playlist with the source and the lower renditions"""
+    movie_file, error = await _playable_movie(pk)
+    if error:
+        return error
+    return _playlist_response(await asyncio.to_thread(master_playlist, movie_file))
+
+
+@require_safe
+async def video_playlist(request, pk):
+    """GET /video/:id/playlist.m3u8?rendition=720p - HLS media playlist of the source or a rendition"""
+    movie_file, error = await _playable_movie(pk)
+    if error:
+        return error
+    text = await asyncio.to_thread(media_playlist, movie_file, request.GET.get("rendition"))
+    if text is None:
+        return JsonResponse({"error": "Rendition not found"}, status=404)
+    return _playlist_response(text)
+
+
+@require_safe
+async def video_stream(request, pk):
+    """
+    GET /video/:id/stream?segment=N - Stream movie content
+
+    ``?rendition=720p`` serves the segment from a lower rendition, encoding it first if
+    nobody watched it in that one yet. ``?init=1`` serves only its initialisation
+    section, for the playlists' ``EXT-X-MAP``. A player that reports its throughput, with
+    ``?bandwidth=<bits/s>`` or the ``Downlink`` client hint, gets the rendition that
+    suits it encoded ahead.
+    """
+    movie_file, error = await _playable_movie(pk)
+    if error:
+        return error
+
+    try:
+        # Get segment parameter (default to 0 for first segment)
+        segment = int(request.GET.get("segment", 0))
+    except ValueError:
+        return JsonResponse({"error": "Invalid segment"}, status=400)
+    rendition = request.GET.get("rendition")
+    throughput = client_throughput(request)
+
+    try:
+        await asyncio.to_thread(update_playhead, movie_file.id, segment)
+
+        if rendition:
+            file_path = await asyncio.to_thread(rendition_file_path, movie_file, segment, rendition)
+        else:
+            file_path = await asyncio.to_thread(segment_file_path, movie_file, segment)
+        if file_path is None:
+            return JsonResponse({"error": f"Segment {segment} not found"}, status=404)
+        if request.GET.get("init"):
+            response = await asyncio.to_thread(VideoService().stream_init_section, file_path)
+            return response or JsonResponse({"error": f"Segment {segment} has no init section"}, status=404)
+        if throughput:
+            await asyncio.to_thread(prepare_rendition, movie_file, segment, throughput)
+
+        # Last access for cache eviction, written with the next progress flush
+        movie_file.last_watched = timezone.now()
+        progress_flusher.record(movie_file, "last_watched")
+
+        # wsgi.py serves these views too: there an async body would be buffered whole,
+        # while the file wrapper can sendfile
+        return VideoService().stream_video(request, file_path, asynchronous=isinstance(request, ASGIRequest))
+    except Exception as e:
+        logging.error(f"Streaming error: {str(e)}")
+        return JsonResponse({"error": "Internal server error"}, status=500)
+
+
+@require_safe
+async def subtitle_file(request, movie_id, language):
+    """
+    GET /subtitles/{movie_id}/file/{language}/ - Serve the subtitle VTT file
+
+    ``?offset=<seconds>`` moves every cue by that much, ``?segment=<n>`` so that cue
+    times count from the start of segment n, for players that load segments as
+    separate media.
+    """
+    file_path = os.path.join(settings.MEDIA_ROOT, 'downloads', 'subtitles', movie_id, f'{language}.vtt')
+    try:
+        offset = float(request.GET.get('offset', 0))
+        if not math.isfinite(offset):
+            raise Http404("Subtitle file not found")
+        if 'segment' in request.GET:
+            movie_file = await MovieFile.objects.aget(id=movie_id)
+            entry = await asyncio.to_thread(lambda: movie_manifest(movie_file).segment(int(request.GET['segment'])))
+            if entry is None:
+                raise Http404("Segment not found")
+            offset -= entry['start']
+    except (ValueError, MovieFile.DoesNotExist):
+        raise Http404("Subtitle file not found")
+
+    try:
+        # Only a cache miss touches the disk beyond a stat
+        variant = await asyncio.to_thread(vtt_cache.get, file_path, round(offset, 3))
+    except OSError:
+        raise Http404("Subtitle file not found")
+
+    # Subtitles can be fetched again, so caches revalidate them with the ETag
+    response = vtt_response(request, variant, cache_control='public, max-age=3600')
+    response['Content-Disposition'] = f'inline; filename="{language}.vtt"'
+    return response
@@ -0,0 +1,150 @@
+import fcntl
+import logging
+import os
+import shutil
+from datetime import timedelta
+from typing import Callable, Optional
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import MovieFile
+
+# Titles in these states are still being written to and are never evicted
+ACTIVE_STATUSES = ["PENDING", "QUEUED", "DOWNLOADING", "DL_AND_CONVERT", "CONVERTING", "PLAYABLE"]
+
+
+class MovieCache:
+    """
+    Disk budget for downloaded titles under ``<DOWNLOAD_PATH>/movies``.
+
+    Every title is one directory holding the torrent payload, its segments,
+    manifest and playlist; its subtitles live under ``MEDIA_ROOT``. Once the titles
+    take more than the high watermark of ``max_bytes``, the least recently watched
+    ones are deleted whole until usage is below the low watermark. Titles not
+    watched for ``max_age_days`` are deleted whatever the usage. Evicted titles go
+    back to PENDING, so the next start downloads them again.
+    """
+
+    # Someone watched it a moment ago, they are probably still watching
+    min_idle = timedelta(hours=1)
+
+    def __init__(self, root: str, subtitles_root: str, max_bytes: int, high_watermark: float,
+                 low_watermark: float, max_age_days: int):
+        self.root = root
+        self.subtitles_root = subtitles_root
+        self.max_bytes = max_bytes
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.max_age_days = max_age_days
+        self.lock_path = os.path.join(root, '.evict.lock')
+
+    def title_path(self, movie_id: int) -> str:
+        return os.path.join(self.root, str(movie_id))
+
+    def usage(self) -> dict:
+        """Bytes on disk per movie id."""
+        usage = {}
+        try:
+            entries = list(os.scandir(self.root))
+        except FileNotFoundError:
+            return usage
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False) and entry.name.isdigit():
+                usage[int(entry.name)] = self._tree_size(entry.path)
+        return usage
+
+    def _tree_size(self, path: str) -> int:
+        total = 0
+        for dir_path, _, file_names in os.walk(path):
+            for name in file_names:
+                try:
+                    total += os.lstat(os.path.join(dir_path, name)).st_size
+                except OSError:
+                    pass
+        return total
+
+    def candidates(self, usage: dict) -> list:
+        """Evictable ``(movie id, last watched)`` pairs, least recently watched first."""
+        idle_since = timezone.now() - self.min_idle
+        rows = (
+            MovieFile.objects
+            .filter(id__in=list(usage), last_watched__lt=idle_since)
+            .exclude(download_status__in=ACTIVE_STATUSES)
+            .order_by('last_watched')
+            .values_list('id', 'last_watched')
+        )
+        known = set(MovieFile.objects.filter(id__in=list(usage)).values_list('id', flat=True))
+        # Directories without a row belong to nothing and go first
+        return [(movie_id, None) for movie_id in usage if movie_id not in known] + list(rows)
+
+    def plan(self, in_use: Optional[Callable[[int], bool]] = None) -> list:
+        """
+        Movie ids that an eviction run would delete, in order. Titles for which
+        ``in_use(movie_id)`` is true are kept whatever their status says.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        usage = self.usage()
+        total = sum(usage.values())
+        expired_before = timezone.now() - timedelta(days=self.max_age_days)
+        over_budget = total > self.max_bytes * self.high_watermark
+        target = self.max_bytes * self.low_watermark
+
+        victims = []
+        for movie_id, last_watched in self.candidates(usage):
+            if in_use and in_use(movie_id):
+                continue
+            expired = last_watched is None or last_watched < expired_before
+            if not expired and not (over_budget and total > target):
+                continue
+            victims.append(movie_id)
+            total -= usage[movie_id]
+        return victims
+
+    def evict(self, release: Optional[Callable[[int], None]] = None,
+              in_use: Optional[Callable[[int], bool]] = None, dry_run: bool = False) -> list:
+        """
+        Delete the titles chosen by ``plan`` and return their ids. ``release(movie_id)``
+        is called first so the torrent session lets go of the payload; titles a torrent
+        or pipeline still works on, per ``in_use(movie_id)``, are left alone.
+
+        Only one process evicts at a time; the others skip the run.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        with open(self.lock_path, 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return []
+            victims = self.plan(in_use)
+            if dry_run:
+                return victims
+            for movie_id in victims:
+                if release:
+                    release(movie_id)
+                self.remove(movie_id)
+            return victims
+
+    def remove(self, movie_id: int):
+        """
+        Delete a title's payload, segments and subtitles and mark it as not downloaded,
+        along with the movies that shared its torrent and so its segments.
+        """
+        for path in (self.title_path(movie_id), os.path.join(self.subtitles_root, str(movie_id))):
+            shutil.rmtree(path, ignore_errors=True)
+        shared_prefix = os.path.join(os.path.relpath(self.title_path(movie_id), settings.DOWNLOAD_PATH), '')
+        MovieFile.objects.filter(Q(id=movie_id) | Q(file_path__startswith=shared_prefix)).update(
+            file_path=None, download_status="PENDING", download_progress=0
+        )
+        logging.info(f"Evicted movie {movie_id} from the download cache")
+
+
+movie_cache = MovieCache(
+    root=os.path.join(settings.DOWNLOAD_PATH, 'movies'),
+    subtitles_root=os.path.join(settings.MEDIA_ROOT, 'downloads', 'subtitles'),
+    max_bytes=settings.MOVIE_CACHE_MAX_BYTES,
+    high_watermark=settings.MOVIE_CACHE_HIGH_WATERMARK,
+    low_watermark=settings.MOVIE_CACHE_LOW_WATERMARK,
+    max_age_days=settings.MOVIE_CACHE_MAX_AGE_DAYS,
+)
@@ -0,0 +1,207 @@
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from typing import Optional
+
+from django.conf import settings
+from django.db import connection
+
+from .events import event_bus
+from .scheduler import QueueFull, download_queue
+
+
+class DaemonError(Exception):
+    pass
+
+
+class TorrentDaemonClient:
+    """
+    Client for the ``torrentd`` process that owns the libtorrent session.
+
+    Requests are one JSON object per line over a Unix socket, answered by one JSON
+    line: ``{"ok": true, "result": ...}`` or ``{"ok": false, "error": ...}``. Each call
+    uses its own short-lived connection, so the client is safe to share between
+    threads and needs no reconnect logic.
+
+    Inside the daemon process itself ``inside_daemon`` is set and the client is false,
+    so callers use the local session instead, whichever module holds the client.
+    """
+
+    timeout = 10
+    relay_retry_interval = 5
+    inside_daemon = False
+
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+        self._relay_thread = None
+        self._relay_lock = threading.Lock()
+
+    def __bool__(self) -> bool:
+        return not self.inside_daemon
+
+    def _connect(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        return sock
+
+    def call(self, op: str, **params):
+        if self.inside_daemon:
+            raise DaemonError(f"The torrent daemon cannot send {op} to itself")
+        try:
+            with self._connect() as sock:
+                sock.sendall(json.dumps({"op": op, **params}).encode() + b"\n")
+                with sock.makefile('rb') as f:
+                    line = f.readline()
+        except OSError as e:
+            raise DaemonError(f"Torrent daemon unavailable: {e}")
+        if not line:
+            raise DaemonError("Torrent daemon closed the connection")
+        response = json.loads(line)
+        if response.get("queue_full"):
+            raise QueueFull(response.get("error"))
+        if not response.get("ok"):
+            raise DaemonError(response.get("error", "Unknown torrent daemon error"))
+        return response.get("result")
+
+    def start_movie(self, movie_id: int) -> int:
+        return self.call("add", movie_id=movie_id)
+
+    def queue_position(self, movie_id: int) -> Optional[int]:
+        return self.call("position", movie_id=movie_id)
+
+    def set_playhead(self, movie_id: int, segment: int):
+        self.call("prioritize", movie_id=movie_id, segment=segment)
+
+    def remove_movie(self, movie_id: int):
+        self.call("remove", movie_id=movie_id)
+
+    def movie_in_use(self, movie_id: int) -> bool:
+        return self.call("in_use", movie_id=movie_id)
+
+    def status(self, movie_id: int) -> Optional[dict]:
+        return self.call("status", movie_id=movie_id)
+
+    def ensure_relay(self):
+        """Republish the daemon's status events on this process's event bus."""
+        with self._relay_lock:
+            if self._relay_thread is None:
+                self._relay_thread = threading.Thread(target=self._relay, daemon=True)
+                self._relay_thread.start()
+
+    def _relay(self):
+        while True:
+            try:
+                with self._connect() as sock:
+                    # Events only arrive when something changes
+                    sock.settimeout(None)
+                    sock.sendall(json.dumps({"op": "subscribe"}).encode() + b"\n")
+                    with sock.makefile('rb') as f:
+                        for line in f:
+                            event = json.loads(line)
+                            event_bus.publish(event["movie_id"], event["data"])
+            except (OSError, ValueError) as e:
+                logging.error(f"Lost torrent daemon event stream: {e}")
+            time.sleep(self.relay_retry_interval)
+
+
+class TorrentDaemonHandler(socketserver.StreamRequestHandler):
+    # Events a subscriber may fall behind by; a slower one loses the oldest
+    event_backlog = 256
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                op = request.pop("op")
+                if op == "subscribe":
+                    self.stream_events()
+                    return
+                result = self.server.dispatch(op, **request)
+                response = {"ok": True, "result": result}
+            except QueueFull as e:
+                response = {"ok": False, "error": str(e), "queue_full": True}
+            except Exception as e:
+                response = {"ok": False, "error": str(e)}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+    def finish(self):
+        super().finish()
+        # Every connection is served by its own thread, with its own database connection
+        connection.close()
+
+    def stream_events(self):
+        events = queue.Queue(maxsize=self.event_backlog)
+
+        def listener(movie_id, data):
+            while True:
+                try:
+                    events.put_nowait((movie_id, data))
+                    return
+                except queue.Full:
+                    try:
+                        events.get_nowait()
+                    except queue.Empty:
+                        pass
+
+        event_bus.add_listener(listener)
+        try:
+            while True:
+                movie_id, data = events.get()
+                self.wfile.write(json.dumps({"movie_id": movie_id, "data": data}).encode() + b"\n")
+                self.wfile.flush()
+        except OSError:
+            pass
+        finally:
+            event_bus.remove_listener(listener)
+
+
+class TorrentDaemonServer(socketserver.ThreadingUnixStreamServer):
+    """
+    The single process that runs the libtorrent session and every movie pipeline.
+
+    Web workers send it ``add`` (queue downloading and segmenting a movie, once),
+    ``prioritize`` (a viewer's playhead moved), ``status``, ``position`` (place in the
+    download queue), ``in_use`` (whether a torrent or pipeline still works on a movie's
+    files) and ``remove``, and may ``subscribe`` to the status events published by
+    the pipelines.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: str):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, TorrentDaemonHandler)
+
+    def dispatch(self, op: str, **params):
+        from .models import MovieFile
+        from . import views
+
+        if op == "ping":
+            return "pong"
+        if op == "add":
+            return views.start_movie_processing(int(params["movie_id"]))
+        if op == "prioritize":
+            views.prioritize_playhead(int(params["movie_id"]), int(params["segment"]))
+            return None
+        if op == "remove":
+            views.TorrentSessionManager().release_movie(int(params["movie_id"]))
+            return None
+        if op == "in_use":
+            return views.TorrentSessionManager().movie_in_use(int(params["movie_id"]))
+        if op == "position":
+            return download_queue.position(int(params["movie_id"]))
+        if op == "status":
+            movie_file = MovieFile.objects.filter(id=int(params["movie_id"])).first()
+            return views.movie_status_data(movie_file) if movie_file else None
+        raise DaemonError(f"Unknown operation: {op}")
+
+
+torrent_daemon = TorrentDaemonClient(settings.TORRENT_DAEMON_SOCKET) if settings.TORRENT_DAEMON_SOCKET else None
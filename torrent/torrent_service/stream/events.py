@@ -0,0 +1,105 @@
+import asyncio
+import threading
+from typing import Callable, Optional
+
+
+class Subscription:
+    """
+    One listener for a movie's status events, bound to the event loop it was created on.
+
+    Only the newest snapshot matters to a player, so an undelivered event is replaced
+    instead of queued behind it.
+    """
+
+    def __init__(self, bus, movie_id: int):
+        self.bus = bus
+        self.movie_id = movie_id
+        self.loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=1)
+
+    def _deliver(self, data: dict):
+        if self._queue.full():
+            self._queue.get_nowait()
+        self._queue.put_nowait(data)
+
+    async def get(self, timeout: Optional[float] = None) -> dict:
+        """Wait for the next snapshot; raises TimeoutError after ``timeout`` seconds."""
+        return await asyncio.wait_for(self._queue.get(), timeout)
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+
+class EventBus:
+    """
+    In-process pub/sub for movie status snapshots.
+
+    Download threads call ``publish`` as often as they like: a snapshot equal to the
+    previous one for the same movie is dropped, so subscribers only hear about real
+    changes. Snapshots are only kept for movies still in progress: a READY or ERROR one
+    is delivered and then forgotten, as subscribers read it from the database anyway.
+    Subscribers are coroutines of the async views, woken through their
+    event loop with ``call_soon_threadsafe``. Listeners are plain callables that get
+    every change for every movie, which is how the torrent daemon forwards events to
+    the web workers.
+    """
+
+    def __init__(self):
+        self._subscribers = {}
+        self._latest = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, movie_id: int) -> Subscription:
+        subscription = Subscription(self, movie_id)
+        with self._lock:
+            self._subscribers.setdefault(movie_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.movie_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.movie_id]
+
+    def add_listener(self, listener: Callable[[int, dict], None]):
+        with self._lock:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[int, dict], None]):
+        with self._lock:
+            self._listeners.remove(listener)
+
+    def latest(self, movie_id: int) -> Optional[dict]:
+        with self._lock:
+            return self._latest.get(movie_id)
+
+    def forget(self, movie_id: int):
+        """Drop the last snapshot of a movie whose download was stopped."""
+        with self._lock:
+            self._latest.pop(movie_id, None)
+
+    def publish(self, movie_id: int, data: dict):
+        """Send ``data`` to the movie's subscribers if it differs from the last snapshot."""
+        with self._lock:
+            if self._latest.get(movie_id) == data:
+                return
+            if data.get("status") in ["READY", "ERROR"]:
+                self._latest.pop(movie_id, None)
+            else:
+                self._latest[movie_id] = data
+            subscribers = list(self._subscribers.get(movie_id, ()))
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(movie_id, data)
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription._deliver, data)
+            except RuntimeError:
+                # The subscriber's event loop is gone
+                self.unsubscribe(subscription)
+
+
+event_bus = EventBus()
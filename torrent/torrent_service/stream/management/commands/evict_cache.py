@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from stream.cache import movie_cache
+from stream.daemon import DaemonError, torrent_daemon
+
+
+class Command(BaseCommand):
+    help = "Delete least recently watched movies until the download cache is within its disk budget"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only list the movies that would be deleted")
+
+    def handle(self, *args, **options):
+        # Only the torrent daemon can tell which titles its session and pipelines still
+        # use; without one they live inside the web workers, which evict on their own
+        if not torrent_daemon and not options["dry_run"]:
+            raise CommandError("Without TORRENT_DAEMON_SOCKET the web workers evict the cache themselves")
+
+        usage = movie_cache.usage()
+        self.stdout.write(
+            f"{len(usage)} titles use {sum(usage.values()) / 1024 ** 3:.1f} GiB "
+            f"of {movie_cache.max_bytes / 1024 ** 3:.1f} GiB"
+        )
+        try:
+            if torrent_daemon:
+                victims = movie_cache.evict(release=torrent_daemon.remove_movie,
+                                            in_use=torrent_daemon.movie_in_use, dry_run=options["dry_run"])
+            else:
+                victims = movie_cache.evict(dry_run=True)
+        except DaemonError as e:
+            raise CommandError(str(e))
+        for movie_id in victims:
+            self.stdout.write(f"{'Would evict' if options['dry_run'] else 'Evicted'} movie {movie_id}")
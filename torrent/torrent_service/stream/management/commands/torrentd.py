@@ -0,0 +1,34 @@
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from stream.daemon import TorrentDaemonClient, TorrentDaemonServer
+from stream.views import TorrentSessionManager, start_movie_processing
+
+
+class Command(BaseCommand):
+    help = "Run the torrent daemon that owns the libtorrent session for all web workers"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--socket", default=settings.TORRENT_DAEMON_SOCKET,
+                            help="Unix socket to listen on (default: TORRENT_DAEMON_SOCKET)")
+
+    def handle(self, *args, **options):
+        socket_path = options["socket"]
+        if not socket_path:
+            raise CommandError("Set TORRENT_DAEMON_SOCKET or pass --socket")
+
+        logging.basicConfig(level=logging.INFO)
+        # This process is the daemon: queue positions and status events go to its own
+        # session, not back through its socket (which is not even listening yet)
+        TorrentDaemonClient.inside_daemon = True
+        TorrentSessionManager().restore_downloads(
+            lambda movie_id: start_movie_processing(movie_id, viewer=False)
+        )
+        server = TorrentDaemonServer(socket_path)
+        self.stdout.write(f"Torrent daemon listening on {socket_path}")
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
@@ -0,0 +1,358 @@
+import json
+import logging
+import math
+import os
+import re
+import struct
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+
+
+def manifest_path_for(path: str) -> str:
+    """Manifest location for a movie, given its source file or one of its segments."""
+    base_path = re.sub(r"_segment_\d+$", "", os.path.splitext(path)[0])
+    return f"{base_path}.manifest.json"
+
+
+class SegmentManifest:
+    """
+    Index of one movie's segments: number, start time, duration, byte size, file name
+    and state ("ready" or "failed").
+
+    ``available`` counts the leading segments that are settled, i.e. ready or given
+    up on, so one failed segment in the middle does not hide everything after it.
+    ``boundaries`` holds the planned start time of every segment when they are not
+    on the fixed ``segment_duration`` grid, as with stream-copied video.
+    Every segment is a self-contained fragmented MP4, so its entry also records
+    ``init_size``, the length of the leading ftyp/moov boxes HLS players load as its
+    initialisation section. The HLS playlist next to it lists the settled leading
+    segments and is always written from this manifest.
+    """
+
+    def __init__(self, path: str, data: Optional[dict] = None):
+        data = data or {}
+        self.path = path
+        self.source = data.get('source')
+        self.segment_duration = data.get('segment_duration')
+        self.total_duration = data.get('total_duration')
+        self.finished = data.get('finished', False)
+        self.source_released = data.get('source_released', False)
+        self.boundaries = data.get('boundaries')
+        self.segments = {int(segment): entry for segment, entry in data.get('segments', {}).items()}
+        self.available = data.get('available', 0)
+
+    @property
+    def directory(self) -> str:
+        return os.path.dirname(self.path)
+
+    @property
+    def playlist_path(self) -> str:
+        return f"{self.path[:-len('.manifest.json')]}.m3u8"
+
+    @property
+    def source_path(self) -> Optional[str]:
+        return os.path.join(self.directory, self.source) if self.source else None
+
+    def to_dict(self) -> dict:
+        return {
+            'source': self.source,
+            'segment_duration': self.segment_duration,
+            'total_duration': self.total_duration,
+            'finished': self.finished,
+            'source_released': self.source_released,
+            'boundaries': self.boundaries,
+            'available': self.available,
+            'segments': {str(segment): entry for segment, entry in sorted(self.segments.items())},
+        }
+
+    @property
+    def total_segments(self) -> Optional[int]:
+        if self.boundaries:
+            return len(self.boundaries)
+        if self.total_duration and self.segment_duration:
+            return math.ceil(self.total_duration / self.segment_duration)
+        return None
+
+    def copy(self) -> 'SegmentManifest':
+        return SegmentManifest(self.path, self.to_dict())
+
+    def segment(self, segment: int) -> Optional[dict]:
+        """Entry of a ready segment, or None."""
+        entry = self.segments.get(segment)
+        return entry if entry and entry['state'] == 'ready' else None
+
+    def segment_path(self, segment: int) -> Optional[str]:
+        entry = self.segment(segment)
+        return os.path.join(self.directory, entry['path']) if entry else None
+
+    def ready_segments(self) -> list:
+        return [(segment, entry) for segment, entry in sorted(self.segments.items()) if entry['state'] == 'ready']
+
+    def playlist_segments(self) -> list:
+        """
+        The ``available`` leading segments in order, for playlists: appending segments of
+        a later seek would break the EVENT playlist's order. Failed ones carry their
+        planned duration so that the timeline after them stays put.
+        """
+        base_name = os.path.basename(self.path)[:-len('.manifest.json')]
+        segments = []
+        for segment in range(self.available):
+            entry = self.segments[segment]
+            if entry['state'] != 'ready':
+                entry = {**entry, 'duration': self.planned_duration(segment),
+                         'path': f"{base_name}_segment_{segment:03d}.mp4"}
+            segments.append((segment, entry))
+        return segments
+
+    def planned_duration(self, segment: int) -> float:
+        if self.boundaries:
+            end = self.boundaries[segment + 1] if segment + 1 < len(self.boundaries) else self.total_duration
+            return max((end or 0) - self.boundaries[segment], 0)
+        duration = self.segment_duration or 0
+        if self.total_duration:
+            duration = min(duration, max(self.total_duration - segment * duration, 0))
+        return duration
+
+    def bandwidth(self) -> tuple:
+        """Peak and average bits per second of the ready segments; zeros before the first one."""
+        rates = [(entry['size'] * 8, entry['duration']) for _, entry in self.ready_segments() if entry['duration']]
+        if not rates:
+            return 0, 0
+        peak = max(bits / duration for bits, duration in rates)
+        average = sum(bits for bits, _ in rates) / sum(duration for _, duration in rates)
+        return math.ceil(peak), math.ceil(average)
+
+    def failed_segments(self) -> list:
+        return [segment for segment, entry in sorted(self.segments.items()) if entry['state'] == 'failed']
+
+    def add_segment(self, segment: int, start: float, duration: float, size: int, filename: str,
+                    init_size: Optional[int] = None):
+        self.segments[segment] = {
+            'start': start,
+            'duration': duration,
+            'size': size,
+            'path': filename,
+            'init_size': init_size,
+            'state': 'ready',
+        }
+        self._advance()
+
+    def mark_failed(self, segment: int):
+        if self.segment(segment) is None:
+            self.segments[segment] = {'start': None, 'duration': None, 'size': 0, 'path': None, 'state': 'failed'}
+            self._advance()
+
+    def _advance(self):
+        while self.available in self.segments:
+            self.available += 1
+
+
+class ManifestStore:
+    """
+    Segment manifests, persisted atomically as ``<base>.manifest.json`` next to the
+    segments and kept in an LRU in memory.
+
+    A cached manifest is reused for as long as the file's mtime is unchanged, so a
+    request costs one ``stat`` however many segments the movie has. Updates replace
+    the cached manifest with a modified copy, so readers never see one half-updated.
+    """
+
+    capacity = 256
+
+    def __init__(self):
+        self._cache = OrderedDict()  # manifest path -> (mtime_ns, manifest)
+        self._lock = threading.Lock()
+        self._path_locks = {}
+
+    def _path_lock(self, path: str) -> threading.Lock:
+        with self._lock:
+            return self._path_locks.setdefault(path, threading.Lock())
+
+    def get(self, path: str) -> SegmentManifest:
+        """Current manifest at ``path``; an empty one when the movie has no segments yet."""
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            mtime_ns = None
+
+        with self._lock:
+            cached = self._cache.get(path)
+            if cached and cached[0] == mtime_ns:
+                self._cache.move_to_end(path)
+                return cached[1]
+
+        manifest = self._load(path) if mtime_ns is not None else self._seed(path)
+        self._remember(path, mtime_ns, manifest)
+        return manifest
+
+    def update(self, path: str, change: Callable[[SegmentManifest], None]) -> SegmentManifest:
+        """Apply ``change`` to the manifest, then persist it and rewrite the playlist."""
+        with self._path_lock(path):
+            manifest = self.get(path).copy()
+            change(manifest)
+            self._save(manifest)
+            self._remember(path, os.stat(path).st_mtime_ns, manifest)
+            return manifest
+
+    def _remember(self, path: str, mtime_ns: Optional[int], manifest: SegmentManifest):
+        with self._lock:
+            self._cache[path] = (mtime_ns, manifest)
+            self._cache.move_to_end(path)
+            while len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+
+    def _load(self, path: str) -> SegmentManifest:
+        try:
+            with open(path) as f:
+                return SegmentManifest(path, json.load(f))
+        except (OSError, ValueError) as e:
+            logging.error(f"Error reading segment manifest {path}: {e}")
+            return SegmentManifest(path)
+
+    def _seed(self, path: str) -> SegmentManifest:
+        # Movies segmented before manifests existed still have their playlist
+        manifest = SegmentManifest(path)
+        base_name = os.path.basename(path)[:-len('.manifest.json')]
+        for segment, (start, duration) in read_playlist(manifest.playlist_path).items():
+            filename = f"{base_name}_segment_{segment:03d}.mp4"
+            segment_path = os.path.join(manifest.directory, filename)
+            try:
+                size = os.path.getsize(segment_path)
+            except OSError:
+                continue
+            manifest.add_segment(segment, start, duration, size, filename, mp4_init_size(segment_path))
+        return manifest
+
+    def _save(self, manifest: SegmentManifest):
+        tmp_path = f"{manifest.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest.to_dict(), f)
+        os.replace(tmp_path, manifest.path)
+        write_playlist(manifest.playlist_path, manifest.playlist_segments(), manifest.segment_duration or 0,
+                       finished=manifest.finished)
+
+
+def mp4_boxes(path: str):
+    """``(type, offset)`` of the top-level boxes of an MP4 file, read from their headers alone."""
+    offset = 0
+    with open(path, 'rb') as f:
+        while True:
+            f.seek(offset)
+            header = f.read(8)
+            if len(header) < 8:
+                return
+            size, box_type = struct.unpack('>I4s', header)
+            yield box_type, offset
+            if size == 1:
+                size = struct.unpack('>Q', f.read(8))[0]
+            if size < 8:
+                # 0 runs to the end of the file
+                return
+            offset += size
+
+
+def mp4_init_size(path: str) -> Optional[int]:
+    """Length of the boxes before the first ``moof`` of a fragmented MP4; None if it has none."""
+    try:
+        for box_type, offset in mp4_boxes(path):
+            if box_type == b'moof':
+                return offset or None
+    except OSError as e:
+        logging.error(f"Error reading MP4 boxes of {path}: {e}")
+    return None
+
+
+def read_init_section(path: str) -> Optional[bytes]:
+    """The initialisation section (ftyp and moov) of a fragmented MP4 segment."""
+    init_size = mp4_init_size(path)
+    if init_size is None:
+        return None
+    with open(path, 'rb') as f:
+        return f.read(init_size)
+
+
+def _file_init_map(segment: int, entry: dict) -> str:
+    if entry.get('init_size'):
+        return f'URI="{entry["path"]}",BYTERANGE="{entry["init_size"]}@0"'
+    return f'URI="{entry["path"]}"'
+
+
+def read_playlist(playlist_path: str) -> dict:
+    """Parse a segment playlist into ``{segment number: (start time, duration)}``."""
+    entries = {}
+    if not os.path.exists(playlist_path):
+        return entries
+    start = 0.0
+    duration = None
+    with open(playlist_path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('#EXTINF:'):
+                duration = float(line[len('#EXTINF:'):].split(',')[0])
+            elif line and not line.startswith('#') and duration is not None:
+                match = re.search(r"_segment_(\d+)\.mp4$", line)
+                if match:
+                    entries[int(match.group(1))] = (start, duration)
+                start += duration
+                duration = None
+    return entries
+
+
+def render_playlist(segments: list, segment_duration: int, finished: bool,
+                    uri: Callable[[int, dict], str] = lambda segment, entry: entry['path'],
+                    init_map: Callable[[int, dict], str] = _file_init_map) -> str:
+    """
+    HLS media playlist listing ``(segment, manifest entry)`` pairs in order, each at
+    ``uri(segment, entry)`` with the ``EXT-X-MAP`` attributes ``init_map(segment, entry)``.
+
+    Segments are fragmented MP4, which needs version 7; failed segments are listed as
+    ``EXT-X-GAP``, which needs version 8.
+    """
+    target = max([segment_duration] + [int(entry['duration'] + 0.999) for _, entry in segments])
+    gaps = any(entry['state'] != 'ready' for _, entry in segments)
+    lines = [
+        "#EXTM3U",
+        f"#EXT-X-VERSION:{8 if gaps else 7}",
+        f"#EXT-X-TARGETDURATION:{target}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        f"#EXT-X-PLAYLIST-TYPE:{'VOD' if finished else 'EVENT'}",
+    ]
+    for segment, entry in segments:
+        if entry['state'] == 'ready':
+            lines.append(f"#EXT-X-MAP:{init_map(segment, entry)}")
+        else:
+            lines.append("#EXT-X-GAP")
+        lines.append(f"#EXTINF:{entry['duration']:.3f},")
+        lines.append(uri(segment, entry))
+    if finished:
+        lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+
+def render_master_playlist(variants: list) -> str:
+    """
+    HLS master playlist from ``(uri, peak bandwidth, average bandwidth, (width, height) or None)``
+    tuples, best first.
+    """
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3"]
+    for uri, bandwidth, average_bandwidth, resolution in variants:
+        attributes = [f"BANDWIDTH={bandwidth}"]
+        if average_bandwidth:
+            attributes.append(f"AVERAGE-BANDWIDTH={average_bandwidth}")
+        if resolution:
+            attributes.append(f"RESOLUTION={resolution[0]}x{resolution[1]}")
+        lines.append(f"#EXT-X-STREAM-INF:{','.join(attributes)}")
+        lines.append(uri)
+    return "\n".join(lines) + "\n"
+
+
+def write_playlist(playlist_path: str, segments: list, segment_duration: int, finished: bool):
+    """Atomically write an HLS playlist listing ``(segment, manifest entry)`` pairs in order."""
+    tmp_path = f"{playlist_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(render_playlist(segments, segment_duration, finished))
+    os.replace(tmp_path, playlist_path)
+
+
+manifest_store = ManifestStore()
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-18 20:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stream', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='moviefile',
+            name='download_status',
+            field=models.CharField(choices=[('PENDING', 'Pending'), ('QUEUED', 'Queued'), ('DOWNLOADING', 'Downloading'), ('DL_AND_CONVERT', 'Downloading and converting'), ('PLAYABLE', 'Playable'), ('READY', 'Ready'), ('ERROR', 'Error'), ('CONVERTING', 'Converting')], default='PENDING', max_length=20),
+        ),
+    ]
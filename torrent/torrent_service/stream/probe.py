@@ -0,0 +1,150 @@
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional
+
+import ffmpeg
+
+
+class ProbeCache:
+    """
+    Cache of ffprobe results keyed by path, size and mtime.
+
+    Results live in memory and in a ``.<name>.probe.json`` sidecar next to the probed
+    file, so a file is probed once per version no matter how many workers or status
+    polls ask about it. A record holds the container format, duration, the stream
+    layout with codecs and, when requested, the video keyframe index as
+    ``[pts_time, byte_offset]`` pairs.
+
+    A file that is still downloading changes between any two calls, so code that asks
+    about it several times in a row does so inside ``pinned``. The last ``capacity``
+    files probed are kept in memory.
+    """
+
+    capacity = 512
+
+    def __init__(self):
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def pinned(self, path: str):
+        """Within the block, this thread probes ``path`` at most once and reuses the record."""
+        pins = self._local.__dict__.setdefault('pins', {})
+        if path in pins:
+            yield
+            return
+        pins[path] = None
+        try:
+            yield
+        finally:
+            del pins[path]
+
+    def sidecar_path(self, path: str) -> str:
+        return os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.probe.json")
+
+    def get(self, path: str, keyframes: bool = False) -> dict:
+        """Return the probe record for ``path``, running ffprobe only when the file changed."""
+        pins = getattr(self._local, 'pins', {})
+        pinned = pins.get(path)
+        if pinned is not None and (not keyframes or pinned.get('keyframes') is not None):
+            return pinned
+
+        stat = os.stat(path)
+        key = (stat.st_size, stat.st_mtime_ns)
+
+        with self._lock:
+            record = self._records.get(path)
+            if record is not None:
+                self._records.move_to_end(path)
+        if not self._matches(record, key, keyframes):
+            record = self._load_sidecar(path)
+            if not self._matches(record, key, keyframes):
+                record = self._probe(path, key, keyframes)
+                self._save_sidecar(path, record)
+            with self._lock:
+                self._records[path] = record
+                self._records.move_to_end(path)
+                while len(self._records) > self.capacity:
+                    self._records.popitem(last=False)
+        if path in pins:
+            pins[path] = record
+        return record
+
+    def invalidate(self, path: str):
+        with self._lock:
+            self._records.pop(path, None)
+        try:
+            os.remove(self.sidecar_path(path))
+        except FileNotFoundError:
+            pass
+
+    def _matches(self, record: Optional[dict], key: tuple, keyframes: bool) -> bool:
+        if not record or (record['size'], record['mtime_ns']) != key:
+            return False
+        return not keyframes or record.get('keyframes') is not None
+
+    def _probe(self, path: str, key: tuple, keyframes: bool) -> dict:
+        probe = ffmpeg.probe(path)
+        fmt = probe.get('format', {})
+        record = {
+            'size': key[0],
+            'mtime_ns': key[1],
+            'format_name': fmt.get('format_name', ''),
+            'duration': float(fmt['duration']) if fmt.get('duration') else None,
+            'bit_rate': int(fmt['bit_rate']) if fmt.get('bit_rate') else None,
+            'streams': [
+                {
+                    'index': stream.get('index'),
+                    'codec_type': stream.get('codec_type'),
+                    'codec_name': stream.get('codec_name'),
+                    'profile': stream.get('profile'),
+                    'pix_fmt': stream.get('pix_fmt'),
+                    'width': stream.get('width'),
+                    'height': stream.get('height'),
+                    'channels': stream.get('channels'),
+                    'sample_rate': stream.get('sample_rate'),
+                    'language': stream.get('tags', {}).get('language'),
+                }
+                for stream in probe.get('streams', [])
+            ],
+            'keyframes': None,
+        }
+        if keyframes:
+            record['keyframes'] = self._probe_keyframes(path)
+        return record
+
+    def _probe_keyframes(self, path: str) -> list:
+        # Reading packet headers only demuxes the file, nothing gets decoded
+        probe = ffmpeg.probe(path, select_streams='v:0', show_entries='packet=pts_time,pos,flags')
+        keyframes = []
+        for packet in probe.get('packets', []):
+            if 'K' in packet.get('flags', '') and packet.get('pts_time') not in (None, 'N/A'):
+                pos = packet.get('pos')
+                keyframes.append([float(packet['pts_time']), int(pos) if pos not in (None, 'N/A') else None])
+        keyframes.sort(key=lambda keyframe: keyframe[0])
+        return keyframes
+
+    def _load_sidecar(self, path: str) -> Optional[dict]:
+        try:
+            with open(self.sidecar_path(path)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_sidecar(self, path: str, record: dict):
+        sidecar_path = self.sidecar_path(path)
+        tmp_path = f"{sidecar_path}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(record, f)
+            os.replace(tmp_path, sidecar_path)
+        except OSError as e:
+            logging.error(f"Error saving probe cache for {path}: {e}")
+
+
+probe_cache = ProbeCache()
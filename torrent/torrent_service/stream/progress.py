@@ -0,0 +1,89 @@
+import logging
+import threading
+import time
+from typing import Optional
+
+from django.conf import settings
+
+from .models import MovieFile
+
+
+class ProgressFlusher:
+    """
+    Coalesce MovieFile field updates from the download threads in memory.
+
+    Progress changes are written every ``interval`` seconds with one ``bulk_update``
+    per set of changed fields, instead of a full-row save per torrent per second.
+    Changes to ``download_status`` or ``file_path`` are state transitions and are
+    written right away, together with anything else pending for that movie. Until
+    a value is written, ``apply`` lays it over an instance read from the database.
+    """
+
+    immediate_fields = {'download_status', 'file_path'}
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._pending = {}  # movie id -> {field: value}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def record(self, movie_file: MovieFile, *fields: str):
+        """Note that ``fields`` of ``movie_file`` changed."""
+        with self._lock:
+            pending = self._pending.setdefault(movie_file.id, {})
+            for field in fields:
+                pending[field] = getattr(movie_file, field)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+                self._thread.start()
+        if self.immediate_fields.intersection(fields):
+            self.flush(movie_file.id)
+
+    def apply(self, movie_file: MovieFile) -> MovieFile:
+        """Overlay values that are not written yet onto ``movie_file``."""
+        with self._lock:
+            pending = dict(self._pending.get(movie_file.id, {}))
+        for field, value in pending.items():
+            setattr(movie_file, field, value)
+        return movie_file
+
+    def flush(self, movie_id: Optional[int] = None):
+        """Write pending changes of one movie, or of every movie."""
+        with self._lock:
+            if movie_id is None:
+                batch, self._pending = self._pending, {}
+            else:
+                batch = {movie_id: self._pending.pop(movie_id)} if movie_id in self._pending else {}
+        if not batch:
+            return
+
+        groups = {}
+        for pk, fields in batch.items():
+            groups.setdefault(tuple(sorted(fields)), []).append(MovieFile(id=pk, **fields))
+        for fields, movie_files in groups.items():
+            try:
+                if len(movie_files) == 1:
+                    MovieFile.objects.filter(id=movie_files[0].id).update(
+                        **{field: getattr(movie_files[0], field) for field in fields}
+                    )
+                else:
+                    MovieFile.objects.bulk_update(movie_files, fields)
+            except Exception as e:
+                logging.error(f"Error writing movie progress: {e}")
+                self._requeue(batch, [movie_file.id for movie_file in movie_files])
+
+    def _requeue(self, batch: dict, movie_ids: list):
+        # Keep unwritten values for the next flush unless newer ones arrived meanwhile
+        with self._lock:
+            for pk in movie_ids:
+                pending = self._pending.setdefault(pk, {})
+                for field, value in batch[pk].items():
+                    pending.setdefault(field, value)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+
+progress_flusher = ProgressFlusher(settings.PROGRESS_FLUSH_INTERVAL)
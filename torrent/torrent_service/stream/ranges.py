@@ -0,0 +1,273 @@
+import asyncio
+import os
+import re
+import uuid
+from typing import AsyncIterator, Iterator, List, Optional, Tuple
+
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+
+# Finished segments never change, so browsers and CDNs can keep them for good
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# More ranges than this in one request is treated as abuse and ignored
+MAX_RANGES = 16
+
+range_spec_re = re.compile(r"^\s*(\d*)\s*-\s*(\d*)\s*$")
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+class RangeFile:
+    """
+    Read-only file limited to ``length`` bytes starting at ``start``.
+
+    It exposes ``fileno`` and keeps the OS file offset at ``start``, so gunicorn's
+    ``wsgi.file_wrapper`` can hand it to ``os.sendfile`` together with the response
+    Content-Length. Other servers fall back to ``read``, which stops at the end of
+    the range.
+    """
+
+    def __init__(self, path: str, start: int, length: int):
+        self.name = path
+        self._file = open(path, 'rb')
+        self._file.seek(start)
+        self._remaining = length
+
+    def read(self, size: int = -1) -> bytes:
+        if self._remaining <= 0:
+            return b''
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def fileno(self) -> int:
+        return self._file.fileno()
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+    def close(self):
+        self._file.close()
+
+
+def parse_range_header(header: str, size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Parse a ``Range`` header into inclusive ``(first, last)`` byte pairs.
+
+    Returns None when the header is absent, malformed or not in bytes, in which case
+    the whole representation is sent. Raises RangeNotSatisfiable when the header is
+    valid but none of its ranges overlaps the file. Overlapping and adjacent ranges
+    are merged.
+    """
+    if not header:
+        return None
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not specs:
+        return None
+    specs = specs.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        match = range_spec_re.match(spec)
+        if not match or not (match.group(1) or match.group(2)):
+            return None
+        first, last = match.group(1), match.group(2)
+        if not first:
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length == 0:
+                continue
+            ranges.append((max(size - length, 0), size - 1))
+            continue
+        first = int(first)
+        if last and int(last) < first:
+            return None
+        last = int(last) if last else size - 1
+        if first < size:
+            ranges.append((first, min(last, size - 1)))
+
+    if not ranges or size == 0:
+        raise RangeNotSatisfiable()
+
+    ranges.sort()
+    merged = [ranges[0]]
+    for first, last in ranges[1:]:
+        if first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def file_validators(path: str) -> Tuple[str, int, int]:
+    """Strong ETag, Last-Modified timestamp and size derived from the file's stat data."""
+    stat = os.stat(path)
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    return etag, int(stat.st_mtime), stat.st_size
+
+
+def _etag_list(header: str) -> List[str]:
+    return [tag.strip() for tag in header.split(',') if tag.strip()]
+
+
+def _weak_match(etag: str, tags: List[str]) -> bool:
+    return '*' in tags or any(tag.removeprefix('W/') == etag for tag in tags)
+
+
+def check_preconditions(meta, etag: str, last_modified: int) -> Optional[int]:
+    """Evaluate conditional request headers, returning 304 or 412 when they apply."""
+    if_match = meta.get('HTTP_IF_MATCH')
+    if if_match:
+        tags = _etag_list(if_match)
+        if '*' not in tags and etag not in tags:
+            return 412
+    else:
+        unmodified_since = parse_http_date_safe(meta.get('HTTP_IF_UNMODIFIED_SINCE', ''))
+        if unmodified_since is not None and last_modified > unmodified_since:
+            return 412
+
+    if_none_match = meta.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        if _weak_match(etag, _etag_list(if_none_match)):
+            return 304
+    else:
+        modified_since = parse_http_date_safe(meta.get('HTTP_IF_MODIFIED_SINCE', ''))
+        if modified_since is not None and last_modified <= modified_since:
+            return 304
+    return None
+
+
+def if_range_allows(meta, etag: str, last_modified: int) -> bool:
+    """Whether a Range header may be honoured given the request's If-Range validator."""
+    if_range = meta.get('HTTP_IF_RANGE', '').strip()
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        # Only strong validators are allowed here
+        return if_range == etag
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def _multipart_parts(ranges, size: int, content_type: str, boundary: str):
+    for first, last in ranges:
+        header = (
+            f"\r\n--{boundary}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Range: bytes {first}-{last}/{size}\r\n\r\n"
+        ).encode()
+        yield header, first, last
+    yield f"\r\n--{boundary}--\r\n".encode(), None, None
+
+
+def _file_body(path: str, parts, block_size: int) -> Iterator[bytes]:
+    """Yield each part's header followed by its byte range read from ``path``."""
+    with open(path, 'rb') as f:
+        for header, first, last in parts:
+            if header:
+                yield header
+            if first is None:
+                continue
+            f.seek(first)
+            remaining = last - first + 1
+            while remaining > 0:
+                data = f.read(min(block_size, remaining))
+                if not data:
+                    return
+                remaining -= len(data)
+                yield data
+
+
+async def _async_file_body(path: str, parts, block_size: int) -> AsyncIterator[bytes]:
+    """Same as ``_file_body`` with every blocking read done in a worker thread."""
+    f = await asyncio.to_thread(open, path, 'rb')
+    try:
+        for header, first, last in parts:
+            if header:
+                yield header
+            if first is None:
+                continue
+            remaining = last - first + 1
+            offset = first
+            while remaining > 0:
+                data = await asyncio.to_thread(os.pread, f.fileno(), min(block_size, remaining), offset)
+                if not data:
+                    return
+                remaining -= len(data)
+                offset += len(data)
+                yield data
+    finally:
+        f.close()
+
+
+def serve_file(request, path: str, content_type: str, cache_control: str = IMMUTABLE_CACHE_CONTROL,
+               block_size: int = 512 * 1024, asynchronous: bool = False) -> HttpResponse:
+    """
+    Answer a GET for ``path`` with full HTTP range and conditional request support:
+    single ranges (sent with sendfile where the server supports it), suffix ranges,
+    multipart/byteranges for several ranges, 416 for unsatisfiable ranges, 304 and 412
+    from If-None-Match/If-Modified-Since/If-Match/If-Unmodified-Since, and If-Range.
+
+    With ``asynchronous`` the body is an async iterator for ASGI servers, so a slow
+    viewer only holds a coroutine instead of a worker.
+    """
+    etag, last_modified, size = file_validators(path)
+    validators = {
+        'ETag': etag,
+        'Last-Modified': http_date(last_modified),
+        'Cache-Control': cache_control,
+        'Accept-Ranges': 'bytes',
+    }
+
+    precondition = check_preconditions(request.META, etag, last_modified)
+    if precondition is not None:
+        response = HttpResponse(status=precondition)
+        if precondition == 304:
+            del response['Content-Type']
+            for header, value in validators.items():
+                response[header] = value
+        return response
+
+    ranges = None
+    if if_range_allows(request.META, etag, last_modified):
+        try:
+            ranges = parse_range_header(request.META.get('HTTP_RANGE', ''), size)
+        except RangeNotSatisfiable:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            response['Accept-Ranges'] = 'bytes'
+            return response
+
+    if ranges and len(ranges) > 1:
+        boundary = uuid.uuid4().hex
+        parts = list(_multipart_parts(ranges, size, content_type, boundary))
+        content_type = f'multipart/byteranges; boundary={boundary}'
+    else:
+        first, last = ranges[0] if ranges else (0, size - 1)
+        parts = [(b'', first, last)]
+    length = sum(len(header) for header, _, _ in parts)
+    length += sum(last - first + 1 for _, first, last in parts if first is not None)
+    status = 206 if ranges else 200
+
+    if asynchronous:
+        response = StreamingHttpResponse(_async_file_body(path, parts, block_size), status=status,
+                                         content_type=content_type)
+    elif len(parts) == 1:
+        response = FileResponse(RangeFile(path, first, length), status=status, content_type=content_type)
+        response.block_size = block_size
+    else:
+        response = StreamingHttpResponse(_file_body(path, parts, block_size), status=status,
+                                         content_type=content_type)
+
+    response['Content-Length'] = str(length)
+    if ranges and len(ranges) == 1:
+        response['Content-Range'] = f'bytes {first}-{last}/{size}'
+    for header, value in validators.items():
+        response[header] = value
+    return response
@@ -0,0 +1,96 @@
+import bisect
+from typing import Optional
+
+
+class SegmentReadiness:
+    """
+    Map segment time ranges of a torrent file to the torrent pieces that hold them.
+
+    Time is turned into byte offsets with the keyframe index from the probe cache.
+    Between known keyframes, or past the end of a partial index, the offset is
+    interpolated and widened by a margin so VBR content does not start too early.
+    Byte offsets become pieces through ``torrent_info.map_file`` and a segment
+    range is ready once ``handle.have_piece`` holds for every one of them, plus the
+    container header that ffmpeg needs to open the file at all.
+
+    Nothing is ready before the file could be probed: for MP4s with the index at
+    the end that also means the tail of the file is on disk.
+    """
+
+    header_bytes = 2 * 1024 * 1024
+    estimate_margin = 0.05
+
+    def __init__(self, handle, torrent_info, file_index: int, segment_duration: int):
+        self.handle = handle
+        self.torrent_info = torrent_info
+        self.file_index = file_index
+        self.file_size = torrent_info.files().file_size(file_index)
+        self.segment_duration = segment_duration
+        self.duration = None
+        self._times = []
+        self._anchors = []
+
+    def update_probe(self, record: dict):
+        """Take duration and keyframe positions from a probe cache record."""
+        self.duration = record.get('duration')
+        if not self.duration:
+            return
+        # (time, byte offset, exact) - the end of the file is only an estimate anchor
+        anchors = [(0.0, 0, True)]
+        for pts, pos in record.get('keyframes') or []:
+            if pos is not None and 0 < pts < self.duration:
+                anchors.append((pts, pos, True))
+        anchors.append((self.duration, self.file_size, False))
+        self._anchors = anchors
+        self._times = [anchor[0] for anchor in anchors]
+
+    def byte_offset(self, seconds: float, round_up: bool = False) -> int:
+        """Byte offset of the keyframe before ``seconds`` (or after it with ``round_up``)."""
+        seconds = min(max(seconds, 0.0), self.duration)
+        i = min(max(bisect.bisect_right(self._times, seconds), 1), len(self._anchors) - 1)
+        lo, hi = self._anchors[i - 1], self._anchors[i]
+        if lo[2] and hi[2]:
+            return hi[1] if round_up and seconds > lo[0] else lo[1]
+
+        span = hi[1] - lo[1]
+        fraction = (seconds - lo[0]) / (hi[0] - lo[0]) if hi[0] > lo[0] else 0
+        margin = self.estimate_margin * span
+        offset = lo[1] + fraction * span + (margin if round_up else -margin)
+        return int(min(max(offset, lo[1]), hi[1]))
+
+    def byte_range(self, first_segment: int, end_segment: Optional[int]) -> tuple:
+        """Half-open byte range ``[start, stop)`` holding segments ``[first_segment, end_segment)``."""
+        start = self.byte_offset(first_segment * self.segment_duration)
+        if end_segment is None:
+            return start, self.file_size
+        return start, self.byte_offset(end_segment * self.segment_duration, round_up=True)
+
+    def pieces(self, start: int, stop: int) -> range:
+        if stop <= start:
+            return range(0)
+        first = self.torrent_info.map_file(self.file_index, start, 1).piece
+        last = self.torrent_info.map_file(self.file_index, min(stop, self.file_size) - 1, 1).piece
+        return range(first, last + 1)
+
+    def header_range(self) -> tuple:
+        first_keyframe = self._anchors[1][1] if len(self._anchors) > 2 else self.header_bytes
+        return 0, min(max(first_keyframe, 1), self.file_size)
+
+    def is_ready(self, first_segment: int, end_segment: Optional[int]) -> bool:
+        """Whether every piece ffmpeg needs to produce the segments has been downloaded."""
+        if not self.duration:
+            return False
+        for start, stop in (self.header_range(), self.byte_range(first_segment, end_segment)):
+            if not all(self.handle.have_piece(piece) for piece in self.pieces(start, stop)):
+                return False
+        return True
+
+    def contiguous_bytes(self, known: int = 0) -> int:
+        """Number of bytes at the start of the file whose pieces have all been downloaded."""
+        available = known
+        while available < self.file_size:
+            request = self.torrent_info.map_file(self.file_index, available, 1)
+            if not self.handle.have_piece(request.piece):
+                break
+            available += self.torrent_info.piece_size(request.piece) - request.start
+        return min(available, self.file_size)
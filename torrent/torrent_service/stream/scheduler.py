@@ -0,0 +1,396 @@
+import itertools
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+from django.conf import settings
+
+
+class SegmentJob:
+    """One segmenting engine run waiting for, or holding, a slot in the transcode pool."""
+
+    def __init__(self, movie_id: int, engine, is_ready: Optional[Callable[[], bool]] = None):
+        self.movie_id = movie_id
+        self.engine = engine
+        self.is_ready = is_ready or (lambda: True)
+        self.success = False
+        self.cancelled = False
+        self._done = threading.Event()
+
+    @property
+    def first_segment(self) -> int:
+        return self.engine.next_segment()
+
+    @property
+    def end_segment(self) -> Optional[int]:
+        return self.engine.end_segment
+
+    def run(self):
+        try:
+            if self.cancelled:
+                return
+            self.engine.start()
+            self.success = self.engine.wait()
+            # The speed governor stopped the engine to change its encoder settings
+            while not self.success and self.engine.restarting and not self.cancelled and not self._finished():
+                self.engine = self.engine.resume()
+                self.engine.start()
+                self.success = self.engine.wait()
+        except Exception as e:
+            logging.error(f"Segment job for movie {self.movie_id} failed: {e}")
+            self.success = False
+        finally:
+            self._done.set()
+
+    def _finished(self) -> bool:
+        return self.end_segment is not None and self.first_segment >= self.end_segment
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        self._done.wait(timeout)
+        return self.success
+
+    def is_done(self) -> bool:
+        return self._done.is_set()
+
+
+class TranscodePool:
+    """
+    Bounded set of ffmpeg slots shared by every movie handled by this process.
+
+    Each worker thread runs one ``SegmentJob`` at a time. When a slot frees up, the
+    ready job whose first segment is closest ahead of its movie's playhead goes
+    next; jobs behind the playhead come after everything ahead of it.
+
+    Jobs fed from the download pipe wait on the network far more than they encode
+    and last as long as the download, so they do not take a slot: each runs on a
+    thread of its own as soon as it is submitted, and the download queue's
+    ``MAX_ACTIVE_DOWNLOADS`` bounds how many there are. Seek jobs and the chunks of
+    downloaded titles always find the workers free of them.
+    """
+
+    readiness_poll_interval = 1
+
+    def __init__(self, workers: int):
+        self.workers = max(1, workers)
+        self.governor = None
+        self._jobs = []
+        self._running = set()
+        self._order = {}
+        self._counter = itertools.count()
+        self._playheads = {}
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def submit(self, job: SegmentJob) -> SegmentJob:
+        if job.engine.pipe:
+            with self._cond:
+                self._running.add(job)
+            threading.Thread(target=self._run, args=(job,), daemon=True).start()
+            if self.governor is not None:
+                self.governor.start()
+            return job
+        with self._cond:
+            self._jobs.append(job)
+            self._order[job] = next(self._counter)
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+                if self.governor is not None:
+                    self.governor.start()
+            self._cond.notify()
+        return job
+
+    def cancel(self, job: SegmentJob):
+        """Drop a job that has not started yet, or stop its ffmpeg if it is running."""
+        job.cancelled = True
+        with self._cond:
+            if job in self._jobs:
+                self._jobs.remove(job)
+                del self._order[job]
+                job._done.set()
+        job.engine.stop()
+
+    def set_playhead(self, movie_id: int, segment: int):
+        with self._cond:
+            self._playheads[movie_id] = segment
+            self._cond.notify_all()
+
+    def clear_playhead(self, movie_id: int):
+        with self._cond:
+            self._playheads.pop(movie_id, None)
+
+    def playhead(self, movie_id: int) -> int:
+        return self._playheads.get(movie_id, 0)
+
+    def watched(self, movie_id: int) -> bool:
+        """Whether a viewer has asked for a segment of the movie."""
+        return movie_id in self._playheads
+
+    def running_jobs(self) -> list:
+        with self._cond:
+            return list(self._running)
+
+    def queued_jobs(self, movie_id: Optional[int] = None) -> int:
+        with self._cond:
+            return sum(1 for job in self._jobs if movie_id is None or job.movie_id == movie_id)
+
+    def _priority(self, job: SegmentJob) -> tuple:
+        distance = job.first_segment - self._playheads.get(job.movie_id, 0)
+        return (distance < 0, abs(distance), self._order[job])
+
+    def _next_job(self) -> Optional[SegmentJob]:
+        ready = []
+        for job in list(self._jobs):
+            try:
+                if job.is_ready():
+                    ready.append(job)
+            except Exception as e:
+                # A job that cannot tell would otherwise take the worker thread down
+                logging.error(f"Dropping segment job for movie {job.movie_id}: {e}")
+                self._jobs.remove(job)
+                del self._order[job]
+                job._done.set()
+        return min(ready, key=self._priority, default=None)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    # Readiness changes as torrent pieces arrive, without a notify
+                    self._cond.wait(self.readiness_poll_interval)
+                    job = self._next_job()
+                self._jobs.remove(job)
+                del self._order[job]
+                self._running.add(job)
+            self._run(job)
+
+    def _run(self, job: SegmentJob):
+        if self.governor is not None:
+            job.engine.level = self.governor.level(job.movie_id)
+        try:
+            job.run()
+        finally:
+            with self._cond:
+                self._running.discard(job)
+
+
+class SpeedGovernor:
+    """
+    Keeps transcodes ahead of their viewers by trading quality for encoding speed.
+
+    Every ``interval`` seconds it compares the speed ffmpeg reports for each running
+    video transcode, as a multiple of realtime, with how far the run is ahead of its
+    movie's playhead. When a run that a viewer is heading into encodes slower than
+    ``min_speed`` with less than ``min_lead`` segments to spare, the movie steps one
+    encoder level down (a faster preset, then a smaller picture). When all of its
+    runs manage ``headroom_speed``, it steps back up. Levels are numbered from 0, the
+    best; the settings behind them are the engines' business.
+
+    A run switches at its next segment by restarting ffmpeg there. Runs fed from the
+    download pipe go as fast as the download and cannot start over in the middle, so
+    they are left alone; they start at their movie's level like any other run.
+    """
+
+    interval = 2
+    settle_time = 10  # Seconds of encoding before a run's speed is trusted
+    cooldown = 30  # Seconds between two level changes of a movie
+    min_speed = 1.1
+    min_lead = 6
+    headroom_speed = 2.5
+
+    def __init__(self, pool: TranscodePool, levels: int, start_level: int):
+        self.pool = pool
+        self.levels = levels
+        self.start_level = start_level
+        self._levels = {}  # movie id -> encoder level
+        self._changed_at = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        pool.governor = self
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def level(self, movie_id: int) -> int:
+        with self._lock:
+            return self._levels.get(movie_id, self.start_level)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except Exception as e:
+                logging.error(f"Speed governor check failed: {e}")
+
+    def check(self, now: Optional[float] = None):
+        """Step the encoder level of every movie whose transcodes fall behind or have room to spare."""
+        now = now or time.time()
+        movies = {}
+        for job in self.pool.running_jobs():
+            engine = job.engine
+            if engine.transcodes_video and not engine.pipe and engine.started_at is not None:
+                movies.setdefault(job.movie_id, []).append(job)
+        for movie_id, jobs in movies.items():
+            step = self._step(movie_id, jobs, now)
+            if step:
+                self._change(movie_id, jobs, step, now)
+
+    def _step(self, movie_id: int, jobs: list, now: float) -> int:
+        level = self.level(movie_id)
+        if now - self._changed_at.get(movie_id, 0) < self.cooldown:
+            return 0
+        engines = [job.engine for job in jobs]
+        measured = [engine for engine in engines
+                    if engine.speed is not None and now - engine.started_at >= self.settle_time]
+        if not measured:
+            return 0
+
+        playhead = self.pool.playhead(movie_id)
+        behind = self.pool.watched(movie_id) and any(
+            0 <= engine.next_segment() - playhead < self.min_lead and engine.speed < self.min_speed
+            for engine in measured
+        )
+        if behind:
+            return 1 if level < self.levels - 1 else 0
+        if len(measured) == len(engines) and level > 0 and all(engine.speed >= self.headroom_speed for engine in measured):
+            return -1
+        return 0
+
+    def _change(self, movie_id: int, jobs: list, step: int, now: float):
+        with self._lock:
+            level = self._levels.get(movie_id, self.start_level) + step
+            self._levels[movie_id] = level
+            self._changed_at[movie_id] = now
+        speeds = ", ".join(f"{job.engine.speed:.2f}x" for job in jobs if job.engine.speed is not None)
+        logging.info(f"{'Lowering' if step > 0 else 'Raising'} encoder quality of movie {movie_id} "
+                     f"to level {level} (speed {speeds})")
+        for job in jobs:
+            if not job.cancelled:
+                job.engine.restart(level)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class DownloadQueue:
+    """
+    Admission control for movie downloads.
+
+    At most ``max_active`` titles download at once. Further titles wait here, with no
+    thread or torrent of their own, and past ``max_queued`` waiting titles new ones
+    are refused. Titles are keyed by IMDb id, so asking for one twice queues it once.
+    When a slot frees up, the title with the most viewers waiting goes next; titles
+    resumed after a restart, which nobody asked for yet, go last.
+    """
+
+    def __init__(self, max_active: int, max_queued: int):
+        self.max_active = max(1, max_active)
+        self.max_queued = max_queued
+        self._active = {}  # key -> movie id
+        self._queued = {}  # key -> [movie id, start, viewers, order]
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def add_listener(self, listener: Callable[[list], None]):
+        """``listener(movie_ids)`` is called when the queue positions of those movies change."""
+        self._listeners.append(listener)
+
+    def submit(self, key, movie_id: int, start: Callable[[], None], viewer: bool = True) -> int:
+        """
+        Run ``start()`` for a title once a download slot is free. Returns the title's
+        queue position, 0 once it is running; raises ``QueueFull`` when it cannot wait.
+        """
+        with self._lock:
+            if key in self._active:
+                return 0
+            if key in self._queued:
+                self._queued[key][2] += viewer
+                position = self._position(key)
+                changed = self._queued_movies()
+            elif len(self._active) < self.max_active:
+                self._active[key] = movie_id
+                position = None
+            elif len(self._queued) >= self.max_queued:
+                raise QueueFull(f"{len(self._queued)} downloads are already waiting")
+            else:
+                self._queued[key] = [movie_id, start, int(viewer), next(self._counter)]
+                position = self._position(key)
+                changed = self._queued_movies()
+
+        if position is None:
+            start()
+            return 0
+        self._notify(changed)
+        return position
+
+    def release(self, key):
+        """Free the slot of a title whose download ended, and start the next one."""
+        with self._lock:
+            if self._active.pop(key, None) is None and self._queued.pop(key, None) is None:
+                return
+            entry = None
+            if self._queued and len(self._active) < self.max_active:
+                next_key = min(self._queued, key=self._priority)
+                entry = self._queued.pop(next_key)
+                self._active[next_key] = entry[0]
+            changed = self._queued_movies()
+
+        if entry is not None:
+            threading.Thread(target=self._start, args=(entry,), daemon=True).start()
+        self._notify(changed)
+
+    def release_movie(self, movie_id: int):
+        """Free the slot, or the place in the queue, of a movie whatever its key."""
+        with self._lock:
+            keys = [key for key, active_id in self._active.items() if active_id == movie_id]
+            keys += [key for key, entry in self._queued.items() if entry[0] == movie_id]
+        for key in keys:
+            self.release(key)
+
+    def position(self, movie_id: int) -> Optional[int]:
+        """1-based place of a waiting movie in the queue, 0 if it downloads, None if unknown."""
+        with self._lock:
+            if movie_id in self._active.values():
+                return 0
+            for key, entry in self._queued.items():
+                if entry[0] == movie_id:
+                    return self._position(key)
+        return None
+
+    def _priority(self, key) -> tuple:
+        movie_id, _, viewers, order = self._queued[key]
+        return (-viewers, order)
+
+    def _position(self, key) -> int:
+        return sorted(self._queued, key=self._priority).index(key) + 1
+
+    def _queued_movies(self) -> list:
+        return [entry[0] for entry in self._queued.values()]
+
+    def _start(self, entry: list):
+        try:
+            entry[1]()
+        except Exception as e:
+            logging.error(f"Could not start queued download of movie {entry[0]}: {e}")
+
+    def _notify(self, movie_ids: list):
+        if not movie_ids:
+            return
+        for listener in self._listeners:
+            try:
+                listener(movie_ids)
+            except Exception as e:
+                logging.error(f"Error in download queue listener: {e}")
+
+
+transcode_pool = TranscodePool(settings.TRANSCODE_WORKERS)
+download_queue = DownloadQueue(settings.MAX_ACTIVE_DOWNLOADS, settings.MAX_QUEUED_DOWNLOADS)
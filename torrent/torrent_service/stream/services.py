@@ -1,34 +1,547 @@
+import csv
+import json
 import logging
+import math
 import os
-from typing import Optional, Union
-from django.http import StreamingHttpResponse, FileResponse
+import subprocess
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional
+from urllib.parse import quote
+from django.http import HttpResponse
 import re, os
 import time
 import ffmpeg
 from .models import MovieFile
-from srt_to_vtt import srt_to_vtt
+from .probe import probe_cache
+from .manifest import manifest_path_for, manifest_store, mp4_boxes, mp4_init_size, read_init_section
+from .ranges import IMMUTABLE_CACHE_CONTROL, serve_file
+from .scheduler import SegmentJob, SpeedGovernor, transcode_pool
+from .subtitles import vtt_cache, write_vtt
 from django.conf import settings
 import requests
 
 
-range_re = re.compile(r"bytes\s*=\s*(\d+)\s*-\s*(\d*)", re.I)
+
+# Encoder settings for transcoded video, best first, as (x264 preset, output height or
+# None for the source's). The speed governor moves each movie along this list.
+ENCODER_LEVELS = [
+    ('veryfast', None),
+    ('superfast', None),
+    ('ultrafast', None),
+    ('ultrafast', 720),
+    ('ultrafast', 480),
+]
+DEFAULT_ENCODER_LEVEL = 2
+
+speed_governor = SpeedGovernor(transcode_pool, levels=len(ENCODER_LEVELS), start_level=DEFAULT_ENCODER_LEVEL)
+
+
+class StreamPlan:
+    """
+    What the segmenter does with each stream of a source: ``copy`` one browsers play
+    as is, ``transcode`` one they do not (video to H.264, audio to stereo AAC).
+    Audio is only copied along with copied video.
+
+    Segments are always fragmented MP4, so a source whose streams are all playable,
+    say an MKV with H.264 and AAC, is only remuxed, and one with H.264 video and
+    AC3 or DTS audio only has its audio encoded. Without stream indices (the probe
+    failed) ffmpeg picks the streams and both are transcoded.
+    """
+
+    def __init__(self, video: str = 'transcode', audio: Optional[str] = 'transcode',
+                 video_index: Optional[int] = None, audio_index: Optional[int] = None,
+                 height: Optional[int] = None):
+        self.video = video
+        self.audio = audio
+        self.video_index = video_index
+        self.audio_index = audio_index
+        self.height = height
+
+    @property
+    def copy(self) -> bool:
+        return self.video == 'copy' and self.audio in ('copy', None)
+
+    def describe(self, level: int = DEFAULT_ENCODER_LEVEL) -> str:
+        video = self.video
+        if self.video == 'transcode':
+            preset, _ = ENCODER_LEVELS[level]
+            height = self.output_height(level)
+            video = f"transcode {preset}{f' {height}p' if height else ''}"
+        return f"video {video}, audio {self.audio or 'none'}"
+
+    def output_height(self, level: int) -> Optional[int]:
+        """Height transcoded video is scaled to at an encoder level, None to keep the source's."""
+        height = ENCODER_LEVELS[level][1]
+        if self.video != 'transcode' or height is None or not self.height or height >= self.height:
+            return None
+        return height
+
+    def output_streams(self, source, level: int = DEFAULT_ENCODER_LEVEL) -> list:
+        if self.video_index is None:
+            return [source]
+        video = source[str(self.video_index)]
+        height = self.output_height(level)
+        streams = [video.filter('scale', -2, height) if height else video]
+        if self.audio_index is not None:
+            streams.append(source[str(self.audio_index)])
+        return streams
+
+    def codec_kwargs(self, segment_duration: int, level: int = DEFAULT_ENCODER_LEVEL) -> dict:
+        if self.video == 'copy':
+            kwargs = {'c:v': 'copy'}
+        else:
+            kwargs = {
+                'c:v': 'libx264',
+                'preset': ENCODER_LEVELS[level][0],
+                'pix_fmt': 'yuv420p',
+                # Keyframes on the segment grid so the muxer can cut exactly there
+                'force_key_frames': f"expr:gte(t,n_forced*{segment_duration})",
+            }
+        if self.audio == 'copy':
+            kwargs['c:a'] = 'copy'
+        elif self.audio == 'transcode':
+            kwargs.update({'c:a': 'aac', 'ac': 2, 'b:a': '160k'})
+        return kwargs
+
+
+def plan_segment_boundaries(keyframes: list, duration: float, segment_duration: int,
+                            delta: float = 0.05) -> list:
+    """
+    Start times of the segments of a stream-copied video with these keyframe times.
+
+    Segment n+1 starts at the first keyframe after the start of segment n that is at
+    or past ``(n + 1) * segment_duration`` (less ``delta``). That is the rule ffmpeg's
+    segment muxer follows when it cuts copied video on its own, so segments cut
+    from a pipe while downloading and ones cut later from the whole file line up.
+    """
+    boundaries = [0.0]
+    for pts in sorted(keyframes):
+        if pts >= duration:
+            break
+        if pts > boundaries[-1] and pts >= len(boundaries) * segment_duration - delta:
+            boundaries.append(pts)
+    return boundaries
+
+
+class Rendition:
+    """
+    One lower rung of the bitrate ladder, configured as ``"<height>:<video kb/s>"``.
+
+    Its segments are encoded one by one from the published source segments, which
+    start on a keyframe and are never deleted, so a rendition can be produced long
+    after the download and even once the torrent file itself is gone.
+    """
+
+    # The audio is copied from the source segment
+    audio_bandwidth = 192_000
+
+    def __init__(self, height: int, video_kbps: int):
+        self.height = height
+        self.video_kbps = video_kbps
+
+    @classmethod
+    def parse(cls, spec: str) -> 'Rendition':
+        height, video_kbps = spec.split(':')
+        return cls(int(height), int(video_kbps))
+
+    @property
+    def name(self) -> str:
+        return f"{self.height}p"
+
+    @property
+    def maxrate_kbps(self) -> int:
+        return int(self.video_kbps * 1.1)
+
+    @property
+    def bandwidth(self) -> int:
+        return self.maxrate_kbps * 1000 + self.audio_bandwidth
+
+    def resolution(self, source_resolution: tuple) -> tuple:
+        width, height = source_resolution
+        return round(width * self.height / height / 2) * 2, self.height
+
+    def output_streams(self, source) -> list:
+        # The audio is optional, not every source has some
+        return [source['v:0'].filter('scale', -2, self.height), source['a:0?']]
+
+    def codec_kwargs(self) -> dict:
+        return {
+            'c:v': 'libx264',
+            'preset': 'veryfast',
+            'pix_fmt': 'yuv420p',
+            'b:v': f"{self.video_kbps}k",
+            'maxrate': f"{self.maxrate_kbps}k",
+            'bufsize': f"{self.video_kbps * 2}k",
+            # Keep the source frames as they are, MP4 output would pad them to a constant rate
+            'vsync': 'passthrough',
+            'c:a': 'copy',
+        }
+
+
+speed_re = re.compile(r"speed=\s*([\d.]+)x")
+
+
+class SegmentingEngine:
+    """
+    Run one long-lived ffmpeg per movie and publish its segments as they complete.
+
+    ffmpeg's segment muxer writes into a hidden staging directory next to the source
+    file. Every segment it reports as finished in its CSV segment list is moved to
+    ``<base>_segment_NNN.mp4`` and recorded in the movie's segment manifest, which
+    also rewrites the ``<base>.m3u8`` playlist, so readers never see a half-written
+    segment.
+
+    In pipe mode ffmpeg reads from stdin and the engine feeds it from the partially
+    downloaded file, never past the byte offset last passed to ``advance``. In file
+    mode the run can be limited to ``[start_segment, end_segment)`` so several
+    engines can work on different parts of the same movie. With ``boundaries`` a
+    file mode run seeks to its first segment's keyframe and cuts exactly at the
+    planned start times instead of on the fixed grid.
+
+    Transcoded video is encoded at one of the ``ENCODER_LEVELS``. ffmpeg reports
+    its speed as it goes, in ``speed``, and a file mode run can be ``restart``-ed at
+    another level from its next segment.
+    """
+
+    poll_interval = 0.5
+    feed_chunk_size = 1024 * 1024
+
+    def __init__(self, input_path: str, segment_duration: int = 10, plan: Optional[StreamPlan] = None,
+                 start_segment: int = 0, end_segment: Optional[int] = None, pipe: bool = False,
+                 boundaries: Optional[list] = None, level: int = DEFAULT_ENCODER_LEVEL):
+        self.input_path = input_path
+        self.segment_duration = segment_duration
+        self.plan = plan or StreamPlan()
+        self.level = level
+        self.boundaries = boundaries if boundaries and not pipe else None
+        self.start_segment = start_segment
+        self.end_segment = end_segment
+        self.pipe = pipe
+
+        self.output_dir = os.path.dirname(input_path)
+        self.base_name = os.path.splitext(os.path.basename(input_path))[0]
+        self.staging_dir = os.path.join(self.output_dir, f".{self.base_name}_staging_{start_segment:03d}")
+        self.segment_list_path = os.path.join(self.staging_dir, "segments.csv")
+        self.manifest_path = manifest_path_for(input_path)
+
+        self.process = None
+        self.published = {}  # segment number -> (start time, duration)
+        self.error = None
+        self.speed = None  # Realtime multiple ffmpeg last reported
+        self.started_at = None
+        self.restarting = False
+        self._available = 0
+        self._fed = 0
+        self._input_complete = False
+        self._stopped = False
+        self._cond = threading.Condition()
+        # The monitor, the job thread and a governor restart may all publish at once
+        self._publish_lock = threading.Lock()
+        self._stderr_tail = deque(maxlen=20)
+        self._threads = []
+
+    def segment_path(self, segment: int) -> str:
+        return os.path.join(self.output_dir, f"{self.base_name}_segment_{segment:03d}.mp4")
+
+    def segment_start(self, segment: int) -> Optional[float]:
+        """Start time of a segment; None past the last planned one, i.e. the end of the file."""
+        if self.boundaries:
+            return self.boundaries[segment] if segment < len(self.boundaries) else None
+        return segment * self.segment_duration
+
+    def _seek_point(self, boundary: float) -> float:
+        """Halfway between a boundary and the keyframe after it."""
+        keyframes = probe_cache.get(self.input_path, keyframes=True).get('keyframes') or []
+        following = next((pts for pts, _ in keyframes if pts > boundary + 0.001), boundary + 1)
+        return (boundary + following) / 2
+
+    def start(self):
+        """Spawn ffmpeg and the threads that feed it and collect its segments."""
+        os.makedirs(self.staging_dir, exist_ok=True)
+        if os.path.exists(self.segment_list_path):
+            os.remove(self.segment_list_path)
+
+        input_kwargs = {}
+        start_time = self.segment_start(self.start_segment)
+        if start_time and not self.pipe:
+            input_kwargs['ss'] = start_time
+        end_time = self.segment_start(self.end_segment) if self.end_segment is not None else None
+        if end_time is not None and not self.pipe:
+            input_kwargs['t'] = end_time - start_time
+
+        cut_kwargs = {'segment_time': self.segment_duration}
+        if self.boundaries:
+            if start_time:
+                # A copy starts on the keyframe ffmpeg seeks to, and ffmpeg backs seeks up
+                # when the video has B-frames: aim past the boundary so it lands right on it
+                input_kwargs['ss'] = self._seek_point(start_time)
+                input_kwargs['noaccurate_seek'] = None
+            # Cut on the planned keyframes, relative to where the run starts; the piece
+            # read past the end of the run becomes a segment of its own and is dropped
+            end = self.end_segment + 1 if self.end_segment is not None else None
+            cut_kwargs = {'segment_times': ",".join(
+                f"{boundary - start_time:.6f}" for boundary in self.boundaries[self.start_segment + 1:end]
+            ) or str(10 ** 6)}
+
+        source = ffmpeg.input('pipe:0' if self.pipe else self.input_path, **input_kwargs)
+        stream = (
+            ffmpeg
+            .output(
+                *self.plan.output_streams(source, self.level),
+                os.path.join(self.staging_dir, f"{self.base_name}_segment_%03d.mp4"),
+                f='segment',
+                **cut_kwargs,
+                # Tolerate keyframes that land a few ms before the cut point
+                segment_time_delta=0.05,
+                segment_format='mp4',
+                segment_format_options='movflags=frag_keyframe+empty_moov',
+                segment_list=self.segment_list_path,
+                segment_list_type='csv',
+                segment_start_number=self.start_segment,
+                reset_timestamps=1,
+                sn=None,
+                dn=None,
+                **self.plan.codec_kwargs(self.segment_duration, self.level),
+            )
+            .overwrite_output()
+        )
+        with self._cond:
+            if self._stopped:
+                return
+            self.process = stream.run_async(pipe_stdin=self.pipe, pipe_stderr=True)
+            self.started_at = time.time()
+        logging.info(
+            f"Segmenting {self.input_path} from segment {self.start_segment}"
+            f"{f' to {self.end_segment}' if self.end_segment is not None else ''} "
+            f"({self.plan.describe(self.level)}, {'pipe' if self.pipe else 'file'} input)"
+        )
+
+        targets = [self._drain_stderr, self._monitor]
+        if self.pipe:
+            targets.append(self._feed)
+        for target in targets:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def advance(self, available_bytes: int, complete: bool = False):
+        """Let the feeder read the input up to ``available_bytes``; ``complete`` closes the input after that."""
+        with self._cond:
+            self._available = max(self._available, available_bytes)
+            self._input_complete = self._input_complete or complete
+            self._cond.notify_all()
+
+    def is_running(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Wait for ffmpeg to exit and return whether it succeeded."""
+        if self.process is None:
+            return False
+        try:
+            self.process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            return False
+        for thread in self._threads:
+            thread.join()
+        self._publish()
+        if self._stopped:
+            return False
+        if self.process.returncode != 0:
+            self.error = "\n".join(self._stderr_tail)
+            logging.error(f"ffmpeg exited with {self.process.returncode} for {self.input_path}: {self.error}")
+            return False
+        os.remove(self.segment_list_path)
+        try:
+            os.rmdir(self.staging_dir)
+        except OSError:
+            pass
+        return True
+
+    def stop(self):
+        """Kill ffmpeg; segments that were already published stay in place."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self.is_running():
+            self.process.kill()
+        if self.process is not None:
+            self.process.wait()
+            for thread in self._threads:
+                thread.join()
+            self._publish()
+
+    @property
+    def transcodes_video(self) -> bool:
+        return self.plan.video == 'transcode'
+
+    def restart(self, level: int):
+        """
+        Stop ffmpeg so the run goes on from its next segment at another encoder level,
+        see ``resume``. Only file mode runs can pick up in the middle of the input.
+        """
+        if self.pipe or not self.is_running():
+            return
+        self.restarting = True
+        self.level = level
+        self.stop()
+
+    def resume(self) -> 'SegmentingEngine':
+        """A fresh engine for the rest of this run, at the current encoder level."""
+        engine = SegmentingEngine(
+            self.input_path,
+            segment_duration=self.segment_duration,
+            plan=self.plan,
+            start_segment=self.next_segment(),
+            end_segment=self.end_segment,
+            boundaries=self.boundaries,
+            level=self.level,
+        )
+        engine.published = dict(self.published)
+        return engine
+
+    def next_segment(self) -> int:
+        """First segment number at or after ``start_segment`` that has not been published."""
+        segment = self.start_segment
+        while segment in self.published:
+            segment += 1
+        return segment
+
+    def _feed(self):
+        try:
+            with open(self.input_path, 'rb') as source:
+                while True:
+                    with self._cond:
+                        while (self._fed >= self._available and not self._input_complete
+                               and not self._stopped):
+                            self._cond.wait()
+                        if self._stopped or (self._fed >= self._available and self._input_complete):
+                            break
+                        end = self._available
+                    source.seek(self._fed)
+                    data = source.read(min(self.feed_chunk_size, end - self._fed))
+                    if not data:
+                        time.sleep(self.poll_interval)
+                        continue
+                    self.process.stdin.write(data)
+                    self._fed += len(data)
+        except (BrokenPipeError, ValueError, OSError) as e:
+            logging.error(f"Stopped feeding ffmpeg for {self.input_path}: {e}")
+        finally:
+            try:
+                self.process.stdin.close()
+            except (BrokenPipeError, OSError):
+                pass
+
+    def _drain_stderr(self):
+        # ffmpeg blocks once the stderr pipe fills up, so it has to be read continuously.
+        # Its progress line is rewritten in place with carriage returns.
+        pending = b''
+        for chunk in iter(lambda: self.process.stderr.read1(64 * 1024), b''):
+            *lines, pending = re.split(rb'[\r\n]', pending + chunk)
+            for line in lines:
+                self._stderr_line(line.decode(errors='replace').rstrip())
+        self._stderr_line(pending.decode(errors='replace').rstrip())
+
+    def _stderr_line(self, line: str):
+        match = speed_re.search(line)
+        if match:
+            self.speed = float(match.group(1))
+        elif line:
+            self._stderr_tail.append(line)
+
+    def _monitor(self):
+        while self.process.poll() is None:
+            self._publish()
+            time.sleep(self.poll_interval)
+
+    def _publish(self):
+        """Move segments that ffmpeg reported as finished out of the staging directory."""
+        with self._publish_lock:
+            self._publish_finished()
+
+    def _publish_finished(self):
+        try:
+            with open(self.segment_list_path, newline='') as f:
+                rows = list(csv.reader(f))
+        except FileNotFoundError:
+            return
+
+        published = {}
+        offset = self.segment_start(self.start_segment) if not self.pipe else 0
+        for row in rows:
+            if len(row) < 3:
+                continue
+            name = os.path.basename(row[0])
+            match = re.search(r"_segment_(\d+)\.mp4$", name)
+            if not match:
+                continue
+            segment = int(match.group(1))
+            if segment in self.published:
+                continue
+            staged_path = os.path.join(self.staging_dir, name)
+            if not os.path.exists(staged_path):
+                continue
+            if self.end_segment is not None and segment >= self.end_segment:
+                os.remove(staged_path)
+                continue
+            os.replace(staged_path, self.segment_path(segment))
+            start, end = offset + float(row[1]), offset + float(row[2])
+            if self.boundaries:
+                # The list's times carry the B-frame delay, the plan has the keyframes
+                start = self.boundaries[segment]
+                if segment + 1 < len(self.boundaries):
+                    end = self.boundaries[segment + 1]
+            published[segment] = (start, end - start)
+            logging.info(f"✓ {'Copied' if self.plan.copy else 'Converted'} segment {segment}: {self.segment_path(segment)}")
+
+        if published:
+            # Chunks of the same movie run in parallel, the store serialises their updates
+            manifest_store.update(self.manifest_path, lambda manifest: self._record(manifest, published))
+            self.published.update(published)
+
+    def _record(self, manifest, published: dict):
+        manifest.source = os.path.basename(self.input_path)
+        manifest.segment_duration = self.segment_duration
+        for segment, (start, duration) in published.items():
+            path = self.segment_path(segment)
+            manifest.add_segment(segment, start, duration, os.path.getsize(path), os.path.basename(path),
+                                 mp4_init_size(path))
 
 
 class VideoService:
+    # Streams browsers play inside fragmented MP4
+    web_video_codecs = {'h264'}
+    web_pix_fmts = {'yuv420p', 'yuvj420p'}
+    unsupported_h264_profiles = {'High 10', 'High 4:2:2', 'High 4:4:4 Predictive'}
+    web_audio_codecs = {'aac', 'mp3'}
+
+    # Rendition segments being encoded, shared by every instance of the process
+    _rendition_pool = ThreadPoolExecutor(max_workers=settings.RENDITION_WORKERS, thread_name_prefix="renditions")
+    _rendition_lock = threading.Lock()
+    _rendition_jobs = {}  # rendition segment path -> Future
+
     def __init__(self):
         self.segment_duration = 10  # 10 seconds
         self.processed_segments = set()
         self.failed_segments = set()
-        self.segment_retry_count = {}
-        self.segment_last_attempt = {}
+        self.stream_block_size = 512 * 1024  # Read size when the server cannot sendfile
+        self.chunk_segments = 30  # Segments per parallel ffmpeg run once the whole file is on disk
         self.max_retries = 3
-        self.retry_cooldown = 30  # Wait 30 seconds before retrying a failed segment
+        self.retry_cooldown = 30  # Wait 30 seconds before restarting a failed ffmpeg run
+        self.rendition_lookahead = 3  # Segments of a rendition encoded ahead of the one requested
+        self.throughput_headroom = 1.25  # A variant fits a client whose throughput is this much above its bandwidth
+
+    def probe(self, video_path: str, keyframes: bool = False) -> dict:
+        """Return the cached ffprobe record for the file, probing it only if it changed."""
+        return probe_cache.get(video_path, keyframes=keyframes)
 
     def get_video_duration(self, video_path: str) -> Optional[float]:
-        """Get video duration using ffprobe."""
+        """Get video duration from the probe cache."""
         try:
-            probe = ffmpeg.probe(video_path)
-            return float(probe['format']['duration'])
+            return self.probe(video_path)['duration']
         except ffmpeg.Error as e:
             logging.error(f"Error getting video duration: {e.stderr.decode()}")
             return None
@@ -36,152 +549,304 @@ class VideoService:
             logging.error(f"Error getting video duration: {e}")
             return None
 
-    def is_web_compatible_mp4(self, input_path: str) -> bool:
-        """Check if the MP4 file is already web-compatible."""
+    def pipe_readable(self, input_path: str) -> bool:
+        """
+        Whether ffmpeg can demux the file read front to back from a pipe: an MP4 or MOV
+        whose moov atom comes after its media data (not "faststart") cannot.
+        """
+        if not self.probe(input_path)['format_name'].startswith('mov,mp4'):
+            return True
         try:
-            probe = ffmpeg.probe(input_path)
-            format_name = probe['format']['format_name']
-            
-            # Check if it's an MP4 container
-            if 'mp4' not in format_name.lower():
-                return False
+            for box_type, _ in mp4_boxes(input_path):
+                if box_type in (b'moov', b'mdat'):
+                    return box_type == b'moov'
+        except OSError as e:
+            logging.error(f"Error reading MP4 boxes of {input_path}: {e}")
+        return False
 
-            # Check video codec
-            video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
-            if not video_stream or video_stream['codec_name'] not in ['h264', 'avc1']:
-                return False
+    def plan_streams(self, input_path: str) -> StreamPlan:
+        """Decide per stream whether it can be copied into the segments or has to be transcoded."""
+        try:
+            streams = self.probe(input_path)['streams']
+        except Exception as e:
+            logging.error(f"Error probing streams, transcoding everything: {e}")
+            return StreamPlan()
 
-            # Check audio codec
-            audio_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'audio'), None)
-            if not audio_stream or audio_stream['codec_name'] not in ['aac']:
-                return False
+        video_stream = next((stream for stream in streams if stream['codec_type'] == 'video'), None)
+        audio_stream = next((stream for stream in streams if stream['codec_type'] == 'audio'), None)
+        if video_stream is None:
+            return StreamPlan()
+        video = 'copy' if self.is_web_video(video_stream) else 'transcode'
+        # Transcoded video is cut on the grid after an input seek, where copied audio would
+        # start at the packet before the cut and run into the previous segment
+        copy_audio = video == 'copy' and audio_stream is not None and audio_stream['codec_name'] in self.web_audio_codecs
+        return StreamPlan(
+            video=video,
+            audio=None if audio_stream is None else 'copy' if copy_audio else 'transcode',
+            video_index=video_stream['index'],
+            audio_index=audio_stream['index'] if audio_stream else None,
+            height=video_stream.get('height'),
+        )
 
-            return True
+    def is_web_video(self, stream: dict) -> bool:
+        # 10-bit and 4:2:2/4:4:4 H.264 do not decode in browsers
+        return (
+            stream['codec_name'] in self.web_video_codecs
+            and stream.get('pix_fmt') in self.web_pix_fmts
+            and (stream.get('profile') or '') not in self.unsupported_h264_profiles
+        )
+
+    def source_resolution(self, manifest) -> Optional[tuple]:
+        """``(width, height)`` of a movie's segments, read from the first ready one."""
+        ready = manifest.ready_segments()
+        if not ready:
+            return None
+        try:
+            streams = self.probe(os.path.join(manifest.directory, ready[0][1]['path']))['streams']
         except Exception as e:
-            logging.error(f"Error checking MP4 compatibility: {e}")
-            return False
+            logging.error(f"Error probing segments of {manifest.path}: {e}")
+            return None
+        video_stream = next((stream for stream in streams if stream['codec_type'] == 'video'), None)
+        if not video_stream or not video_stream.get('height'):
+            return None
+        return video_stream['width'], video_stream['height']
 
-    def convert_segment(self, input_path: str, output_dir: str, current_segment: int, video_duration: float) -> bool:
-        """Convert a single segment of the video to web-compatible format."""
-        start_time = current_segment * self.segment_duration
-        
-        # Get relative path structure from input_path
-        rel_path = os.path.relpath(input_path, output_dir)
-        dir_path = os.path.dirname(rel_path)
-        file_name = os.path.basename(rel_path)
-        base_name = os.path.splitext(file_name)[0]
-        segment_name = f"{base_name}_segment_{current_segment:03d}.mp4"
-        if dir_path and dir_path != '.':
-            segment_path = os.path.join(output_dir, dir_path, segment_name)
-            # Ensure the subdirectory exists
-            os.makedirs(os.path.dirname(segment_path), exist_ok=True)
-        else:
-            segment_path = os.path.join(output_dir, segment_name)
+    def renditions(self, manifest) -> list:
+        """Rungs of the configured ladder below the source resolution, best first."""
+        resolution = self.source_resolution(manifest)
+        if resolution is None:
+            return []
+        ladder = sorted((Rendition.parse(spec) for spec in settings.VIDEO_RENDITIONS), key=lambda rung: -rung.height)
+        return [rendition for rendition in ladder if rendition.height < resolution[1]]
 
-        # Record attempt time
-        self.segment_last_attempt[current_segment] = time.time()
+    def rendition(self, manifest, name: str) -> Optional[Rendition]:
+        return next((rendition for rendition in self.renditions(manifest) if rendition.name == name), None)
 
-        try:
-            retry_info = (
-                f" (retry {self.segment_retry_count.get(current_segment, 0) + 1}/{self.max_retries})"
-                if self.segment_retry_count.get(current_segment, 0) > 0
-                else ""
-            )
-            logging.info(f"Converting segment {current_segment}{retry_info}...")
-
-            # Check if input is already a web-compatible MP4
-            is_compatible = self.is_web_compatible_mp4(input_path)
-            
-            if is_compatible:
-                # For compatible MP4s, just copy the stream without re-encoding
-                stream = (
-                    ffmpeg
-                    .input(input_path, ss=start_time, t=min(self.segment_duration, video_duration - start_time))
-                    .output(
-                        segment_path,
-                        c='copy',  # Copy streams without re-encoding
-                        movflags='frag_keyframe+empty_moov'  # Optimize for web streaming
-                    )
-                    .overwrite_output()
-                )
-            else:
-                # For other formats, convert to web-compatible format
-                stream = (
-                    ffmpeg
-                    .input(input_path, ss=start_time, t=min(self.segment_duration, video_duration - start_time))
-                    .output(
-                        segment_path,
-                        format='mp4',
-                        preset='ultrafast',
-                        movflags='frag_keyframe+empty_moov'
-                    )
-                    .overwrite_output()
-                )
+    def variants(self, manifest) -> list:
+        """
+        ``(rendition or None for the source, peak bandwidth, average bandwidth, resolution)``
+        for every variant of a movie, best first.
+        """
+        resolution = self.source_resolution(manifest)
+        peak, average = manifest.bandwidth()
+        variants = [(None, peak, average, resolution)]
+        for rendition in self.renditions(manifest):
+            variants.append((rendition, rendition.bandwidth, None, rendition.resolution(resolution)))
+        return variants
 
-            # Run ffmpeg
-            stream.run(capture_stdout=True, capture_stderr=True)
-
-            # Verify the output file exists and is valid
-            if os.path.exists(segment_path) and os.path.getsize(segment_path) > 0:
-                try:
-                    ffmpeg.probe(segment_path)
-                    logging.info(f"✓ {'Copied' if is_compatible else 'Converted'} segment {current_segment}: {segment_path}")
-                    self.processed_segments.add(current_segment)
-                    return True
-                except ffmpeg.Error as e:
-                    logging.error(f"Invalid output file for segment {current_segment}: {e.stderr.decode()}")
-                    if os.path.exists(segment_path):
-                        os.remove(segment_path)
-                    return False
-            else:
-                logging.error(f"Output file not created for segment {current_segment}")
-                return False
+    def rendition_for_throughput(self, manifest, throughput: float) -> Optional[Rendition]:
+        """The best lower rendition a client with ``throughput`` bits/s can keep up with, if the source is too much."""
+        peak, _ = manifest.bandwidth()
+        if not peak or throughput >= peak * self.throughput_headroom:
+            return None
+        renditions = self.renditions(manifest)
+        fitting = [rendition for rendition in renditions if throughput >= rendition.bandwidth * self.throughput_headroom]
+        return fitting[0] if fitting else (renditions[-1] if renditions else None)
 
-        except ffmpeg.Error as e:
-            error_msg = e.stderr.decode() if hasattr(e, 'stderr') else str(e)
-            logging.error(f"FFmpeg error for segment {current_segment}: {error_msg}")
-            self.segment_retry_count[current_segment] = self.segment_retry_count.get(current_segment, 0) + 1
-            logging.error(
-                f"✗ Error {'copying' if is_compatible else 'converting'} segment {current_segment} "
-                f"(attempt {self.segment_retry_count[current_segment]}/{self.max_retries})"
+    def rendition_path(self, manifest, rendition: Rendition, segment: int) -> Optional[str]:
+        """Where a segment of a rendition goes; None while the source segment is not ready."""
+        entry = manifest.segment(segment)
+        if entry is None:
+            return None
+        return os.path.join(manifest.directory, 'renditions', rendition.name, entry['path'])
+
+    def rendition_segment(self, manifest, rendition: Rendition, segment: int) -> Optional[str]:
+        """
+        Path of a segment of a lower rendition, encoded from the source segment the first
+        time it is asked for. The next ``rendition_lookahead`` segments are queued too, so
+        a player that switched to the rendition does not wait on every segment.
+        """
+        path = self.rendition_path(manifest, rendition, segment)
+        if path is None:
+            return None
+        if not os.path.exists(path):
+            self._submit_rendition(manifest, rendition, segment).result()
+        self.prefetch_rendition(manifest, rendition, segment + 1)
+        return path if os.path.exists(path) else None
+
+    def prefetch_rendition(self, manifest, rendition: Rendition, first_segment: int):
+        """Encode the segments of a rendition from ``first_segment`` on in the background."""
+        for segment in range(first_segment, first_segment + self.rendition_lookahead):
+            path = self.rendition_path(manifest, rendition, segment)
+            if path and not os.path.exists(path):
+                self._submit_rendition(manifest, rendition, segment)
+
+    def _submit_rendition(self, manifest, rendition: Rendition, segment: int) -> Future:
+        path = self.rendition_path(manifest, rendition, segment)
+        with self._rendition_lock:
+            future = self._rendition_jobs.get(path)
+            if future is not None:
+                return future
+            future = self._rendition_pool.submit(self._encode_rendition, manifest.segment_path(segment), path, rendition)
+            self._rendition_jobs[path] = future
+        future.add_done_callback(lambda _: self._forget_rendition(path))
+        return future
+
+    def _forget_rendition(self, path: str):
+        with self._rendition_lock:
+            self._rendition_jobs.pop(path, None)
+
+    def _encode_rendition(self, source_path: str, path: str, rendition: Rendition) -> bool:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        source = ffmpeg.input(source_path)
+        try:
+            (
+                ffmpeg
+                .output(*rendition.output_streams(source), tmp_path, f='mp4',
+                        movflags='frag_keyframe+empty_moov', **rendition.codec_kwargs())
+                .overwrite_output()
+                .run(capture_stdout=True, capture_stderr=True)
             )
+            os.replace(tmp_path, path)
+            logging.info(f"✓ Encoded {rendition.name} rendition: {path}")
+            return True
+        except ffmpeg.Error as e:
+            logging.error(f"Error encoding {rendition.name} rendition of {source_path}: {e.stderr.decode()[-2000:]}")
             return False
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def create_engine(self, input_path: str, start_segment: int = 0, end_segment: Optional[int] = None,
+                      pipe: bool = False) -> SegmentingEngine:
+        """Build a segmenting engine for ``input_path``, copying the streams that are already web-compatible."""
+        self.record_source(input_path)
+        plan = self.plan_streams(input_path)
+        return SegmentingEngine(
+            input_path,
+            segment_duration=self.segment_duration,
+            plan=plan,
+            start_segment=start_segment,
+            end_segment=end_segment,
+            pipe=pipe,
+            boundaries=manifest_store.get(manifest_path_for(input_path)).boundaries if plan.video == 'copy' else None,
+        )
+
+    def plan_boundaries(self, input_path: str) -> Optional[list]:
+        """
+        Plan keyframe-aligned segment boundaries of a complete file whose video is copied,
+        once; they are kept in the manifest. Encoded video is cut on the fixed grid.
+        """
+        manifest_path = manifest_path_for(input_path)
+        manifest = manifest_store.get(manifest_path)
+        if manifest.boundaries or self.plan_streams(input_path).video != 'copy':
+            return manifest.boundaries
+        try:
+            record = self.probe(input_path, keyframes=True)
         except Exception as e:
-            logging.error(f"Exception during segment {current_segment} conversion: {e}")
-            self.segment_retry_count[current_segment] = self.segment_retry_count.get(current_segment, 0) + 1
-            return False
+            logging.error(f"Error reading keyframes of {input_path}: {e}")
+            return None
+        if not record.get('duration') or not record.get('keyframes'):
+            return None
+        boundaries = plan_segment_boundaries(
+            [pts for pts, _ in record['keyframes']], record['duration'], self.segment_duration
+        )
 
-    def convert_to_mp4(self, input_path: str) -> str:
-        """Convert video to MP4 format in segments."""
-        output_dir = os.path.dirname(input_path)
-        current_segment = 0
+        def change(manifest):
+            manifest.boundaries = boundaries
+        manifest_store.update(manifest_path, change)
+        return boundaries
 
-        # Get video duration
+    def record_source(self, input_path: str):
+        """Note the source file and its duration in the movie's segment manifest."""
+        path = manifest_path_for(input_path)
+        source = os.path.basename(input_path)
+        duration = self.get_video_duration(input_path)
+        manifest = manifest_store.get(path)
+        if manifest.source == source and manifest.total_duration == duration:
+            return
+
+        def change(manifest):
+            manifest.source = source
+            manifest.segment_duration = self.segment_duration
+            manifest.total_duration = duration
+        manifest_store.update(path, change)
+
+    def submit_segments(self, movie_id: int, input_path: str, start_segment: int = 0,
+                        end_segment: Optional[int] = None, pipe: bool = False,
+                        is_ready: Optional[Callable[[], bool]] = None) -> SegmentJob:
+        """Queue an engine run on the shared transcode pool."""
+        engine = self.create_engine(input_path, start_segment=start_segment, end_segment=end_segment, pipe=pipe)
+        return transcode_pool.submit(SegmentJob(movie_id, engine, is_ready=is_ready))
+
+    def total_segments(self, input_path: str) -> int:
+        boundaries = manifest_store.get(manifest_path_for(input_path)).boundaries
+        if boundaries:
+            return len(boundaries)
         video_duration = self.get_video_duration(input_path)
         if not video_duration:
             raise Exception("Could not determine video duration")
+        return math.ceil(video_duration / self.segment_duration)
+
+    def convert_to_mp4(self, input_path: str, start_segment: int = 0, movie_id: Optional[int] = None,
+                       is_ready: Optional[Callable[[int, int], bool]] = None,
+                       on_progress: Optional[Callable[[], None]] = None) -> str:
+        """
+        Convert video to MP4 segments, splitting the remaining time range into chunks
+        that are transcoded in parallel on the shared pool.
+
+        ``is_ready(first, end)`` tells whether the input data for a chunk is available.
+        ``on_progress()`` is called whenever a chunk finishes.
+        A chunk that fails resumes from its first missing segment; a segment that keeps
+        failing is skipped after ``max_retries`` attempts.
+        """
         if not os.path.exists(input_path):
             raise Exception("Input file not found")
-        while (current_segment * self.segment_duration) < video_duration:
-            # Check cooldown period for retries
-            last_attempt_time = self.segment_last_attempt.get(current_segment, 0)
-            cooldown_passed = (time.time() - last_attempt_time) >= self.retry_cooldown
-
-            if (
-                current_segment not in self.processed_segments
-                and self.segment_retry_count.get(current_segment, 0) < self.max_retries
-                and (self.segment_retry_count.get(current_segment, 0) == 0 or cooldown_passed)
-            ):
-                success = self.convert_segment(input_path, output_dir, current_segment, video_duration)
+        self.record_source(input_path)
+        self.plan_boundaries(input_path)
+        total_segments = self.total_segments(input_path)
 
+        # Chunk only the runs of segments that do not exist yet
+        pending = []
+        manifest_path = manifest_path_for(input_path)
+        manifest = manifest_store.get(manifest_path)
+        for segment in range(start_segment, total_segments):
+            if manifest.segment(segment):
+                continue
+            if pending and pending[-1][1] == segment and segment - pending[-1][0] < self.chunk_segments:
+                pending[-1] = (pending[-1][0], segment + 1)
+            else:
+                pending.append((segment, segment + 1))
+        retries = {}
+        while pending:
+            jobs = [
+                self.submit_segments(
+                    movie_id, input_path, first, end,
+                    is_ready=(lambda first=first, end=end: is_ready(first, end)) if is_ready else None,
+                )
+                for first, end in pending
+            ]
+            pending = []
+            cooldown = False
+            for job in jobs:
+                success = job.wait()
+                self.processed_segments.update(job.engine.published)
+                if on_progress:
+                    on_progress()
                 if success:
-                    current_segment += 1
-                elif self.segment_retry_count.get(current_segment, 0) >= self.max_retries:
-                    self.failed_segments.add(current_segment)
-                    logging.error(f"⚠ Skipping segment {current_segment} after {self.max_retries} failed attempts")
-                    current_segment += 1
+                    continue
 
-            time.sleep(1)  # Small delay to prevent CPU overload
+                first, end = job.engine.next_segment(), job.end_segment
+                if first == job.engine.start_segment:
+                    retries[first] = retries.get(first, 0) + 1
+                    if retries[first] >= self.max_retries:
+                        self.failed_segments.add(first)
+                        manifest_store.update(manifest_path, lambda manifest, segment=first: manifest.mark_failed(segment))
+                        logging.error(f"⚠ Skipping segment {first} after {self.max_retries} failed attempts")
+                        first += 1
+                    else:
+                        logging.error(
+                            f"✗ Error converting segment {first} "
+                            f"(attempt {retries[first]}/{self.max_retries}), retrying in {self.retry_cooldown}s"
+                        )
+                        cooldown = True
+                if first < end:
+                    pending.append((first, end))
+            if pending and cooldown:
+                time.sleep(self.retry_cooldown)
+
+        self.finalize_playlist(input_path)
 
         if self.failed_segments:
             logging.error(f"Failed segments: {sorted(list(self.failed_segments))}")
@@ -191,183 +856,267 @@ class VideoService:
         first_segment = f"{os.path.splitext(input_path)[0]}_segment_000.mp4"
         return first_segment
 
-    def stream_video(self, file_path: str, range_header: str = "", start_time: float = 0) -> Union[StreamingHttpResponse, FileResponse]:
-        """Stream video content with support for range requests and segment switching."""
+    def finalize_playlist(self, input_path: str):
+        """Mark the movie's manifest and playlist as complete once no more segments will be added."""
+
+        def change(manifest):
+            manifest.finished = True
+        manifest_store.update(manifest_path_for(input_path), change)
+
+    def release_source(self, input_path: str) -> bool:
+        """
+        Delete the source file once every segment is published and matches its recorded
+        size, leaving the segments as the movie's only copy on disk.
+        """
+        manifest_path = manifest_path_for(input_path)
+        manifest = manifest_store.get(manifest_path)
+        if not manifest.finished or manifest.failed_segments() or not manifest.available:
+            return False
+        # The segments the runs actually cut: the muxer may cut one fewer than the nominal
+        # grid when the last keyframe comes before its last point
+        if len(manifest.segments) != manifest.available:
+            logging.error(f"Keeping {input_path}: its segments are not contiguous")
+            return False
+        for segment in range(manifest.available):
+            path = manifest.segment_path(segment)
+            if path is None or not os.path.exists(path) or os.path.getsize(path) != manifest.segment(segment)['size']:
+                logging.error(f"Keeping {input_path}: segment {segment} is missing or incomplete")
+                return False
+
+        def change(manifest):
+            manifest.source_released = True
+        manifest_store.update(manifest_path, change)
+        probe_cache.invalidate(input_path)
+        try:
+            os.remove(input_path)
+        except FileNotFoundError:
+            pass
+        logging.info(f"Released source file {input_path}, only its segments are kept")
+        return True
+
+    def stream_video(self, request, file_path: str, asynchronous: bool = False) -> HttpResponse:
+        """
+        Serve a finished segment with range and conditional request support.
+
+        Depending on ``VIDEO_SENDFILE_MODE`` the bytes are either sent with
+        ``os.sendfile`` through the WSGI file wrapper or the transfer is handed to
+        the front server with ``X-Accel-Redirect``/``X-Sendfile``. ``sendfile`` only
+        applies under WSGI: under ASGI, where the view passes ``asynchronous``, that
+        mode reads the file in worker threads, so deployments offload to the front
+        server. Segments never change once published, so they are marked immutable.
+        """
         try:
             if not os.path.exists(file_path):
                 raise FileNotFoundError(f"Video file not found: {file_path}")
 
-            file_size = os.path.getsize(file_path)
             content_type = 'video/mp4'
+            mode = settings.VIDEO_SENDFILE_MODE
 
-            # Handle range request
-            if range_header:
-                try:
-                    ranges = range_header.replace('bytes=', '').split('-')
-                    first_byte = int(ranges[0])
-                    last_byte = int(ranges[1]) if ranges[1] else file_size - 1
-                except (IndexError, ValueError):
-                    first_byte = 0
-                    last_byte = file_size - 1
+            if mode in ('x-accel-redirect', 'x-sendfile'):
+                # The front server reads the file and answers Range and conditional headers itself
+                response = HttpResponse(content_type=content_type)
+                if mode == 'x-accel-redirect':
+                    rel_path = os.path.relpath(file_path, settings.DOWNLOAD_PATH)
+                    response['X-Accel-Redirect'] = settings.VIDEO_SENDFILE_PREFIX + quote(rel_path)
+                else:
+                    response['X-Sendfile'] = file_path
+                response['Accept-Ranges'] = 'bytes'
+                response['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
             else:
-                first_byte = 0
-                last_byte = file_size - 1
-
-            # Ensure valid range
-            if first_byte >= file_size or first_byte < 0:
-                first_byte = 0
-            if last_byte >= file_size:
-                last_byte = file_size - 1
-
-            length = last_byte - first_byte + 1
-
-            # Create response
-            response = StreamingHttpResponse(
-                self._stream_video_content(file_path, first_byte, last_byte),
-                status=206 if range_header else 200,
-                content_type=content_type
-            )
+                response = serve_file(request, file_path, content_type, block_size=self.stream_block_size,
+                                      asynchronous=asynchronous)
 
-            # Set headers
-            response['Accept-Ranges'] = 'bytes'
-            response['Content-Length'] = str(length)
-            if range_header:
-                response['Content-Range'] = f'bytes {first_byte}-{last_byte}/{file_size}'
-            
-            # CORS headers
-            response['Access-Control-Allow-Origin'] = '*'
-            response['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
-            response['Access-Control-Allow-Headers'] = 'Range'
-            
-            # Cache control
-            response['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-            response['Pragma'] = 'no-cache'
-            response['Expires'] = '0'
-
-            return response
+            return self._allow_cors(response)
 
         except Exception as e:
             logging.error(f"Error in stream_video: {str(e)}")
             raise
 
-    def _stream_video_content(self, file_path: str, start: int, end: int):
-        """Generator to stream video content in chunks."""
-        chunk_size = 8192
-        try:
-            with open(file_path, 'rb') as f:
-                f.seek(start)
-                remaining = end - start + 1
-                while remaining > 0:
-                    chunk = min(chunk_size, remaining)
-                    data = f.read(chunk)
-                    if not data:
-                        break
-                    yield data
-                    remaining -= len(data)
-        except Exception as e:
-            logging.error(f"Error in _stream_video_content: {str(e)}")
-            raise
-        
+    def stream_init_section(self, file_path: str) -> Optional[HttpResponse]:
+        """Serve the initialisation section a playlist's ``EXT-X-MAP`` names; None if the segment has none."""
+        init_section = read_init_section(file_path)
+        if init_section is None:
+            return None
+        response = HttpResponse(init_section, content_type='video/mp4')
+        response['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        return self._allow_cors(response)
+
+    def _allow_cors(self, response: HttpResponse) -> HttpResponse:
+        response['Access-Control-Allow-Origin'] = '*'
+        response['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
+        response['Access-Control-Allow-Headers'] = 'Range, If-Range, If-None-Match, If-Modified-Since'
+        response['Access-Control-Expose-Headers'] = 'Content-Range, Content-Length, ETag, Last-Modified'
+        return response
+
 
 # ++++++++++++++++++++++++++++++++++++++++++
 
 
 class SubtitleService:
-    BASE_URL = "https://api.opensubtitles.com/api/v1"
+    """
+    Subtitles from the OpenSubtitles API, cached under
+    ``MEDIA_ROOT/downloads/subtitles/<movie id>`` next to an ``index.json``.
 
-    def __init__(self):
+    The index records, per language, the IMDb id the file was fetched for, or that
+    the API had none (kept for ``missing_ttl``) or failed (kept for ``error_ttl``), so
+    a cached answer, good or bad, costs no request. All instances share one pooled
+    HTTP session and one small pool for background prefetches.
+    """
+
+    timeout = 15
+    missing_ttl = 24 * 3600
+    error_ttl = 300
+    language_re = re.compile(r"[a-z]{2,3}(-[a-z]{2,4})?", re.I)
+
+    _http = requests.Session()
+    _http.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    _http.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    _prefetch_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="subtitles")
+    _index_lock = threading.Lock()
+    # (movie id, language) -> [lock, fetches using it], dropped by the last one
+    _fetch_locks = {}
+
+    def __init__(self, base_url: Optional[str] = None):
+        self.base_url = (base_url or settings.OPENSUBTITLES_API_URL).rstrip('/')
         self.headers = {
             "Api-Key": os.getenv("OPENSUBTITLE_API_KEY", ""),
             "Content-Type": "application/json",
             "User-Agent": "torrent",
         }
 
-    def convert_srt_to_vtt(self, srt_path: str) -> str:
+    def subtitles_dir(self, movie_id: int) -> str:
+        return os.path.join(settings.MEDIA_ROOT, 'downloads', 'subtitles', str(movie_id))
+
+    def fetch_subtitles(self, movie: MovieFile, lang: str) -> list:
         """
-        Convert an SRT file to VTT format and return the path to the VTT file.
+        Subtitles of a movie in one language, from the cache or else from OpenSubtitles.
+        Returns a list with one subtitle description, or an empty list.
         """
-        vtt_path = srt_path.replace('.srt', '.vtt')
+        if not movie.imdb_id or not self.language_re.fullmatch(lang):
+            return []
+
+        key = (movie.id, lang)
+        with self._index_lock:
+            fetch_lock = self._fetch_locks.setdefault(key, [threading.Lock(), 0])
+            fetch_lock[1] += 1
         try:
-            srt_to_vtt(srt_path, vtt_path)
-            return vtt_path
-        except Exception as e:
-            logging.error(f"Error converting SRT to VTT: {str(e)}")
+            # Concurrent requests for the same subtitle wait for one download
+            with fetch_lock[0]:
+                entry = self._cached(movie, lang)
+                if entry is None:
+                    entry = self._download(movie, lang)
+                    self._update_index(movie.id, lang, entry)
+        finally:
+            with self._index_lock:
+                fetch_lock[1] -= 1
+                if not fetch_lock[1]:
+                    del self._fetch_locks[key]
+        return [self._describe(movie, lang, entry)] if entry['state'] == 'ok' else []
+
+    def prefetch(self, movie: MovieFile, languages: Optional[list] = None):
+        """Fetch the configured languages of a movie in the background, concurrently."""
+        return [
+            self._prefetch_pool.submit(self.fetch_subtitles, movie, lang)
+            for lang in (languages or settings.SUBTITLE_LANGUAGES)
+        ]
+
+    def _cached(self, movie: MovieFile, lang: str) -> Optional[dict]:
+        entry = self._read_index(movie.id).get(lang)
+        if entry is None or entry.get('imdb_id') != movie.imdb_id:
+            # Files fetched before the index existed are still good
+            vtt_path = os.path.join(self.subtitles_dir(movie.id), f"{lang}.vtt")
+            if os.path.exists(vtt_path):
+                return {'imdb_id': movie.imdb_id, 'state': 'ok', 'language': lang, 'file': f"{lang}.vtt"}
             return None
+        if entry['state'] == 'ok':
+            return entry if os.path.exists(os.path.join(self.subtitles_dir(movie.id), entry['file'])) else None
+        ttl = self.missing_ttl if entry['state'] == 'missing' else self.error_ttl
+        return entry if time.time() - entry['fetched_at'] < ttl else None
 
-    def fetch_subtitles(self, movie: MovieFile, lang: str) -> list:
-        """
-        Fetch and download subtitles for a movie in the specified language from OpenSubtitles API.
-        Returns a list of downloaded subtitle information.
-        """
+    def _download(self, movie: MovieFile, lang: str) -> dict:
+        entry = {'imdb_id': movie.imdb_id, 'fetched_at': time.time()}
         try:
-            response = requests.get(
-                f"{self.BASE_URL}/subtitles",
+            response = self._http.get(
+                f"{self.base_url}/subtitles",
                 headers=self.headers,
                 params={
                     "imdb_id": movie.imdb_id,
                     "languages": lang,
                     "order_by": "ratings"
-                }
+                },
+                timeout=self.timeout,
             )
             response.raise_for_status()
             data = response.json()
-
-            subtitles = []
-            for item in data.get('data', []):
-                attributes = item.get('attributes', {})
-                files = attributes.get('files', [])
-                if files:
-                    file_id = files[0].get('file_id')
-                    if file_id:
-                        try:
-                            download_response = requests.post(
-                                f"{self.BASE_URL}/download",
-                                headers=self.headers,
-                                json={"file_id": file_id}
-                            )
-                            download_response.raise_for_status()
-                            download_data = download_response.json()
-                            download_url = download_data.get('link')
-
-                            if download_url:
-                                subtitles_dir = os.path.join(settings.MEDIA_ROOT, 'downloads/subtitles', str(movie.id))
-                                os.makedirs(subtitles_dir, exist_ok=True)
-
-                                srt_path = os.path.join(subtitles_dir, f"{lang}.srt")
-                                file_response = requests.get(download_url)
-                                file_response.raise_for_status()
-
-                                with open(srt_path, 'wb') as f:
-                                    f.write(file_response.content)
-
-                                # Convert SRT to VTT
-                                vtt_path = self.convert_srt_to_vtt(srt_path)
-                                if vtt_path:
-                                    vtt_relative_path = os.path.join('downloads/subtitles', str(movie.id), f"{lang}.vtt")
-                                else:
-                                    vtt_relative_path = None
-
-                                subtitles.append({
-                                    'language': attributes.get('language', lang),
-                                    'language_name': 'English' if lang == 'en' else lang.upper(),
-                                    'file_path': vtt_relative_path or os.path.join('subtitles', str(movie.id), f"{lang}.srt")
-                                })
-                                logging.info(f"Successfully downloaded subtitle to {srt_path} and converted to VTT")
-                                break
-
-                        except requests.exceptions.RequestException as e:
-                            logging.error(f"Error downloading subtitle with file_id {file_id}: {str(e)}")
-                            continue
-                        except Exception as e:
-                            logging.error(f"Unexpected error downloading subtitle with file_id {file_id}: {str(e)}")
-                            continue
-
-            return subtitles
-
-        except requests.exceptions.RequestException as e:
+        except (requests.exceptions.RequestException, ValueError) as e:
             logging.error(f"Error fetching subtitles: {str(e)}")
-            return []
-        except Exception as e:
-            logging.error(f"Unexpected error while fetching subtitles: {str(e)}")
-            return [] 
+            return {**entry, 'state': 'error'}
+
+        failed = False
+        for item in data.get('data', []):
+            attributes = item.get('attributes', {})
+            files = attributes.get('files', [])
+            file_id = files[0].get('file_id') if files else None
+            if not file_id:
+                continue
+            try:
+                filename = self._download_file(movie, lang, file_id)
+            except (requests.exceptions.RequestException, OSError, ValueError) as e:
+                logging.error(f"Error downloading subtitle with file_id {file_id}: {str(e)}")
+                failed = True
+                continue
+            if filename:
+                return {**entry, 'state': 'ok', 'language': attributes.get('language', lang), 'file': filename}
+
+        return {**entry, 'state': 'error' if failed else 'missing'}
+
+    def _download_file(self, movie: MovieFile, lang: str, file_id) -> Optional[str]:
+        download_response = self._http.post(
+            f"{self.base_url}/download",
+            headers=self.headers,
+            json={"file_id": file_id},
+            timeout=self.timeout,
+        )
+        download_response.raise_for_status()
+        download_url = download_response.json().get('link')
+        if not download_url:
+            return None
+
+        subtitles_dir = self.subtitles_dir(movie.id)
+        os.makedirs(subtitles_dir, exist_ok=True)
+        vtt_path = os.path.join(subtitles_dir, f"{lang}.vtt")
+        # Converted to VTT as it arrives
+        with self._http.get(download_url, timeout=self.timeout, stream=True) as file_response:
+            file_response.raise_for_status()
+            write_vtt(file_response.iter_content(chunk_size=64 * 1024), vtt_path)
+        vtt_cache.invalidate(vtt_path)
+        logging.info(f"Successfully downloaded subtitle to {vtt_path}")
+        return os.path.basename(vtt_path)
+
+    def _describe(self, movie: MovieFile, lang: str, entry: dict) -> dict:
+        return {
+            'language': entry.get('language', lang),
+            'language_name': 'English' if lang == 'en' else lang.upper(),
+            'file_path': os.path.join('downloads/subtitles', str(movie.id), entry['file']),
+        }
+
+    def _read_index(self, movie_id: int) -> dict:
+        try:
+            with open(os.path.join(self.subtitles_dir(movie_id), 'index.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
 
+    def _update_index(self, movie_id: int, lang: str, entry: dict):
+        subtitles_dir = self.subtitles_dir(movie_id)
+        with self._index_lock:
+            index = self._read_index(movie_id)
+            index[lang] = entry
+            try:
+                os.makedirs(subtitles_dir, exist_ok=True)
+                tmp_path = os.path.join(subtitles_dir, f"index.json.{os.getpid()}.tmp")
+                with open(tmp_path, 'w') as f:
+                    json.dump(index, f)
+                os.replace(tmp_path, os.path.join(subtitles_dir, 'index.json'))
+            except OSError as e:
+                logging.error(f"Error writing subtitle index of movie {movie_id}: {e}")
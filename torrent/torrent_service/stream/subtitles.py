@@ -0,0 +1,262 @@
+import codecs
+import gzip
+import hashlib
+import itertools
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Iterable, Iterator
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.http import http_date
+
+from .ranges import check_preconditions
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+timestamp_re = re.compile(r"(\d+):(\d{2}):(\d{2})[,.](\d{1,3})")
+cue_timing_re = re.compile(rf"^\s*({timestamp_re.pattern})\s*-->\s*({timestamp_re.pattern})(.*)$")
+
+BOMS = [
+    (codecs.BOM_UTF8, 'utf-8'),
+    (codecs.BOM_UTF16_LE, 'utf-16-le'),
+    (codecs.BOM_UTF16_BE, 'utf-16-be'),
+]
+
+# Bytes looked at to decide between UTF-8 and the legacy encoding
+SNIFF_BYTES = 64 * 1024
+
+
+def detect_encoding(head: bytes) -> tuple:
+    """``(encoding, BOM length)`` of a subtitle file, from its first bytes."""
+    for bom, encoding in BOMS:
+        if head.startswith(bom):
+            return encoding, len(bom)
+    try:
+        # A multi-byte character may be cut at the end of the sample
+        codecs.getincrementaldecoder('utf-8')().decode(head, final=False)
+        return 'utf-8', 0
+    except UnicodeDecodeError:
+        # Most subtitles that are not UTF-8 are Windows-1252 (or a superset of its letters)
+        return 'cp1252', 0
+
+
+def format_timestamp(seconds: float) -> str:
+    millis = max(0, round(seconds * 1000))
+    hours, millis = divmod(millis, 3600_000)
+    minutes, millis = divmod(millis, 60_000)
+    secs, millis = divmod(millis, 1000)
+    return f"{hours:02d}:{minutes:02d}:{secs:02d}.{millis:03d}"
+
+
+def parse_timestamp(text: str) -> float:
+    hours, minutes, secs, fraction = timestamp_re.match(text).groups()
+    return int(hours) * 3600 + int(minutes) * 60 + int(secs) + int(fraction.ljust(3, '0')) / 1000
+
+
+def _decoded_lines(chunks: Iterable[bytes]) -> Iterator[str]:
+    chunks = iter(chunks)
+    head = b''
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= SNIFF_BYTES:
+            break
+    encoding, bom_length = detect_encoding(head)
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+
+    pending = ''
+    for chunk in itertools.chain([head[bom_length:]], chunks):
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split('\n')
+        for line in lines:
+            yield line.rstrip('\r')
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending.rstrip('\r')
+
+
+def shift_cues(lines: Iterable[str], offset: float = 0) -> Iterator[str]:
+    """
+    Yield VTT lines with cue timings moved by ``offset`` seconds; cues that end up
+    entirely before zero are dropped.
+    """
+    skipping = False
+    block_start = True
+    # The first line of a block may be the identifier of the cue whose timing follows
+    identifier = None
+    for line in lines:
+        match = cue_timing_re.match(line)
+        if match:
+            start = parse_timestamp(match.group(1)) + offset
+            end = parse_timestamp(match.group(6)) + offset
+            skipping = end <= 0
+            if not skipping:
+                if identifier is not None:
+                    yield identifier
+                yield f"{format_timestamp(start)} --> {format_timestamp(end)}{match.group(11)}"
+            identifier = None
+            block_start = False
+            continue
+        if identifier is not None:
+            yield identifier
+            identifier = None
+        if skipping:
+            # The cue runs until the next blank line
+            skipping = bool(line.strip())
+            block_start = not skipping
+            continue
+        if block_start and line.strip():
+            identifier = line
+            block_start = False
+            continue
+        block_start = not line.strip()
+        yield line
+    if identifier is not None:
+        yield identifier
+
+
+def srt_to_vtt(chunks: Iterable[bytes], offset: float = 0) -> Iterator[str]:
+    """
+    Convert SRT bytes to WebVTT text incrementally, chunk by chunk as they are
+    downloaded, so the file is never held in memory whole.
+    """
+    yield "WEBVTT\n\n"
+    lines = _decoded_lines(chunks)
+    for line in shift_cues(lines, offset):
+        if line.strip() == 'WEBVTT':
+            continue
+        yield line + "\n"
+
+
+def write_vtt(chunks: Iterable[bytes], vtt_path: str, offset: float = 0):
+    """Convert SRT chunks into ``vtt_path``, replacing it atomically."""
+    tmp_path = f"{vtt_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for text in srt_to_vtt(chunks, offset):
+                f.write(text)
+        os.replace(tmp_path, vtt_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class VttVariant:
+    """One subtitle body as served: its bytes, ETag and compressed copies."""
+
+    def __init__(self, body: bytes, last_modified: int):
+        self.body = body
+        self.last_modified = last_modified
+        self.etag = f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"'
+        self.encoded = {'gzip': gzip.compress(body, mtime=0)}
+        if brotli is not None:
+            self.encoded['br'] = brotli.compress(body, mode=brotli.MODE_TEXT)
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(len(data) for data in self.encoded.values())
+
+
+class VttCache:
+    """
+    Served subtitle files, kept in memory up to ``max_bytes`` and dropped least
+    recently used first.
+
+    Each entry holds the VTT and its gzip (and, when the brotli module is installed,
+    brotli) copy, so a subtitle file is read and compressed once, however many
+    viewers load it. A cached entry is reused while the file's mtime and size are
+    unchanged. Time-shifted variants are derived from the cached text and cached
+    next to it.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # (path, offset) -> ((mtime_ns, size), VttVariant)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, path: str, offset: float = 0) -> VttVariant:
+        """The subtitle at ``path`` shifted by ``offset`` seconds; raises OSError if missing."""
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        key = (path, offset)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached and cached[0] == signature:
+                self._entries.move_to_end(key)
+                return cached[1]
+
+        if offset:
+            text = self.get(path).body.decode('utf-8', errors='replace')
+            body = "\n".join(shift_cues(text.split('\n'), offset)).encode('utf-8')
+        else:
+            with open(path, 'rb') as f:
+                body = f.read()
+        variant = VttVariant(body, int(stat.st_mtime))
+        self._store(key, signature, variant)
+        return variant
+
+    def _store(self, key, signature, variant: VttVariant):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous:
+                self._bytes -= previous[1].size
+            if variant.size > self.max_bytes:
+                return
+            self._entries[key] = (signature, variant)
+            self._bytes += variant.size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
+
+    def invalidate(self, path: str):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == path]:
+                self._bytes -= self._entries.pop(key)[1].size
+
+
+def accepted_encodings(header: str) -> set:
+    encodings = set()
+    for part in header.split(','):
+        name, _, params = part.strip().partition(';')
+        quality = params.strip().removeprefix('q=')
+        try:
+            if params and float(quality) == 0:
+                continue
+        except ValueError:
+            continue
+        encodings.add(name.strip().lower())
+    return encodings
+
+
+def vtt_response(request, variant: VttVariant, cache_control: str) -> HttpResponse:
+    """Answer with a cached subtitle, compressed if the client accepts it, or 304."""
+    accepted = accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    encoding = next((name for name in ('br', 'gzip') if name in accepted and name in variant.encoded), None)
+    etag = f'{variant.etag[:-1]}-{encoding}"' if encoding else variant.etag
+
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(variant.last_modified),
+        'Cache-Control': cache_control,
+        'Vary': 'Accept-Encoding',
+    }
+    if check_preconditions(request.META, etag, variant.last_modified) == 304:
+        response = HttpResponse(status=304)
+        del response['Content-Type']
+    else:
+        response = HttpResponse(variant.encoded[encoding] if encoding else variant.body,
+                                content_type='text/vtt; charset=utf-8')
+        if encoding:
+            response['Content-Encoding'] = encoding
+    for header, value in headers.items():
+        response[header] = value
+    return response
+
+
+vtt_cache = VttCache(settings.SUBTITLE_CACHE_BYTES)
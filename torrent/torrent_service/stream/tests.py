@@ -1,3 +1,1166 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+import libtorrent as lt
+import requests
+from django.core.management import CommandError, call_command
+from django.http import FileResponse, Http404, StreamingHttpResponse
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, override_settings
+from django.utils import timezone
+from django.utils.http import http_date
+
+from .async_views import subtitle_file, video_stream
+from .cache import MovieCache
+from .daemon import DaemonError, TorrentDaemonClient, TorrentDaemonHandler
+from .events import EventBus
+from .manifest import SegmentManifest, manifest_store, mp4_init_size, render_master_playlist, render_playlist
+from .models import MovieFile
+from .probe import ProbeCache
+from .progress import ProgressFlusher
+from .readiness import SegmentReadiness
+from .ranges import file_validators, serve_file
+from .scheduler import DownloadQueue, QueueFull, SegmentJob, SpeedGovernor, TranscodePool
+from .services import Rendition, SegmentingEngine, SubtitleService, VideoService, plan_segment_boundaries
+from .subtitles import VttCache, srt_to_vtt, vtt_response
+from .trackers import FALLBACK_TRACKERS, TrackerRegistry, normalize_tracker
+from .views import MoviePipeline, TorrentSessionManager
+
+SRT = b"1\n00:00:01,000 --> 00:00:02,500\nHello\n\n2\n00:00:03,000 --> 00:00:04,000\nWorld\n"
+
+
+class FakeOpenSubtitles(BaseHTTPRequestHandler):
+    """Stand-in for the OpenSubtitles API: subtitles exist in English and French only."""
+
+    languages = {"en": 101, "fr": 102}
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type="application/json"):
+        self.server.requests.append((self.command, self.path))
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/subtitles":
+            lang = parse_qs(url.query)["languages"][0]
+            file_id = self.languages.get(lang)
+            data = [{"attributes": {"language": lang, "files": [{"file_id": file_id}]}}] if file_id else []
+            self._send(200, json.dumps({"data": data}).encode())
+        elif url.path.startswith("/files/"):
+            self._send(200, SRT, "text/plain")
+        else:
+            self._send(404, b"{}")
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        link = f"http://127.0.0.1:{self.server.server_port}/files/{body['file_id']}.srt"
+        self._send(200, json.dumps({"link": link}).encode())
+
+
+class SubtitleServiceTests(SimpleTestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOpenSubtitles)
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root, SUBTITLE_LANGUAGES=["en", "fr"])
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.service = SubtitleService(base_url=f"http://127.0.0.1:{self.server.server_port}")
+        self.movie = MovieFile(id=7, imdb_id="tt0133093", magnet_link="magnet:?xt=urn:btih:0")
+
+    def test_fetch_downloads_and_converts(self):
+        subtitles = self.service.fetch_subtitles(self.movie, "en")
+
+        self.assertEqual(subtitles, [{
+            "language": "en",
+            "language_name": "English",
+            "file_path": "downloads/subtitles/7/en.vtt",
+        }])
+        with open(os.path.join(self.service.subtitles_dir(7), "en.vtt")) as f:
+            self.assertTrue(f.read().startswith("WEBVTT"))
+
+    def test_second_fetch_is_served_from_the_index(self):
+        first = self.service.fetch_subtitles(self.movie, "en")
+        requests_made = len(self.server.requests)
+
+        self.assertEqual(self.service.fetch_subtitles(self.movie, "en"), first)
+        self.assertEqual(len(self.server.requests), requests_made)
+
+    def test_missing_language_is_cached(self):
+        self.assertEqual(self.service.fetch_subtitles(self.movie, "de"), [])
+        self.assertEqual(self.service.fetch_subtitles(self.movie, "de"), [])
+        self.assertEqual(self.server.requests, [("GET", "/subtitles?imdb_id=tt0133093&languages=de&order_by=ratings")])
+
+    def test_other_imdb_id_is_not_a_hit(self):
+        self.service.fetch_subtitles(self.movie, "de")
+        other = MovieFile(id=7, imdb_id="tt0234215", magnet_link="magnet:?xt=urn:btih:0")
+
+        self.service.fetch_subtitles(other, "de")
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_unreachable_api_is_cached_briefly(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+        self.assertEqual(self.service.fetch_subtitles(self.movie, "en"), [])
+        entry = self.service._read_index(7)["en"]
+        self.assertEqual(entry["state"], "error")
+
+    def test_invalid_language_is_rejected(self):
+        self.assertEqual(self.service.fetch_subtitles(self.movie, "../../etc"), [])
+        self.assertEqual(self.server.requests, [])
+
+    def test_prefetch_fetches_configured_languages(self):
+        for future in self.service.prefetch(self.movie):
+            future.result(timeout=10)
+
+        index = self.service._read_index(7)
+        self.assertEqual({lang: entry["state"] for lang, entry in index.items()}, {"en": "ok", "fr": "ok"})
+        self.assertEqual(SubtitleService._fetch_locks, {})
+
+
+class SrtToVttTests(SimpleTestCase):
+    def convert(self, data, chunk_size=7, offset=0):
+        chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+        return "".join(srt_to_vtt(chunks, offset))
+
+    def test_converts_timings_and_keeps_cues(self):
+        self.assertEqual(
+            self.convert(SRT),
+            "WEBVTT\n\n1\n00:00:01.000 --> 00:00:02.500\nHello\n\n2\n00:00:03.000 --> 00:00:04.000\nWorld\n",
+        )
+
+    def test_handles_bom_crlf_and_legacy_encoding(self):
+        utf8 = self.convert(b"\xef\xbb\xbf1\r\n00:00:01,000 --> 00:00:02,000\r\nCaf\xc3\xa9\r\n")
+        cp1252 = self.convert(b"1\n00:00:01,000 --> 00:00:02,000\nCaf\xe9\n")
+        utf16 = self.convert("1\n00:00:01,000 --> 00:00:02,000\nCafé\n".encode("utf-16"))
+
+        for vtt in (utf8, cp1252, utf16):
+            self.assertEqual(vtt, "WEBVTT\n\n1\n00:00:01.000 --> 00:00:02.000\nCafé\n")
+
+    def test_offset_drops_cues_before_zero(self):
+        self.assertEqual(self.convert(SRT, offset=-2.75), "WEBVTT\n\n2\n00:00:00.250 --> 00:00:01.250\nWorld\n")
+
+
+class VttCacheTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.path = os.path.join(directory, "en.vtt")
+        with open(self.path, "w") as f:
+            f.write("".join(srt_to_vtt([SRT])))
+        self.cache = VttCache(max_bytes=64 * 1024)
+
+    def test_reuses_entry_until_the_file_changes(self):
+        first = self.cache.get(self.path)
+        self.assertIs(self.cache.get(self.path), first)
+
+        with open(self.path, "a") as f:
+            f.write("\n")
+        self.assertIsNot(self.cache.get(self.path), first)
+
+    def test_serves_gzip_with_its_own_etag_and_revalidates(self):
+        variant = self.cache.get(self.path)
+        request = RequestFactory().get("/", HTTP_ACCEPT_ENCODING="gzip, deflate")
+        response = vtt_response(request, variant, "public, max-age=3600")
+
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(response.content), variant.body)
+        self.assertNotEqual(response["ETag"], variant.etag)
+
+        request = RequestFactory().get("/", HTTP_ACCEPT_ENCODING="gzip", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(vtt_response(request, variant, "public, max-age=3600").status_code, 304)
+
+    def test_evicts_least_recently_used(self):
+        cache = VttCache(max_bytes=self.cache.get(self.path).size * 2)
+        cache.get(self.path)
+        cache.get(self.path, -1.0)
+        cache.get(self.path)
+        cache.get(self.path, -2.0)
+
+        self.assertEqual([key[1] for key in cache._entries], [0, -2.0])
+
+
+class SubtitleFileTests(SimpleTestCase):
+    def test_rejects_offsets_that_are_not_finite(self):
+        for offset in ("nan", "inf", "-inf"):
+            request = RequestFactory().get("/", {"offset": offset})
+            with self.assertRaises(Http404):
+                asyncio.run(subtitle_file(request, "1", "en"))
+
+
+class ServeFileTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "movie_segment_000.mp4")
+        self.data = bytes(range(100))
+        with open(self.path, "wb") as f:
+            f.write(self.data)
+        self.etag, self.last_modified, _ = file_validators(self.path)
+
+    def serve(self, **headers):
+        response = serve_file(RequestFactory().get("/", **headers), self.path, "video/mp4")
+        self.addCleanup(response.close)
+        return response
+
+    def body(self, response):
+        return b"".join(response.streaming_content)
+
+    def test_suffix_range_sends_the_last_bytes(self):
+        response = self.serve(HTTP_RANGE="bytes=-10")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], "bytes 90-99/100")
+        self.assertEqual(self.body(response), self.data[90:])
+
+    def test_unsatisfiable_range_is_416(self):
+        response = self.serve(HTTP_RANGE="bytes=200-300")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], "bytes */100")
+
+    def test_if_range_with_the_current_etag_keeps_the_range(self):
+        self.assertEqual(self.serve(HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE=self.etag).status_code, 206)
+
+        response = self.serve(HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.data)
+
+    def test_if_range_with_the_last_modified_date_keeps_the_range(self):
+        response = self.serve(HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE=http_date(self.last_modified))
+        self.assertEqual(response.status_code, 206)
+
+        response = self.serve(HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE=http_date(self.last_modified - 60))
+        self.assertEqual(response.status_code, 200)
+
+    def test_if_none_match_is_304_with_the_validators(self):
+        response = self.serve(HTTP_IF_NONE_MATCH=f"W/{self.etag}")
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], self.etag)
+        self.assertEqual(response.content, b"")
+
+    def test_several_ranges_are_sent_as_multipart(self):
+        response = self.serve(HTTP_RANGE="bytes=0-1,50-51,1-2")
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response["Content-Type"].startswith("multipart/byteranges; boundary="))
+        body = self.body(response)
+        self.assertEqual(len(body), int(response["Content-Length"]))
+        # Overlapping ranges are merged
+        self.assertIn(b"Content-Range: bytes 0-2/100\r\n\r\n" + self.data[0:3], body)
+        self.assertIn(b"Content-Range: bytes 50-51/100\r\n\r\n" + self.data[50:52], body)
+
+
+@override_settings(VIDEO_SENDFILE_MODE="sendfile")
+class VideoStreamTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "movie_segment_000.mp4")
+        with open(path, "wb") as f:
+            f.write(b"segment")
+
+        async def playable_movie(pk):
+            return MovieFile(id=pk, download_status="READY"), None
+
+        for target, value in (
+            ("stream.async_views._playable_movie", playable_movie),
+            ("stream.async_views.segment_file_path", lambda movie_file, segment: path),
+            ("stream.async_views.update_playhead", lambda movie_id, segment: None),
+            ("stream.async_views.progress_flusher", mock.Mock()),
+        ):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def stream(self, factory):
+        response = asyncio.run(video_stream(factory.get("/", {"segment": 0}), 1))
+        self.addCleanup(response.close)
+        return response
+
+    def test_wsgi_requests_get_a_file_for_sendfile(self):
+        response = self.stream(RequestFactory())
+        self.assertIsInstance(response, FileResponse)
+        self.assertFalse(response.is_async)
+
+    def test_asgi_requests_get_an_async_body(self):
+        response = self.stream(AsyncRequestFactory())
+        self.assertIsInstance(response, StreamingHttpResponse)
+        self.assertTrue(response.is_async)
+
+
+class MovieCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.cache = MovieCache(self.tmp_dir, self.tmp_dir, max_bytes=1000, high_watermark=0.9,
+                                low_watermark=0.5, max_age_days=30)
+        for name, size in (("usage", {1: 600, 2: 300, 3: 100}), ("candidates", None)):
+            patcher = mock.patch.object(MovieCache, name, return_value=size)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        now = timezone.now()
+        MovieCache.candidates.return_value = [(1, now - timedelta(days=2)), (2, now - timedelta(days=1)),
+                                              (3, now - timedelta(hours=2))]
+
+    def test_over_budget_evicts_least_recently_watched_down_to_the_low_watermark(self):
+        self.assertEqual(self.cache.plan(), [1])
+
+    def test_titles_in_use_are_kept(self):
+        self.assertEqual(self.cache.plan(in_use=lambda movie_id: movie_id == 1), [2, 3])
+
+
+    def test_command_asks_the_torrent_daemon_what_is_in_use(self):
+        daemon = mock.Mock(**{"movie_in_use.side_effect": lambda movie_id: movie_id == 1})
+        with mock.patch("stream.management.commands.evict_cache.torrent_daemon", daemon), \
+                mock.patch("stream.management.commands.evict_cache.movie_cache", self.cache), \
+                mock.patch.object(MovieCache, "remove") as remove:
+            call_command("evict_cache", stdout=mock.Mock())
+        self.assertEqual([call.args for call in remove.call_args_list], [(2,), (3,)])
+        daemon.remove_movie.assert_has_calls([mock.call(2), mock.call(3)])
+
+    def test_command_refuses_to_evict_without_a_torrent_daemon(self):
+        with mock.patch("stream.management.commands.evict_cache.torrent_daemon", None):
+            with self.assertRaises(CommandError):
+                call_command("evict_cache", stdout=mock.Mock())
+
+class ProbeCacheTests(SimpleTestCase):
+    probe = {
+        "format": {"format_name": "matroska,webm", "duration": "60.5", "bit_rate": "800000"},
+        "streams": [{"index": 0, "codec_type": "video", "codec_name": "h264", "tags": {"language": "eng"}}],
+    }
+    packets = {"packets": [
+        {"pts_time": "2.0", "pos": "4096", "flags": "K__"},
+        {"pts_time": "1.0", "pos": "2048", "flags": "__"},
+        {"pts_time": "0.0", "pos": "N/A", "flags": "K__"},
+    ]}
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "movie.mkv")
+        with open(self.path, "wb") as f:
+            f.write(b"movie")
+        patcher = mock.patch("stream.probe.ffmpeg.probe",
+                             side_effect=lambda path, **kwargs: self.packets if kwargs else self.probe)
+        self.ffprobe = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_probes_once_per_file_version(self):
+        record = ProbeCache().get(self.path)
+        self.assertEqual(record["duration"], 60.5)
+        self.assertEqual(record["streams"][0]["language"], "eng")
+
+        # Another worker reads the sidecar
+        self.assertEqual(ProbeCache().get(self.path), record)
+        self.assertEqual(self.ffprobe.call_count, 1)
+
+        with open(self.path, "ab") as f:
+            f.write(b" grows")
+        ProbeCache().get(self.path)
+        self.assertEqual(self.ffprobe.call_count, 2)
+
+    def test_keyframes_are_read_when_first_asked_for(self):
+        cache = ProbeCache()
+        self.assertIsNone(cache.get(self.path)["keyframes"])
+
+        self.assertEqual(cache.get(self.path, keyframes=True)["keyframes"], [[0.0, None], [2.0, 4096]])
+        cache.get(self.path)
+        self.assertEqual(self.ffprobe.call_count, 3)
+
+
+    def test_pinned_file_is_probed_once_while_it_grows(self):
+        cache = ProbeCache()
+        with cache.pinned(self.path):
+            first = cache.get(self.path)
+            with open(self.path, "ab") as f:
+                f.write(b" grows")
+            self.assertIs(cache.get(self.path), first)
+        self.assertEqual(self.ffprobe.call_count, 1)
+
+        cache.get(self.path)
+        self.assertEqual(self.ffprobe.call_count, 2)
+
+    def test_keeps_the_most_recently_used_records(self):
+        cache = ProbeCache()
+        cache.capacity = 2
+        paths = [self.path]
+        for name in ("b.mkv", "c.mkv"):
+            paths.append(os.path.join(os.path.dirname(self.path), name))
+            with open(paths[-1], "wb") as f:
+                f.write(b"movie")
+        cache.get(paths[0])
+        cache.get(paths[1])
+        cache.get(paths[0])
+        cache.get(paths[2])
+
+        self.assertEqual(list(cache._records), [paths[0], paths[2]])
+
+class FakeTorrentInfo:
+    """A single 1000 byte file in 100 byte pieces."""
+
+    piece_length = 100
+
+    def files(self):
+        return mock.Mock(file_size=lambda index: 1000)
+
+    def map_file(self, index, offset, size):
+        return mock.Mock(piece=offset // self.piece_length, start=offset % self.piece_length)
+
+    def piece_size(self, piece):
+        return self.piece_length
+
+
+class SegmentReadinessTests(SimpleTestCase):
+    def setUp(self):
+        self.pieces = set()
+        handle = mock.Mock(have_piece=lambda piece: piece in self.pieces)
+        self.readiness = SegmentReadiness(handle, FakeTorrentInfo(), 0, segment_duration=10)
+
+    def test_nothing_is_ready_before_the_probe(self):
+        self.pieces.update(range(10))
+        self.assertFalse(self.readiness.is_ready(0, 1))
+
+    def test_needs_the_header_and_the_pieces_between_keyframes(self):
+        self.readiness.update_probe({"duration": 100, "keyframes": [[10.0 * i, 100 * i] for i in range(1, 10)]})
+
+        self.pieces.add(2)
+        self.assertFalse(self.readiness.is_ready(2, 3))
+        self.pieces.add(0)
+        self.assertTrue(self.readiness.is_ready(2, 3))
+        self.assertFalse(self.readiness.is_ready(2, None))
+
+    def test_estimated_offsets_are_widened(self):
+        # No keyframe index: segment 2 is somewhere around bytes 200-300
+        self.readiness.update_probe({"duration": 100, "keyframes": None})
+        self.assertEqual(self.readiness.byte_range(2, 3), (150, 350))
+
+    def test_contiguous_bytes_stop_at_the_first_missing_piece(self):
+        self.pieces.update({0, 1, 3})
+        self.assertEqual(self.readiness.contiguous_bytes(), 200)
+        self.pieces.add(2)
+        self.assertEqual(self.readiness.contiguous_bytes(known=200), 400)
+
+
+class ProgressFlusherTests(SimpleTestCase):
+    def setUp(self):
+        # Flushed by hand only
+        self.flusher = ProgressFlusher(interval=3600)
+        patcher = mock.patch.object(MovieFile, "objects")
+        self.objects = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_progress_waits_for_the_flush_and_overlays_reads(self):
+        self.flusher.record(MovieFile(id=1, download_progress=42.0), "download_progress")
+        self.objects.filter.assert_not_called()
+
+        self.assertEqual(self.flusher.apply(MovieFile(id=1, download_progress=0)).download_progress, 42.0)
+
+    def test_status_changes_are_written_with_pending_progress(self):
+        self.flusher.record(MovieFile(id=1, download_progress=42.0), "download_progress")
+        self.flusher.record(MovieFile(id=1, download_status="PLAYABLE"), "download_status")
+
+        self.objects.filter.assert_called_once_with(id=1)
+        self.objects.filter.return_value.update.assert_called_once_with(
+            download_progress=42.0, download_status="PLAYABLE")
+
+    def test_movies_with_the_same_fields_are_written_together(self):
+        for pk in (1, 2):
+            self.flusher.record(MovieFile(id=pk, download_progress=pk * 10.0), "download_progress")
+        self.flusher.flush()
+
+        movie_files, fields = self.objects.bulk_update.call_args.args
+        self.assertEqual([movie_file.id for movie_file in movie_files], [1, 2])
+        self.assertEqual(fields, ("download_progress",))
+
+    def test_failed_writes_are_retried_unless_newer_values_arrived(self):
+        watched = timezone.now()
+        self.objects.filter.return_value.update.side_effect = Exception("database is gone")
+        self.flusher.record(MovieFile(id=1, download_progress=10.0, last_watched=watched),
+                            "download_progress", "last_watched")
+        self.flusher.flush()
+        self.flusher.record(MovieFile(id=1, download_progress=20.0), "download_progress")
+
+        self.objects.filter.return_value.update.side_effect = None
+        self.flusher.flush()
+        self.objects.filter.return_value.update.assert_called_with(download_progress=20.0, last_watched=watched)
+
+
+class SegmentManifestTests(SimpleTestCase):
+    def setUp(self):
+        self.manifest = SegmentManifest("/movies/1/movie.manifest.json")
+        self.manifest.segment_duration = 10
+        self.manifest.total_duration = 35
+
+    def test_playlist_lists_only_the_leading_settled_segments(self):
+        self.manifest.add_segment(0, 0, 10, 100, "movie_segment_000.mp4", 40)
+        self.manifest.mark_failed(1)
+        # Cut by a seek job, before segment 2
+        self.manifest.add_segment(3, 30, 5, 50, "movie_segment_003.mp4", 40)
+
+        segments = self.manifest.playlist_segments()
+        self.assertEqual([segment for segment, _ in segments], [0, 1])
+        self.assertEqual(segments[1][1]["duration"], 10)
+        self.assertEqual(segments[1][1]["path"], "movie_segment_001.mp4")
+
+    def test_playlist_maps_the_init_section_of_each_segment(self):
+        self.manifest.add_segment(0, 0, 10, 100, "movie_segment_000.mp4", 40)
+        self.manifest.mark_failed(1)
+
+        playlist = render_playlist(self.manifest.playlist_segments(), 10, finished=False)
+        self.assertEqual(playlist, (
+            "#EXTM3U\n#EXT-X-VERSION:8\n#EXT-X-TARGETDURATION:10\n"
+            "#EXT-X-MEDIA-SEQUENCE:0\n#EXT-X-PLAYLIST-TYPE:EVENT\n"
+            '#EXT-X-MAP:URI="movie_segment_000.mp4",BYTERANGE="40@0"\n#EXTINF:10.000,\nmovie_segment_000.mp4\n'
+            "#EXT-X-GAP\n#EXTINF:10.000,\nmovie_segment_001.mp4\n"
+        ))
+
+    def test_init_size_covers_the_boxes_before_the_first_fragment(self):
+        def box(box_type, payload=b""):
+            return (8 + len(payload)).to_bytes(4, "big") + box_type + payload
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, "movie_segment_000.mp4")
+        with open(path, "wb") as f:
+            f.write(box(b"ftyp", b"isom") + box(b"moov", b"x" * 20) + box(b"moof", b"y") + box(b"mdat", b"z"))
+
+        self.assertEqual(mp4_init_size(path), 40)
+
+
+class ReleaseSourceTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.source = os.path.join(self.tmp_dir, "movie.mkv")
+        with open(self.source, "wb") as f:
+            f.write(b"payload")
+
+    def segment(self, manifest, segment, start, duration):
+        filename = f"movie_segment_{segment:03d}.mp4"
+        with open(os.path.join(self.tmp_dir, filename), "wb") as f:
+            f.write(b"x" * (segment + 1))
+        manifest.add_segment(segment, start, duration, segment + 1, filename)
+
+    def test_releases_when_the_run_cut_fewer_segments_than_the_grid(self):
+        def change(manifest):
+            manifest.segment_duration = 10
+            manifest.total_duration = 61
+            # The last keyframe came before 60 s, so 6 segments instead of 7
+            for segment in range(6):
+                self.segment(manifest, segment, segment * 10, 11 if segment == 5 else 10)
+            manifest.finished = True
+        manifest_store.update(os.path.join(self.tmp_dir, "movie.manifest.json"), change)
+
+        self.assertTrue(VideoService().release_source(self.source))
+        self.assertFalse(os.path.exists(self.source))
+
+    def test_keeps_the_source_while_a_segment_is_missing(self):
+        def change(manifest):
+            self.segment(manifest, 0, 0, 10)
+            self.segment(manifest, 2, 20, 10)
+            manifest.finished = True
+        manifest_store.update(os.path.join(self.tmp_dir, "movie.manifest.json"), change)
+
+        self.assertFalse(VideoService().release_source(self.source))
+        self.assertTrue(os.path.exists(self.source))
+
+
+class StreamPlanTests(SimpleTestCase):
+    def plan(self, video_codec, audio_codec):
+        streams = [
+            {"index": 0, "codec_type": "video", "codec_name": video_codec, "pix_fmt": "yuv420p", "height": 720},
+            {"index": 1, "codec_type": "audio", "codec_name": audio_codec},
+        ]
+        with mock.patch.object(VideoService, "probe", return_value={"streams": streams}):
+            return VideoService().plan_streams("/movies/1/movie.mkv")
+
+    def test_playable_streams_are_copied(self):
+        plan = self.plan("h264", "aac")
+        self.assertTrue(plan.copy)
+        self.assertEqual(plan.codec_kwargs(10), {"c:v": "copy", "c:a": "copy"})
+
+    def test_only_the_unplayable_audio_is_transcoded(self):
+        plan = self.plan("h264", "ac3")
+        self.assertEqual((plan.video, plan.audio), ("copy", "transcode"))
+
+    def test_audio_is_transcoded_along_with_transcoded_video(self):
+        plan = self.plan("mpeg4", "mp3")
+        self.assertEqual((plan.video, plan.audio), ("transcode", "transcode"))
+        self.assertEqual(plan.codec_kwargs(10)["c:a"], "aac")
+
+
+    def test_mp4_with_its_index_after_the_media_cannot_be_piped(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, "movie.mp4")
+        service = VideoService()
+
+        def write(*box_types):
+            with open(path, "wb") as f:
+                for box_type in box_types:
+                    f.write((16).to_bytes(4, "big") + box_type + b"x" * 8)
+
+        with mock.patch.object(VideoService, "probe", return_value={"format_name": "mov,mp4,m4a,3gp,3g2,mj2"}):
+            write(b"ftyp", b"moov", b"mdat")
+            self.assertTrue(service.pipe_readable(path))
+            write(b"ftyp", b"free", b"mdat", b"moov")
+            self.assertFalse(service.pipe_readable(path))
+        with mock.patch.object(VideoService, "probe", return_value={"format_name": "matroska,webm"}):
+            self.assertTrue(service.pipe_readable(path))
+
+class SegmentBoundaryTests(SimpleTestCase):
+    def test_cuts_on_the_first_keyframe_past_each_grid_point(self):
+        keyframes = [0, 3.48, 6.96, 10.44, 13.92, 17.4, 20.88, 24.36]
+        self.assertEqual(plan_segment_boundaries(keyframes, 26, 10), [0.0, 10.44, 20.88])
+
+    def test_long_gop_makes_a_longer_segment_and_the_grid_catches_up(self):
+        # No keyframe between 4 and 25: the first segment runs to 25, the next ones stay on the grid
+        self.assertEqual(plan_segment_boundaries([0, 4, 25, 27, 33], 40, 10), [0.0, 25, 27, 33])
+
+    def test_keyframe_just_short_of_the_grid_is_a_boundary(self):
+        self.assertEqual(plan_segment_boundaries([0, 9.98, 15], 20, 10), [0.0, 9.98])
+
+
+@override_settings(VIDEO_RENDITIONS=["480:1200", "1080:5000", "720:2800"])
+class RenditionLadderTests(SimpleTestCase):
+    def setUp(self):
+        self.manifest = SegmentManifest("/movies/1/movie.manifest.json")
+        # 8 Mb/s of source video
+        self.manifest.add_segment(0, 0, 10, 10 * 1_000_000, "movie_segment_000.mp4")
+        self.service = VideoService()
+        patcher = mock.patch.object(VideoService, "source_resolution", return_value=(1280, 720))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_offers_only_rungs_below_the_source(self):
+        self.assertEqual([rendition.name for rendition in self.service.renditions(self.manifest)], ["480p"])
+
+    def test_throughput_picks_the_best_rung_that_fits(self):
+        self.assertIsNone(self.service.rendition_for_throughput(self.manifest, 20_000_000))
+        self.assertEqual(self.service.rendition_for_throughput(self.manifest, 2_000_000).name, "480p")
+        # Below every rung the lowest one is still better than the source
+        self.assertEqual(self.service.rendition_for_throughput(self.manifest, 100_000).name, "480p")
+
+    def test_master_playlist_lists_the_source_first(self):
+        variants = self.service.variants(self.manifest)
+        playlist = render_master_playlist([
+            (f"{rendition.name if rendition else 'source'}.m3u8", bandwidth, average, resolution)
+            for rendition, bandwidth, average, resolution in variants
+        ])
+
+        self.assertEqual(playlist, (
+            "#EXTM3U\n#EXT-X-VERSION:3\n"
+            "#EXT-X-STREAM-INF:BANDWIDTH=8000000,AVERAGE-BANDWIDTH=8000000,RESOLUTION=1280x720\nsource.m3u8\n"
+            f"#EXT-X-STREAM-INF:BANDWIDTH={Rendition(480, 1200).bandwidth},RESOLUTION=854x480\n480p.m3u8\n"
+        ))
+
+
+class FakeEngine:
+    """Just what the speed governor reads from a running segmenting engine."""
+
+    transcodes_video = True
+    pipe = False
+    end_segment = None
+
+    def __init__(self, next_segment, speed):
+        self._next_segment = next_segment
+        self.speed = speed
+        self.started_at = 0
+        self.restarted_at = None
+
+    def next_segment(self):
+        return self._next_segment
+
+    def restart(self, level):
+        self.restarted_at = level
+
+
+class TranscodePoolTests(SimpleTestCase):
+    def test_job_failing_its_readiness_check_is_dropped(self):
+        pool = TranscodePool(1)
+        broken = SegmentJob(1, FakeEngine(next_segment=0, speed=None), is_ready=mock.Mock(side_effect=OSError("gone")))
+        waiting = SegmentJob(2, FakeEngine(next_segment=0, speed=None), is_ready=lambda: False)
+        pool._jobs = [broken, waiting]
+        pool._order = {broken: 0, waiting: 1}
+
+        self.assertIsNone(pool._next_job())
+        self.assertTrue(broken.is_done())
+        self.assertFalse(broken.wait())
+        self.assertEqual(pool._jobs, [waiting])
+
+
+    def test_pipe_fed_jobs_leave_the_workers_to_file_jobs(self):
+        pool = TranscodePool(1)
+        download = threading.Event()
+        self.addCleanup(download.set)
+        pipe_engine = mock.Mock(pipe=True, restarting=False, wait=lambda: download.wait(5))
+        file_engine = mock.Mock(pipe=False, restarting=False, end_segment=None, **{"wait.return_value": True, "next_segment.return_value": 0})
+
+        pipe_job = pool.submit(SegmentJob(1, pipe_engine))
+        file_job = pool.submit(SegmentJob(2, file_engine))
+
+        self.assertTrue(file_job.wait(5))
+        self.assertFalse(pipe_job.is_done())
+        download.set()
+        self.assertTrue(pipe_job.wait(5))
+
+class SpeedGovernorTests(SimpleTestCase):
+    def setUp(self):
+        self.pool = TranscodePool(1)
+        self.governor = SpeedGovernor(self.pool, levels=5, start_level=2)
+
+    def run_job(self, engine, movie_id=1):
+        self.pool._running.add(SegmentJob(movie_id, engine))
+        return engine
+
+    def test_steps_down_when_a_watched_transcode_falls_behind(self):
+        self.pool.set_playhead(1, 10)
+        engine = self.run_job(FakeEngine(next_segment=12, speed=0.8))
+
+        self.governor.check(now=100)
+        self.assertEqual(self.governor.level(1), 3)
+        self.assertEqual(engine.restarted_at, 3)
+
+        # Nothing more until the cooldown is over
+        self.governor.check(now=110)
+        self.assertEqual(self.governor.level(1), 3)
+
+    def test_slow_transcode_far_ahead_of_the_playhead_is_left_alone(self):
+        self.pool.set_playhead(1, 0)
+        engine = self.run_job(FakeEngine(next_segment=40, speed=0.8))
+
+        self.governor.check(now=100)
+        self.assertEqual(self.governor.level(1), 2)
+        self.assertIsNone(engine.restarted_at)
+
+    def test_steps_up_with_headroom(self):
+        self.run_job(FakeEngine(next_segment=3, speed=4.0))
+        self.governor.check(now=100)
+        self.assertEqual(self.governor.level(1), 1)
+
+    def test_reads_speed_from_ffmpeg_progress(self):
+        engine = SegmentingEngine("/tmp/movie.mkv")
+        engine._stderr_line("frame=  468 fps=466 q=28.0 size=0kB time=00:00:19.04 bitrate=0.0kbits/s speed=  19x")
+        engine._stderr_line("[mp4 @ 0x1] Invalid data")
+
+        self.assertEqual(engine.speed, 19.0)
+        self.assertEqual(list(engine._stderr_tail), ["[mp4 @ 0x1] Invalid data"])
+
+
+class SegmentingEngineTests(SimpleTestCase):
+    def test_concurrent_publishes_move_each_segment_once(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        engine = SegmentingEngine(os.path.join(tmp_dir, "movie.mkv"))
+        os.makedirs(engine.staging_dir)
+        with open(engine.segment_list_path, "w") as f:
+            f.write("movie_segment_000.mp4,0.0,10.0\n")
+        with open(os.path.join(engine.staging_dir, "movie_segment_000.mp4"), "wb") as f:
+            f.write(b"segment")
+
+        replace = os.replace
+
+        def slow_replace(src, dst):
+            # Let the other publisher find the staged file before it is gone
+            time.sleep(0.2)
+            replace(src, dst)
+
+        errors = []
+
+        def publish():
+            try:
+                engine._publish()
+            except OSError as e:
+                errors.append(e)
+
+        with mock.patch("stream.services.os.replace", side_effect=slow_replace), \
+                mock.patch("stream.services.manifest_store") as store:
+            threads = [threading.Thread(target=publish) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(store.update.call_count, 1)
+        self.assertTrue(os.path.exists(engine.segment_path(0)))
+
+
+class TrackerRegistryTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, ".trackers.json")
+
+    def registry(self):
+        # Never due for a background refresh
+        return TrackerRegistry(self.path, ttl=10 ** 12, sources=["https://a/list.txt", "https://b/list.txt"])
+
+    def test_normalizes_tracker_urls(self):
+        self.assertEqual(normalize_tracker(" UDP://Tracker.Example.org:1337/announce\n"),
+                         "udp://tracker.example.org:1337/announce")
+        self.assertEqual(normalize_tracker("http://tracker.example.org/"), "http://tracker.example.org")
+        self.assertIsNone(normalize_tracker("# comment"))
+        self.assertIsNone(normalize_tracker("tracker.example.org"))
+
+    def test_ranks_by_announce_success_and_shares_the_stats(self):
+        registry = self.registry()
+        first, second = FALLBACK_TRACKERS[:2]
+        registry.record_announce(first, success=False)
+        registry.record_announce(second, success=True)
+        registry.save()
+
+        self.assertEqual(self.registry().trackers(limit=2), [second, FALLBACK_TRACKERS[2]])
+
+    def test_refresh_keeps_the_list_when_no_source_answers(self):
+        answer = mock.Mock(text="udp://one.example:80/announce\n\nudp://ONE.example:80/announce/\n")
+
+        with mock.patch("stream.trackers.requests.get",
+                        side_effect=[requests.ConnectionError("down"), answer]):
+            registry = self.registry()
+            registry.refresh()
+        self.assertEqual(registry.trackers(), ["udp://one.example:80/announce"])
+
+        with mock.patch("stream.trackers.requests.get", side_effect=requests.ConnectionError("down")):
+            registry.refresh()
+        self.assertEqual(registry.trackers(), ["udp://one.example:80/announce"])
+
+
+class TorrentRegistryTests(SimpleTestCase):
+    magnet_link = "magnet:?xt=urn:btih:0123456789abcdef0123456789abcdef01234567&tr=udp%3A%2F%2Fa.example%3A80"
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        # A bare manager: no alert, cleanup or resume threads and nothing on the network
+        self.manager = object.__new__(TorrentSessionManager)
+        self.manager.session = lt.session({
+            "listen_interfaces": "127.0.0.1:0", "enable_dht": False, "enable_lsd": False,
+            "enable_upnp": False, "enable_natpmp": False,
+        })
+        self.manager.resume_dir = self.tmp_dir
+        self.manager.handles = {}
+        self.manager.streams = {}
+        self.manager.movie_handles = {}
+        self.manager.handle_movies = {}
+        self.manager.playhead_windows = {}
+        self.manager.pipelines = {}
+        self.manager.movie_leaders = {}
+
+    def test_same_torrent_is_shared_and_gains_new_trackers(self):
+        first = self.manager.add_torrent(self.magnet_link, self.tmp_dir, movie_id=1)
+        second = self.manager.add_torrent(f"{self.magnet_link}&tr=udp%3A%2F%2Fb.example%3A80", "/elsewhere", movie_id=2)
+
+        self.assertEqual(first, "0123456789abcdef0123456789abcdef01234567")
+        self.assertEqual(second, first)
+        self.assertEqual(len(self.manager.session.get_torrents()), 1)
+        self.assertEqual(self.manager.save_path(first), self.tmp_dir)
+        handle = self.manager.get_handle(first)
+        self.assertEqual([tracker["url"] for tracker in handle.trackers()],
+                         ["udp://a.example:80", "udp://b.example:80"])
+
+    def test_torrent_stays_until_every_movie_and_pipeline_let_go(self):
+        handle_id = self.manager.add_torrent(self.magnet_link, self.tmp_dir, movie_id=1)
+        self.manager.add_torrent(self.magnet_link, self.tmp_dir, movie_id=2)
+        pipeline = mock.Mock(handle=self.manager.get_handle(handle_id), handle_id=handle_id)
+        self.manager.attach_pipeline(pipeline.handle, pipeline)
+
+        self.manager.release_movie(1)
+        self.manager.remove_torrent(handle_id, 2)
+        self.assertIsNotNone(self.manager.get_handle(handle_id))
+        self.assertIsNone(self.manager.handle_for_movie(1))
+
+        self.manager.pipeline_done(pipeline)
+        self.assertIsNone(self.manager.get_handle(handle_id))
+        self.assertEqual(self.manager.session.get_torrents(), [])
+
+
+    def test_releasing_a_movie_stops_its_pipeline_and_frees_its_slot(self):
+        handle_id = self.manager.add_torrent(self.magnet_link, self.tmp_dir, movie_id=1)
+        pipeline = mock.Mock(handle=self.manager.get_handle(handle_id), handle_id=handle_id, movie_id=1)
+        self.manager.attach_pipeline(pipeline.handle, pipeline)
+
+        with mock.patch("stream.views.download_queue") as queue:
+            self.manager.release_movie(1)
+        pipeline.stop.assert_called_once_with()
+        queue.release_movie.assert_called_once_with(1)
+
+    def test_pieces_leaving_the_playhead_window_go_back_to_the_file_priority(self):
+        handle = mock.Mock(**{"have_piece.return_value": False})
+        readiness = SegmentReadiness(handle, FakeTorrentInfo(), 0, segment_duration=10)
+        readiness.update_probe({"duration": 100, "keyframes": [[10.0 * i, 100 * i] for i in range(1, 10)]})
+        readiness.torrent_info.files = lambda: mock.Mock(**{"num_files.return_value": 1})
+        self.manager.handles["a"] = handle
+
+        self.manager.prepare_streaming("a", 1, readiness)
+        file_priority = handle.prioritize_files.call_args.args[0][0]
+        self.manager.playhead_window_segments = 2
+        self.manager.set_playhead("a", 0)
+        handle.piece_priority.reset_mock()
+        self.manager.set_playhead("a", 5)
+
+        self.assertIn(mock.call(0, file_priority), handle.piece_priority.call_args_list)
+        self.assertGreater(handle.piece_priority.call_args_list[-1].args[1], file_priority)
+
+class MoviePipelineTests(SimpleTestCase):
+    def setUp(self):
+        self.pipeline = MoviePipeline(mock.Mock(), 1, "tt0133093")
+        self.pipeline.state = "DOWNLOADING"
+        self.pipeline.movie_file = MovieFile(id=1, download_status="DL_AND_CONVERT", download_progress=0)
+        self.pipeline.readiness = mock.Mock(**{"contiguous_bytes.return_value": 1024})
+        self.pipeline.job = mock.Mock()
+        self.pipeline.job.engine.published = {0}
+        for target in ("stream.views.progress_flusher", "stream.views.publish_movie_status"):
+            patcher = mock.patch(target)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_status_updates_leave_database_writes_and_ffprobe_to_the_pool(self):
+        with mock.patch.object(MoviePipeline, "probe_pool") as pool, \
+                mock.patch.object(MoviePipeline, "mark_playable") as mark_playable:
+            pool.submit.return_value.done.return_value = False
+            self.pipeline.on_status(mock.Mock(progress=0.5, total_wanted_done=500))
+            self.pipeline.on_status(mock.Mock(progress=0.6, total_wanted_done=600))
+
+        mark_playable.assert_not_called()
+        # One run at a time: the second update finds the first one still pending
+        pool.submit.assert_called_once_with(self.pipeline._tend_segmenter)
+
+    def test_movie_sharing_the_torrent_mirrors_the_pipeline_that_downloads_it(self):
+        self.pipeline.movie_file.download_status = "PLAYABLE"
+        self.pipeline.movie_file.file_path = "movies/1/movie_segment_000.mp4"
+        follower = MovieFile(id=2, download_status="DOWNLOADING", download_progress=0)
+
+        self.assertTrue(self.pipeline.add_follower(follower))
+        self.assertEqual((follower.download_status, follower.file_path),
+                         ("PLAYABLE", "movies/1/movie_segment_000.mp4"))
+
+        self.pipeline.fail()
+        self.assertEqual(follower.download_status, "ERROR")
+        self.pipeline.manager.remove_torrent.assert_called_once_with(self.pipeline.handle_id, 2)
+        self.assertFalse(self.pipeline.add_follower(MovieFile(id=3)))
+
+
+    def restored_pipeline(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.pipeline.movie_dir = tmp_dir
+        self.pipeline.downloaded_path = os.path.join(tmp_dir, "movie.mkv")
+
+        def change(manifest):
+            manifest.segment_duration = 10
+            manifest.total_duration = 20
+            for segment in range(2):
+                manifest.add_segment(segment, segment * 10, 10, 100, f"movie_segment_{segment:03d}.mp4")
+            manifest.finished = True
+        manifest_store.update(os.path.join(tmp_dir, "movie.manifest.json"), change)
+        return self.pipeline
+
+    def test_restored_pipeline_with_every_segment_on_disk_ends_ready(self):
+        pipeline = self.restored_pipeline()
+        pipeline.state = "FINISHING"
+        pipeline.job = None
+        # convert_to_mp4 skips the segments the manifest holds, so it processes none
+        pipeline.video_service = mock.Mock(processed_segments=set(), failed_segments=set())
+
+        with mock.patch.object(MoviePipeline, "mark_playable") as mark_playable:
+            pipeline._convert_remaining()
+
+        mark_playable.assert_called_once_with()
+        self.assertEqual(pipeline.movie_file.download_status, "READY")
+
+    def test_restored_playable_title_stays_playable(self):
+        pipeline = self.restored_pipeline()
+        pipeline.state = "METADATA"
+        pipeline.movie_file.download_status = "PLAYABLE"
+        pipeline.manager.save_path.return_value = pipeline.movie_dir
+        pipeline.manager.leading_pipeline.return_value = None
+        handle = pipeline.manager.get_handle.return_value
+        handle.status.return_value.has_metadata = False
+
+        with mock.patch.object(MovieFile, "objects") as objects, \
+                mock.patch("stream.views.SubtitleService"), mock.patch("stream.views.os.makedirs"):
+            objects.get.return_value = pipeline.movie_file
+            pipeline.start()
+        self.assertEqual(pipeline.movie_file.download_status, "PLAYABLE")
+
+        files = handle.get_torrent_info.return_value.files.return_value
+        files.num_files.return_value = 1
+        files.file_path.return_value = "movie.mkv"
+        handle.status.return_value.is_finished = False
+        with mock.patch.object(MoviePipeline, "probe_pool") as pool, mock.patch("stream.views.SegmentReadiness"):
+            pipeline.on_metadata()
+        self.assertTrue(pipeline.first_segment_ready)
+        self.assertEqual(pipeline.movie_file.download_status, "PLAYABLE")
+        pool.submit.assert_not_called()
+
+    def test_stalled_download_fails_and_gives_up_its_slot(self):
+        self.pipeline.state = "METADATA"
+        self.pipeline.progress_at = 0
+        with mock.patch.object(MoviePipeline, "probe_pool") as pool:
+            self.pipeline.check_stalled(now=self.pipeline.stall_timeout - 1)
+            pool.submit.assert_not_called()
+            self.pipeline.check_stalled(now=self.pipeline.stall_timeout + 1)
+        pool.submit.assert_called_once_with(self.pipeline.fail)
+
+        with mock.patch("stream.views.download_queue") as queue:
+            self.pipeline.fail()
+        self.assertEqual(self.pipeline.movie_file.download_status, "ERROR")
+        queue.release.assert_called_once_with("tt0133093")
+
+    def test_failed_streaming_run_goes_on_from_the_file(self):
+        self.pipeline.downloaded_path = "/movies/1/movie.mp4"
+        self.pipeline.video_service = mock.Mock(chunk_segments=30, **{"total_segments.return_value": 100})
+        self.pipeline.job = SegmentJob(1, mock.Mock(pipe=True, **{"next_segment.return_value": 4}))
+        self.pipeline.job._done.set()
+
+        with mock.patch("stream.views.transcode_pool") as pool:
+            self.pipeline._continue_segmenter()
+        self.pipeline.video_service.create_engine.assert_called_once_with(
+            "/movies/1/movie.mp4", start_segment=4, end_segment=34)
+        job = pool.submit.call_args.args[0]
+        self.assertIs(self.pipeline.job, pool.submit.return_value)
+
+        # A chunk waits for its own pieces
+        self.pipeline.readiness.is_ready.return_value = False
+        self.assertFalse(job.is_ready())
+        self.pipeline.readiness.is_ready.assert_called_once_with(4, 34)
+
+        # A failed chunk is not retried while downloading
+        failed = SegmentJob(1, mock.Mock(pipe=False))
+        failed._done.set()
+        self.pipeline.job = failed
+        with mock.patch("stream.views.transcode_pool") as pool:
+            self.pipeline._continue_segmenter()
+        pool.submit.assert_not_called()
+
+
+class DownloadQueueTests(SimpleTestCase):
+    def setUp(self):
+        self.queue = DownloadQueue(max_active=1, max_queued=2)
+        self.started = []
+
+    def submit(self, key, movie_id, viewer=True):
+        return self.queue.submit(key, movie_id, lambda: self.started.append(movie_id), viewer=viewer)
+
+    def test_title_with_most_viewers_goes_next(self):
+        self.assertEqual(self.submit("a", 1), 0)
+        self.assertEqual(self.submit("b", 2), 1)
+        self.assertEqual(self.submit("c", 3), 2)
+        # A second viewer of the last title moves it ahead, submitting it twice queues it once
+        self.assertEqual(self.submit("c", 3), 1)
+        self.assertEqual(self.queue.position(2), 2)
+
+        with mock.patch("threading.Thread") as thread:
+            self.queue.release("a")
+        thread.call_args.kwargs["target"](*thread.call_args.kwargs["args"])
+        self.assertEqual(self.started, [1, 3])
+        self.assertEqual(self.queue.position(3), 0)
+
+    def test_restored_titles_wait_behind_asked_for_ones(self):
+        self.submit("a", 1)
+        self.submit("b", 2, viewer=False)
+        self.submit("c", 3)
+        self.assertEqual(self.queue.position(3), 1)
+
+    def test_released_movie_leaves_the_queue_or_its_slot(self):
+        self.submit("a", 1)
+        self.submit("b", 2)
+        self.queue.release_movie(2)
+        self.assertIsNone(self.queue.position(2))
+
+        with mock.patch("threading.Thread"):
+            self.queue.release_movie(1)
+        self.assertIsNone(self.queue.position(1))
+        self.assertEqual(self.submit("c", 3), 0)
+
+    def test_refuses_beyond_max_queued(self):
+        self.submit("a", 1)
+        self.submit("b", 2)
+        self.submit("c", 3)
+        with self.assertRaises(QueueFull):
+            self.submit("d", 4)
+
+
+class TorrentDaemonTests(SimpleTestCase):
+    def test_client_is_off_inside_the_daemon(self):
+        client = TorrentDaemonClient("/nonexistent.sock")
+        self.assertTrue(client)
+        with mock.patch.object(TorrentDaemonClient, "inside_daemon", True):
+            self.assertFalse(client)
+            with self.assertRaises(DaemonError):
+                client.queue_position(1)
+
+    def test_slow_subscriber_loses_the_oldest_events(self):
+        bus = EventBus()
+        written, blocked, unblock = [], threading.Event(), threading.Event()
+
+        class SlowWriter:
+            def write(self, line):
+                written.append(json.loads(line)["movie_id"])
+                if len(written) == 1:
+                    blocked.set()
+                    unblock.wait(5)
+                if written[-1] == 99:
+                    raise BrokenPipeError
+
+            def flush(self):
+                pass
+
+        handler = TorrentDaemonHandler.__new__(TorrentDaemonHandler)
+        handler.wfile = SlowWriter()
+        handler.event_backlog = 10
+        with mock.patch("stream.daemon.event_bus", bus):
+            thread = threading.Thread(target=handler.stream_events)
+            thread.start()
+            while not bus._listeners:
+                time.sleep(0.01)
+            bus.publish(0, {"status": "DOWNLOADING"})
+            self.assertTrue(blocked.wait(5))
+            for movie_id in range(1, 100):
+                bus.publish(movie_id, {"status": "DOWNLOADING"})
+            unblock.set()
+            thread.join(5)
+        self.assertEqual(written, [0, *range(90, 100)])
+        self.assertEqual(bus._listeners, [])
+
+
+class EventBusTests(SimpleTestCase):
+    def setUp(self):
+        self.bus = EventBus()
+        self.received = []
+        self.bus.add_listener(lambda movie_id, data: self.received.append((movie_id, data["status"])))
+
+    def test_finished_movies_are_not_kept(self):
+        self.bus.publish(1, {"status": "DOWNLOADING"})
+        self.bus.publish(2, {"status": "DOWNLOADING"})
+        self.bus.publish(1, {"status": "READY"})
+        self.bus.publish(2, {"status": "ERROR"})
+
+        self.assertEqual(self.received, [(1, "DOWNLOADING"), (2, "DOWNLOADING"), (1, "READY"), (2, "ERROR")])
+        self.assertEqual(self.bus._latest, {})
+
+    def test_forget_drops_a_stopped_movie(self):
+        self.bus.publish(1, {"status": "DOWNLOADING"})
+        self.bus.forget(1)
+        self.assertIsNone(self.bus.latest(1))
@@ -0,0 +1,166 @@
+import json
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+import requests
+from django.conf import settings
+
+TRACKER_SOURCES = [
+    "https://raw.githubusercontent.com/XIU2/TrackersListCollection/refs/heads/master/best.txt",
+    "https://raw.githubusercontent.com/ngosang/trackerslist/refs/heads/master/trackers_best.txt",
+]
+
+# Used until a tracker list has been fetched once
+FALLBACK_TRACKERS = [
+    "udp://tracker.opentrackr.org:1337/announce",
+    "udp://open.demonii.com:1337/announce",
+    "udp://open.stealth.si:80/announce",
+    "udp://tracker.torrent.eu.org:451/announce",
+    "udp://tracker.skyts.net:6969/announce",
+    "udp://tracker.dump.cl:6969/announce",
+    "udp://ns-1.x-fins.com:6969/announce",
+    "udp://explodie.org:6969/announce",
+    "udp://exodus.desync.com:6969/announce",
+    "http://www.torrentsnipe.info:2701/announce",
+    "http://tracker810.xyz:11450/announce",
+    "http://tracker.xiaoduola.xyz:6969/announce",
+    "http://tracker.sbsub.com:2710/announce",
+    "http://tracker.corpscorp.online:80/announce",
+    "http://tracker.bz:80/announce",
+    "http://share.hkg-fansub.info:80/announce.php",
+    "http://seeders-paradise.org:80/announce",
+    "http://home.yxgz.club:6969/announce",
+    "http://finbytes.org:80/announce.php",
+    "http://buny.uk:6969/announce",
+]
+
+
+def normalize_tracker(url: str) -> Optional[str]:
+    url = url.strip()
+    if not url or url.startswith('#') or '://' not in url:
+        return None
+    scheme, rest = url.split('://', 1)
+    host, _, path = rest.partition('/')
+    return f"{scheme.lower()}://{host.lower()}/{path}".rstrip('/')
+
+
+class TrackerRegistry:
+    """
+    Public tracker list, kept in memory and in ``path`` and refreshed in the background.
+
+    Reading the list never waits on the network: once it is older than ``ttl``, a
+    refresh is started in a thread and the current list is served meanwhile. Every
+    process reads the same file, so the list and its announce statistics are shared;
+    the statistics come from libtorrent tracker alerts in the process that runs the
+    session, and trackers are ranked by their announce success rate.
+    """
+
+    timeout = 10
+    save_interval = 60
+
+    def __init__(self, path: str, ttl: int, sources: list = TRACKER_SOURCES):
+        self.path = path
+        self.ttl = ttl
+        self.sources = sources
+        self._trackers = list(FALLBACK_TRACKERS)
+        self._stats = {}  # tracker -> [announces answered, announces failed]
+        self._fetched_at = 0
+        self._mtime_ns = None
+        self._saved_at = 0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def trackers(self, limit: Optional[int] = None) -> list:
+        """Known trackers, best first."""
+        self._reload()
+        with self._lock:
+            if time.time() - self._fetched_at > self.ttl and not self._refreshing:
+                self._refreshing = True
+                threading.Thread(target=self.refresh, daemon=True).start()
+            order = {tracker: index for index, tracker in enumerate(self._trackers)}
+            ranked = sorted(self._trackers, key=lambda tracker: (-self._score(tracker), order[tracker]))
+        return ranked[:limit] if limit else ranked
+
+    def record_announce(self, url: str, success: bool):
+        tracker = normalize_tracker(url)
+        if tracker is None:
+            return
+        with self._lock:
+            self._stats.setdefault(tracker, [0, 0])[0 if success else 1] += 1
+            due = time.time() - self._saved_at > self.save_interval
+        if due:
+            self.save()
+
+    def refresh(self):
+        """Fetch the tracker lists; the current list stays if none of them answers."""
+        try:
+            fetched = []
+            for source in self.sources:
+                try:
+                    response = requests.get(source, timeout=self.timeout)
+                    response.raise_for_status()
+                    fetched.extend(response.text.splitlines())
+                except requests.RequestException as e:
+                    logging.error(f"Error getting trackers from {source}: {e}")
+
+            trackers = list(dict.fromkeys(filter(None, map(normalize_tracker, fetched))))
+            with self._lock:
+                if trackers:
+                    self._trackers = trackers
+                # Retry a failed fetch after one more ttl, not on every read
+                self._fetched_at = time.time()
+            self.save()
+        finally:
+            self._refreshing = False
+
+    def _score(self, tracker: str) -> float:
+        answered, failed = self._stats.get(tracker, (0, 0))
+        # Trackers never tried rank as even odds
+        return (answered + 1) / (answered + failed + 2)
+
+    def _reload(self):
+        try:
+            mtime_ns = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime_ns == self._mtime_ns:
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f"Error reading tracker list {self.path}: {e}")
+            return
+        with self._lock:
+            self._mtime_ns = mtime_ns
+            if data.get('trackers'):
+                self._trackers = data['trackers']
+            self._fetched_at = max(self._fetched_at, data.get('fetched_at', 0))
+            for tracker, counts in data.get('stats', {}).items():
+                # Keep whichever process has seen more announces
+                if sum(counts) > sum(self._stats.get(tracker, (0, 0))):
+                    self._stats[tracker] = list(counts)
+
+    def save(self):
+        with self._lock:
+            data = {
+                'fetched_at': self._fetched_at,
+                'trackers': self._trackers,
+                'stats': {tracker: counts for tracker, counts in self._stats.items() if tracker in self._trackers},
+            }
+            self._saved_at = time.time()
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+            self._mtime_ns = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            logging.error(f"Error writing tracker list {self.path}: {e}")
+
+
+tracker_registry = TrackerRegistry(os.path.join(settings.DOWNLOAD_PATH, '.trackers.json'), settings.TRACKER_LIST_TTL)
@@ -1,5 +1,6 @@
-from django.urls import path, include
+from django.urls import path, re_path, include
 from rest_framework.routers import DefaultRouter
+from . import async_views
 from .views import VideoViewSet, SubtitleViewSet
 
 router = DefaultRouter()
@@ -7,5 +8,16 @@ router.register(r"video", VideoViewSet, basename="video")
 router.register(r"subtitles", SubtitleViewSet, basename="subtitle")
 
 urlpatterns = [
+    # Long-lived and frequently polled endpoints run as async views under ASGI
+    path("video/<int:pk>/stream/", async_views.video_stream, name="video-stream"),
+    path("video/<int:pk>/master.m3u8", async_views.video_master_playlist, name="video-master-playlist"),
+    path("video/<int:pk>/playlist.m3u8", async_views.video_playlist, name="video-playlist"),
+    path("video/<int:pk>/status/", async_views.video_status, name="video-status"),
+    path("video/<int:pk>/events/", async_views.video_events, name="video-events"),
+    re_path(
+        r"^subtitles/(?P<movie_id>\d+)/file/(?P<language>\w+)/$",
+        async_views.subtitle_file,
+        name="subtitle-serve-file",
+    ),
     path("", include(router.urls)),
 ]
@@ -1,28 +1,66 @@
 
-from rest_framework import viewsets, status, permissions
+from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from .services import VideoService
-import re
-import os, sys
-from django.utils import timezone
+from .readiness import SegmentReadiness
+from .scheduler import QueueFull, SegmentJob, download_queue, transcode_pool
+from .events import event_bus
+from .manifest import manifest_path_for, manifest_store, render_master_playlist, render_playlist
+from .probe import probe_cache
+from .progress import progress_flusher
+from .cache import movie_cache
+from .daemon import DaemonError, torrent_daemon
+import os
 import threading
+import fcntl
+from concurrent.futures import ThreadPoolExecutor
 import libtorrent as lt
 import logging
 import time
 from .models import MovieFile
-from rest_framework.pagination import PageNumberPagination
 from .services import SubtitleService
-from .utils import get_trackers, make_magnet_link
+from .utils import make_magnet_link
+from .trackers import normalize_tracker, tracker_registry
 from django.conf import settings
-from django.http import Http404, HttpResponse
-range_re = re.compile(r"bytes\s*=\s*(\d+)\s*-\s*(\d*)", re.I)
 
 logger = logging.getLogger(__name__)
 
+# libtorrent download priorities
+DONT_DOWNLOAD = 0
+DEFAULT_PRIORITY = 4
+TOP_PRIORITY = 7
+
+# Movies whose processing thread was still running when the process stopped
+RESUMABLE_STATUSES = ["PENDING", "DOWNLOADING", "DL_AND_CONVERT", "CONVERTING", "PLAYABLE"]
+
+# Movies that are already being processed or done; starting them again is a no-op. Queued
+# ones are submitted again, which counts one more viewer waiting for them.
+STARTED_STATUSES = ["DOWNLOADING", "DL_AND_CONVERT", "CONVERTING", "PLAYABLE", "READY"]
+
 class TorrentSessionManager:
     _instance = None
     _lock = threading.Lock()
+    # Orders a movie's QUEUED status before the DOWNLOADING status written when it starts
+    _start_lock = threading.RLock()
+
+    # Fetched before anything else so ffmpeg can open the file and find its index
+    header_bytes = 4 * 1024 * 1024
+    tail_bytes = 8 * 1024 * 1024
+    # How far ahead of the playhead pieces get download deadlines
+    playhead_window_segments = 6
+    # Fast-resume files ({movie_id}.fastresume) and the session's DHT state and settings
+    resume_dir = os.path.join(settings.DOWNLOAD_PATH, '.resume')
+    resume_interval = 60
+    # Seconds between torrent status updates handed to the movie pipelines
+    status_interval = 1
+    alert_mask = (
+        lt.alert.category_t.status_notification
+        | lt.alert.category_t.piece_progress_notification
+        | lt.alert.category_t.storage_notification
+        | lt.alert.category_t.error_notification
+        | lt.alert.category_t.tracker_notification
+    )
 
     def __new__(cls):
         with cls._lock:
@@ -33,207 +71,1013 @@ class TorrentSessionManager:
 
     def _initialize(self):
         self.session = lt.session()
+        self._load_session_state()
+        self.session.apply_settings({'alert_mask': self.alert_mask})
         self.session.listen_on(6881, 6891)
-        self.handles = {}
-        self.handle_locks = {}
+        # Torrents are keyed by info-hash, so one torrent added by several requests, with
+        # different tracker lists, is one handle in one swarm. It stays in the session while
+        # a movie holds it or a pipeline drives it.
+        self.handles = {}  # info-hash -> torrent handle
+        self.streams = {}
+        self.movie_handles = {}
+        self.handle_movies = {}  # info-hash -> ids of the movies holding the torrent
+        self.playhead_windows = {}
+        self.pipelines = {}  # torrent handle -> MoviePipelines driven by its alerts
+        self.movie_leaders = {}  # movie id -> id of the movie whose pipeline it follows
+        self._alert_thread = threading.Thread(target=self._alert_loop, daemon=True)
+        self._alert_thread.start()
         self._cleanup_thread = threading.Thread(target=self._cleanup_loop, daemon=True)
         self._cleanup_thread.start()
+        self._resume_thread = threading.Thread(target=self._resume_loop, daemon=True)
+        self._resume_thread.start()
 
     def _cleanup_loop(self):
         while True:
             try:
-                with self._lock:
-                    for handle_id, handle in list(self.handles.items()):
-                        if handle.is_valid() and handle.status().is_seeding:
-                            if handle.status().active_time > 3600:
-                                self.remove_torrent(handle_id)
+                movie_cache.evict(release=self.release_movie, in_use=self.movie_in_use)
             except Exception as e:
                 logging.error(f"Error in cleanup loop: {str(e)}")
             time.sleep(300)
 
-    def add_torrent(self, magnet_link, save_path):
+    def _alert_loop(self):
+        """
+        The one thread that drives every torrent: wait for libtorrent alerts and hand
+        them to the movie pipelines, asking for status updates once per interval.
+        """
+        last_update = 0
+        while True:
+            try:
+                if time.time() - last_update >= self.status_interval:
+                    # Answered with one state_update_alert holding every torrent that changed
+                    self.session.post_torrent_updates()
+                    last_update = time.time()
+                    # Stalled torrents send no updates, so they are looked for here
+                    self._check_stalls(last_update)
+                self.session.wait_for_alert(int(self.status_interval * 1000))
+                alerts = self.session.pop_alerts()
+            except Exception as e:
+                logging.error(f"Error reading torrent alerts: {str(e)}")
+                time.sleep(self.status_interval)
+                continue
+            for alert in alerts:
+                try:
+                    self._dispatch(alert)
+                except Exception as e:
+                    logging.error(f"Error handling {type(alert).__name__}: {str(e)}")
+
+    def _check_stalls(self, now):
+        with self._lock:
+            pipelines = [pipeline for pipelines in self.pipelines.values() for pipeline in pipelines]
+        for pipeline in pipelines:
+            pipeline.check_stalled(now)
+
+    def _dispatch(self, alert):
+        if isinstance(alert, lt.state_update_alert):
+            for status in alert.status:
+                for pipeline in tuple(self.pipelines.get(status.handle, ())):
+                    pipeline.on_status(status)
+            return
+        if isinstance(alert, (lt.save_resume_data_alert, lt.save_resume_data_failed_alert)):
+            self._resume_data_saved(alert)
+            return
+        if isinstance(alert, lt.tracker_reply_alert):
+            tracker_registry.record_announce(alert.tracker_url(), True)
+            return
+        if isinstance(alert, lt.tracker_error_alert):
+            tracker_registry.record_announce(alert.tracker_url(), False)
+            return
+        if isinstance(alert, lt.torrent_error_alert):
+            logging.error(f"Torrent error: {alert.message()}")
+
+        if not isinstance(alert, lt.torrent_alert):
+            return
+        for pipeline in tuple(self.pipelines.get(alert.handle, ())):
+            if isinstance(alert, lt.metadata_received_alert):
+                pipeline.on_metadata()
+            elif isinstance(alert, lt.piece_finished_alert):
+                pipeline.on_piece_finished(alert.piece_index)
+            elif isinstance(alert, lt.state_changed_alert):
+                pipeline.on_state_changed(alert.state)
+            elif isinstance(alert, lt.torrent_finished_alert):
+                pipeline.on_finished()
+
+    def start_pipeline(self, movie_id, viewer=True):
+        """
+        Start downloading and segmenting a movie once the download queue admits it.
+        Returns its queue position, 0 when it runs; raises QueueFull.
+        """
+        imdb_id = MovieFile.objects.filter(id=movie_id).values_list('imdb_id', flat=True).first()
+        key = imdb_id or movie_id
+        with self._start_lock:
+            position = download_queue.submit(
+                key, movie_id, lambda: self._run_pipeline(movie_id, key), viewer=viewer
+            )
+            if position:
+                movie_file = MovieFile.objects.get(id=movie_id)
+                movie_file.download_status = "QUEUED"
+                progress_flusher.record(movie_file, "download_status")
+                publish_movie_status(movie_file)
+        return position
+
+    def _run_pipeline(self, movie_id, key):
+        with self._start_lock:
+            pipeline = MoviePipeline(self, movie_id, key)
+        pipeline.start()
+
+    def attach_pipeline(self, handle, pipeline):
+        with self._lock:
+            self.pipelines.setdefault(handle, []).append(pipeline)
+
+    def leading_pipeline(self, handle, movie_id):
+        """The running pipeline of another movie that already downloads this torrent, if any."""
+        with self._lock:
+            return next((pipeline for pipeline in self.pipelines.get(handle, ())
+                         if pipeline.movie_id != movie_id and pipeline.state != "DONE"), None)
+
+    def follow(self, movie_id, leader_id):
+        with self._lock:
+            self.movie_leaders[movie_id] = leader_id
+
+    def leader_of(self, movie_id):
+        """Movie whose pipeline segments for ``movie_id``: itself unless it shares another's torrent."""
+        return self.movie_leaders.get(movie_id, movie_id)
+
+    def pipeline_done(self, pipeline):
+        if pipeline.handle is None:
+            return
+        with self._lock:
+            pipelines = self.pipelines.get(pipeline.handle, [])
+            if pipeline in pipelines:
+                pipelines.remove(pipeline)
+            self._remove_if_unused(pipeline.handle_id)
+
+    @staticmethod
+    def handle_id_for(info_hashes):
+        """Registry key of a torrent: the hex info-hash, v1 unless it only has a v2 one."""
+        return str(info_hashes.get_best())
+
+    def add_torrent(self, magnet_link, save_path, movie_id=None):
+        """
+        Add a torrent for ``movie_id`` and return its id. A torrent that is already in
+        the session is shared instead: the movie takes a reference on its handle and
+        the trackers of this magnet link are added to it.
+        """
         params = lt.parse_magnet_uri(magnet_link)
+        handle_id = self.handle_id_for(params.info_hashes)
+        trackers = list(zip(params.trackers, params.tracker_tiers))
+        if movie_id is not None:
+            # Resume data carries the metadata and which pieces are on disk, so nothing is rechecked
+            params = self._resume_params(movie_id, params) or params
         params.save_path = save_path
 
         with self._lock:
-            handle = self.session.add_torrent(params)
-            handle_id = str(hash(magnet_link))
-            self.handles[handle_id] = handle
-            self.handle_locks[handle_id] = threading.Lock()
+            handle = self.handles.get(handle_id)
+            if handle is not None and handle.is_valid():
+                self._merge_trackers(handle, trackers)
+            else:
+                self.handles[handle_id] = self.session.add_torrent(params)
+            if movie_id is not None:
+                # The movie may have been started again with another magnet link
+                previous = self.movie_handles.get(movie_id)
+                if previous and previous != handle_id:
+                    self.handle_movies.get(previous, set()).discard(movie_id)
+                    self._remove_if_unused(previous)
+                self.movie_handles[movie_id] = handle_id
+                self.handle_movies.setdefault(handle_id, set()).add(movie_id)
             return handle_id
 
+    def _merge_trackers(self, handle, trackers):
+        known = {normalize_tracker(tracker['url']) for tracker in handle.trackers()}
+        for url, tier in trackers:
+            if normalize_tracker(url) not in known:
+                handle.add_tracker({'url': url, 'tier': tier})
+                known.add(normalize_tracker(url))
+
     def get_handle(self, handle_id):
         return self.handles.get(handle_id)
 
-    def get_handle_lock(self, handle_id):
-        return self.handle_locks.get(handle_id)
+    def save_path(self, handle_id):
+        """Directory the torrent downloads to, that of the movie which added it first."""
+        handle = self.handles.get(handle_id)
+        return handle.status().save_path if handle is not None and handle.is_valid() else None
+
+    def prepare_streaming(self, handle_id, movie_id, readiness):
+        """
+        Download only the streamed file and fetch its header and tail first, where
+        containers keep their track headers and indexes (moov atom, MKV cues).
+        """
+        handle = self.handles.get(handle_id)
+        if not handle:
+            return
+        files = readiness.torrent_info.files()
+        # The rest of the file keeps the default priority, so the playhead window set
+        # on top of it, and handed back to it, is the only part above it
+        handle.prioritize_files([
+            DEFAULT_PRIORITY if index == readiness.file_index else DONT_DOWNLOAD
+            for index in range(files.num_files())
+        ])
+        file_size = readiness.file_size
+        urgent = list(readiness.pieces(0, min(self.header_bytes, file_size)))
+        urgent += list(readiness.pieces(max(0, file_size - self.tail_bytes), file_size))
+        for piece in dict.fromkeys(urgent):
+            handle.set_piece_deadline(piece, 0)
 
-    def remove_torrent(self, handle_id):
         with self._lock:
-            if handle_id in self.handles:
-                handle = self.handles[handle_id]
-                if handle.is_valid():
-                    self.session.remove_torrent(handle)
-                del self.handles[handle_id]
-                del self.handle_locks[handle_id]
+            self.streams[handle_id] = readiness
+            self.movie_handles[movie_id] = handle_id
 
-torrent_manager = TorrentSessionManager()
+    def handle_for_movie(self, movie_id):
+        return self.movie_handles.get(movie_id)
 
+    def set_playhead(self, handle_id, segment):
+        """
+        Give the pieces of the next ``playhead_window_segments`` segments after ``segment``
+        top priority and staggered deadlines, and release the previous window.
+        """
+        handle = self.handles.get(handle_id)
+        readiness = self.streams.get(handle_id)
+        if not handle or not readiness or not readiness.duration:
+            return
 
-def process_video_thread(video_id):
-    try:
-        movie_file = MovieFile.objects.get(id=video_id)
-        movie_file.download_status = "DOWNLOADING"
-        movie_file.save()
+        start, stop = readiness.byte_range(segment, segment + self.playhead_window_segments)
+        window = [piece for piece in readiness.pieces(start, stop) if not handle.have_piece(piece)]
+        window_ms = self.playhead_window_segments * readiness.segment_duration * 1000
 
-        # Create standardized movie directory
-        downloads_dir = "/app/downloads"
-        movie_dir = os.path.join(downloads_dir, "movies", str(movie_file.id))
-        os.makedirs(movie_dir, exist_ok=True)
-        logging.info(f"Using movie directory: {movie_dir}")
+        with self._lock:
+            previous = self.playhead_windows.get(handle_id, set())
+            self.playhead_windows[handle_id] = set(window)
+        for piece in previous.difference(window):
+            if not handle.have_piece(piece):
+                handle.reset_piece_deadline(piece)
+                handle.piece_priority(piece, DEFAULT_PRIORITY)
+        for i, piece in enumerate(window):
+            handle.piece_priority(piece, TOP_PRIORITY)
+            handle.set_piece_deadline(piece, int(i * window_ms / len(window)))
 
-        handle_id = torrent_manager.add_torrent(movie_file.magnet_link, movie_dir)
-        handle = torrent_manager.get_handle(handle_id)
-        handle_lock = torrent_manager.get_handle_lock(handle_id)
+    def movie_in_use(self, movie_id):
+        """Whether a torrent or a pipeline of this process still works on the movie's files."""
+        with self._lock:
+            if movie_id in self.movie_handles:
+                return True
+            if any(pipeline.movie_id == movie_id for pipelines in self.pipelines.values() for pipeline in pipelines):
+                return True
+        return download_queue.position(movie_id) is not None
 
-        if not handle:
-            logging.error(f"Failed to get torrent handle for movie {video_id}")
-            movie_file.download_status = "ERROR"
-            movie_file.save()
+    def release_movie(self, movie_id):
+        """Drop the pipeline, download slot and torrent of a movie whose files are about to be deleted."""
+        with self._lock:
+            pipelines = [pipeline for pipelines in self.pipelines.values() for pipeline in pipelines
+                         if pipeline.movie_id == movie_id]
+        for pipeline in pipelines:
+            pipeline.stop()
+        download_queue.release_movie(movie_id)
+        event_bus.forget(movie_id)
+        handle_id = self.movie_handles.get(movie_id)
+        if handle_id:
+            self.remove_torrent(handle_id, movie_id)
+
+    def remove_torrent(self, handle_id, movie_id=None):
+        """
+        Drop ``movie_id``'s reference on a torrent, or every reference when it is None.
+        The torrent leaves the session once no movie holds it and no pipeline drives it.
+        """
+        with self._lock:
+            movie_ids = self.handle_movies.get(handle_id, set())
+            released = set(movie_ids) if movie_id is None else movie_ids & {movie_id}
+            for released_id in released:
+                movie_ids.discard(released_id)
+                self.movie_leaders.pop(released_id, None)
+                if self.movie_handles.get(released_id) == handle_id:
+                    del self.movie_handles[released_id]
+                self._remove_resume_file(released_id)
+            if movie_id is None:
+                handle = self.handles.get(handle_id)
+                if handle is not None:
+                    self.pipelines.pop(handle, None)
+            self._remove_if_unused(handle_id)
+
+    def _remove_if_unused(self, handle_id):
+        handle = self.handles.get(handle_id)
+        if handle is None or self.handle_movies.get(handle_id) or self.pipelines.get(handle):
             return
+        if handle.is_valid():
+            self.session.remove_torrent(handle)
+        del self.handles[handle_id]
+        self.handle_movies.pop(handle_id, None)
+        self.pipelines.pop(handle, None)
+        self.streams.pop(handle_id, None)
+        self.playhead_windows.pop(handle_id, None)
 
-        with handle_lock:
-            handle.set_sequential_download(True)
-            while not handle.has_metadata():
-                time.sleep(1)
+    def resume_path(self, movie_id):
+        return os.path.join(self.resume_dir, f"{movie_id}.fastresume")
 
-            torrent_info = handle.get_torrent_info()
-            largest_file = max(torrent_info.files(), key=lambda f: f.size)
-            file_path_in_torrent = largest_file.path
-            downloaded_path = os.path.join(movie_dir, file_path_in_torrent)
-            
-            # Store the full relative path including any subdirectories
-            movie_file.file_path = os.path.join("movies", str(movie_file.id), file_path_in_torrent)
-            movie_file.save()
+    def _resume_params(self, movie_id, magnet_params):
+        try:
+            with open(self.resume_path(movie_id), 'rb') as f:
+                params = lt.read_resume_data(f.read())
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.error(f"Ignoring resume data of movie {movie_id}: {e}")
+            return None
+        # The movie may have been started again with another magnet link
+        if str(params.info_hashes.v1) != str(magnet_params.info_hashes.v1):
+            return None
+        return params
+
+    def _remove_resume_file(self, movie_id):
+        try:
+            os.remove(self.resume_path(movie_id))
+        except FileNotFoundError:
+            pass
+
+    def _write_atomic(self, path, data):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _load_session_state(self):
+        try:
+            with open(os.path.join(self.resume_dir, 'session.state'), 'rb') as f:
+                self.session.load_state(lt.bdecode(f.read()))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.error(f"Ignoring saved torrent session state: {e}")
+
+    def save_resume_data(self):
+        """
+        Ask for fast-resume data of every torrent that changed, written when the alert
+        loop receives it, and write the session state.
+        """
+        os.makedirs(self.resume_dir, exist_ok=True)
+        with self._lock:
+            handles = [self.handles[handle_id] for handle_id in self.handle_movies if handle_id in self.handles]
+        for handle in handles:
+            if handle.is_valid() and handle.status().has_metadata and handle.need_save_resume_data():
+                handle.save_resume_data(
+                    lt.save_resume_flags_t.flush_disk_cache | lt.save_resume_flags_t.save_info_dict
+                )
+        self._write_atomic(os.path.join(self.resume_dir, 'session.state'), lt.bencode(self.session.save_state()))
+
+    def _resume_data_saved(self, alert):
+        handle_id = self.handle_id_for(alert.handle.info_hashes())
+        with self._lock:
+            movie_ids = list(self.handle_movies.get(handle_id, ()))
+        for movie_id in movie_ids:
+            if isinstance(alert, lt.save_resume_data_alert):
+                self._write_atomic(self.resume_path(movie_id), lt.write_resume_data_buf(alert.params))
+            else:
+                logging.error(f"Could not save resume data of movie {movie_id}: {alert.message()}")
+
+    def _resume_loop(self):
+        while True:
+            time.sleep(self.resume_interval)
+            try:
+                self.save_resume_data()
+            except Exception as e:
+                logging.error(f"Error saving torrent resume data: {str(e)}")
+
+    def restore_downloads(self, process):
+        """
+        Call ``process(movie_id)`` for every movie with resume data whose download was
+        still running when the process stopped, then for every movie that was running
+        without resume data yet (it stopped before the first save or before the metadata
+        came), then for every movie that was still queued. Only one process per host
+        does this.
+        """
+        os.makedirs(self.resume_dir, exist_ok=True)
+        self._restore_lock = open(os.path.join(self.resume_dir, 'restore.lock'), 'w')
+        try:
+            fcntl.flock(self._restore_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+
+        def restore():
+            try:
+                movie_ids = [
+                    int(name[:-len('.fastresume')]) for name in os.listdir(self.resume_dir)
+                    if name.endswith('.fastresume') and name[:-len('.fastresume')].isdigit()
+                ]
+                resumable = set(MovieFile.objects.filter(
+                    id__in=movie_ids, download_status__in=RESUMABLE_STATUSES
+                ).values_list('id', flat=True))
+                for movie_id in movie_ids:
+                    if movie_id not in resumable:
+                        self._remove_resume_file(movie_id)
+                        continue
+                    logging.info(f"Resuming download of movie {movie_id}")
+                    process(movie_id)
+                # start_stream refuses these as started, so they would be stuck for good.
+                # PENDING ones never started or were evicted, and wait for a viewer.
+                stranded = (
+                    MovieFile.objects.filter(download_status__in=RESUMABLE_STATUSES)
+                    .exclude(download_status="PENDING").exclude(id__in=movie_ids)
+                    .order_by('id').values_list('id', flat=True)
+                )
+                for movie_id in stranded:
+                    logging.info(f"Restarting download of movie {movie_id}, it has no resume data")
+                    process(movie_id)
+                queued = MovieFile.objects.filter(download_status="QUEUED").order_by('id').values_list('id', flat=True)
+                for movie_id in queued:
+                    process(movie_id)
+            except QueueFull as e:
+                logging.error(f"Stopped restoring downloads: {str(e)}")
+            except Exception as e:
+                logging.error(f"Error restoring downloads: {str(e)}")
+
+        threading.Thread(target=restore, daemon=True).start()
+
+class MoviePipeline:
+    """
+    Download and segmenting state machine of one movie, driven by torrent alerts.
+
+    METADATA -> DOWNLOADING -> FINISHING -> DONE, or DONE with an error once nothing
+    arrived for ``stall_timeout`` seconds before FINISHING. A movie whose torrent another
+    movie's pipeline already downloads does not get a pipeline of its own: it follows
+    that one, sharing its file, segments and manifest and mirroring its status,
+    download progress and file path. The session manager's alert loop
+    calls ``on_metadata``, ``on_piece_finished``, ``on_state_changed``, ``on_finished``
+    and, about once a second, ``on_status``; none of them block. ffprobe, state
+    changes written to the database and starting seek jobs run on a small shared
+    pool, and only a movie that is FINISHING holds a thread while it waits for its
+    last segments, so idle downloads cost no thread at all.
+    """
+
+    probe_retry_interval = 2
+    stall_timeout = settings.DOWNLOAD_STALL_TIMEOUT
+    probe_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="probe")
+
+    def __init__(self, manager, movie_id, key):
+        self.manager = manager
+        self.movie_id = movie_id
+        self.key = key  # download queue slot
+        self.state = "METADATA"
+        self.movie_file = None
+        self.handle_id = None
+        self.handle = None
+        self.video_service = VideoService()
+        self.readiness = None
+        self.job = None
+        self.seek_jobs = []
+        self.available_bytes = 0
+        self.first_segment_ready = False
+        self.last_probe_time = 0
+        self.progress_at = time.time()  # last time metadata or new data arrived
+        self.downloaded_bytes = 0
+        self.probing = False
+        self.tending = None  # future of the last _tend_segmenter run
+        self.followers = []  # MovieFiles of other movies with the same torrent
+        self._lock = threading.RLock()
+
+    def start(self):
+        try:
+            self.movie_file = MovieFile.objects.get(id=self.movie_id)
+            # A title restored in the middle of playback stays playable
+            if self.movie_file.download_status != "PLAYABLE":
+                self.movie_file.download_status = "DOWNLOADING"
+                progress_flusher.record(self.movie_file, "download_status")
+            # Subtitles are ready by the time the first segment is
+            SubtitleService().prefetch(self.movie_file)
+
+            # Create standardized movie directory
+            downloads_dir = "/app/downloads"
+            self.movie_dir = os.path.join(downloads_dir, "movies", str(self.movie_id))
+            os.makedirs(self.movie_dir, exist_ok=True)
+            logging.info(f"Using movie directory: {self.movie_dir}")
+
+            self.handle_id = self.manager.add_torrent(self.movie_file.magnet_link, self.movie_dir, movie_id=self.movie_id)
+            self.handle = self.manager.get_handle(self.handle_id)
+            if not self.handle:
+                logging.error(f"Failed to get torrent handle for movie {self.movie_id}")
+                self.fail()
+                return
+            # Another movie with the same torrent may already be downloading it elsewhere
+            self.movie_dir = self.manager.save_path(self.handle_id) or self.movie_dir
+            leader = self.manager.leading_pipeline(self.handle, self.movie_id)
+            if leader is not None and leader.add_follower(self.movie_file):
+                # Its segmenter writes the same files, so this movie only mirrors it
+                self.manager.follow(self.movie_id, leader.movie_id)
+                logging.info(f"Movie {self.movie_id} follows movie {leader.movie_id}, which has the same torrent")
+                self.state = "DONE"
+                download_queue.release(self.key)
+                return
+
+            self.handle.set_sequential_download(True)
+            self.manager.attach_pipeline(self.handle, self)
+            # Resumed torrents come back with their metadata and never send the alert
+            if self.handle.status().has_metadata:
+                self.on_metadata()
+        except Exception as e:
+            logging.error(f"Error processing video {self.movie_id}: {str(e)}")
+            self.fail()
+
+    def fail(self):
+        with self._lock:
+            self.state = "DONE"
+        if self.movie_file is not None:
+            self.movie_file.download_status = "ERROR"
+            progress_flusher.record(self.movie_file, "download_status")
+            self._publish_status()
+        self._release_followers()
+        download_queue.release(self.key)
+        self.manager.pipeline_done(self)
+
+    def stop(self):
+        """Stop a download that is still running, leaving the movie's status alone."""
+        with self._lock:
+            if self.state not in ("METADATA", "DOWNLOADING"):
+                return
+            self.state = "DONE"
+            jobs = [job for job in [self.job] + self.seek_jobs if job is not None]
+        for job in jobs:
+            transcode_pool.cancel(job)
+        self._release_followers()
+        download_queue.release(self.key)
+        self.manager.pipeline_done(self)
+
+    def check_stalled(self, now):
+        """
+        Give up on a download that got no metadata, or no new data, for ``stall_timeout``
+        seconds: a dead magnet or a torrent without seeds would hold its slot for good.
+        """
+        with self._lock:
+            if self.state not in ("METADATA", "DOWNLOADING") or now - self.progress_at < self.stall_timeout:
+                return
+            self.state = "DONE"
+        logging.error(f"Download of movie {self.movie_id} stalled for {self.stall_timeout}s, giving up")
+        # fail() writes to the database, so not on the alert loop
+        self.probe_pool.submit(self.fail)
+
+    def add_follower(self, movie_file):
+        """Let another movie with the same torrent share this pipeline; False once it is done."""
+        with self._lock:
+            if self.state == "DONE" or self.movie_file is None:
+                return False
+            self.followers.append(movie_file)
+        self._sync_followers()
+        return True
+
+    def _publish_status(self):
+        publish_movie_status(self.movie_file)
+        self._sync_followers()
+
+    def _sync_followers(self, fields=("download_status", "download_progress", "file_path")):
+        for follower in list(self.followers):
+            changed = [field for field in fields if getattr(follower, field) != getattr(self.movie_file, field)]
+            if not changed:
+                continue
+            for field in changed:
+                setattr(follower, field, getattr(self.movie_file, field))
+            progress_flusher.record(follower, *changed)
+            publish_movie_status(follower)
+
+    def _release_followers(self):
+        with self._lock:
+            followers, self.followers = self.followers, []
+        for follower in followers:
+            self.manager.remove_torrent(self.handle_id, follower.id)
+
+    def on_metadata(self):
+        with self._lock:
+            if self.state != "METADATA":
+                return
+            torrent_info = self.handle.get_torrent_info()
+            files = torrent_info.files()
+            self.file_index = max(range(files.num_files()), key=files.file_size)
+            self.file_path_in_torrent = files.file_path(self.file_index)
+            self.downloaded_path = os.path.join(self.movie_dir, self.file_path_in_torrent)
+
+            # A restored download may have its first segments on disk already
+            self.first_segment_ready = self._first_segment_on_disk()
+            if self.first_segment_ready:
+                if self.movie_file.download_status != "PLAYABLE":
+                    self.probe_pool.submit(self.mark_playable)
+            else:
+                # Store the full relative path including any subdirectories; written at once, so off this thread
+                self.movie_file.file_path = os.path.relpath(self.downloaded_path, settings.DOWNLOAD_PATH)
+                self.probe_pool.submit(progress_flusher.record, self.movie_file, "file_path")
 
             # Ensure the full directory structure exists
-            os.makedirs(os.path.dirname(downloaded_path), exist_ok=True)
+            os.makedirs(os.path.dirname(self.downloaded_path), exist_ok=True)
 
-            video_service = VideoService()
-            conversion_started = False
-            current_segment = 0
-            video_duration = None
-            first_segment_ready = False
-            last_attempt_time = 0
-
-            while True:
-                status = handle.status()
-                progress = status.progress * 100
-                movie_file.download_progress = progress
-                
-                # Try to start segmentation as soon as possible
-                if not conversion_started and os.path.exists(downloaded_path):
-                    current_time = time.time()
-                    if current_time - last_attempt_time > 2:
-                        last_attempt_time = current_time
-                        try:
-                            video_duration = video_service.get_video_duration(downloaded_path)
-                            if video_duration:
-                                conversion_started = True
-                                movie_file.download_status = "DL_AND_CONVERT"
-                                movie_file.save()
-                                logging.info(f"Starting segmentation at {progress:.2f}% for {file_path_in_torrent}")
-                        except Exception as e:
-                            logging.debug(f"File not ready yet: {e}")
-
-                if conversion_started and video_duration:
-                    segment_start_time = current_segment * video_service.segment_duration
-                    required_progress = (segment_start_time + video_service.segment_duration) / video_duration * 100
-                    required_progress = min(required_progress + 5, 100)  # Small buffer for safety
-
-                    if progress >= required_progress:
-                        try:
-                            if current_segment not in video_service.processed_segments:
-                                success = video_service.convert_segment(
-                                    downloaded_path,
-                                    movie_dir,
-                                    current_segment,
-                                    video_duration
-                                )
-                                if success:
-                                    current_segment += 1
-                                    if current_segment == 1:
-                                        # Get the directory structure from the original file path
-                                        rel_path = os.path.relpath(downloaded_path, movie_dir)
-                                        dir_path = os.path.dirname(rel_path)
-                                        base_name = os.path.splitext(os.path.basename(rel_path))[0]
-                                        
-                                        # Create segment path preserving directory structure
-                                        first_segment = f"{base_name}_segment_000.mp4"
-                                        if dir_path:
-                                            first_segment = os.path.join(dir_path, first_segment)
-                                        
-                                        movie_file.file_path = os.path.join("movies", str(movie_file.id), first_segment)
-                                        movie_file.download_status = "PLAYABLE"
-                                        first_segment_ready = True
-                                        movie_file.save()
-                                        logging.info("First segment ready, movie is now playable")
-                        except Exception as e:
-                            logging.error(f"Error converting segment {current_segment}: {e}")
-                            if video_service.segment_retry_count.get(current_segment, 0) >= video_service.max_retries:
-                                current_segment += 1
-
-                movie_file.save()
-                logging.info(f"Download progress: {progress:.2f}%")
-
-                if status.is_seeding:
-                    break
-
-                time.sleep(1)
-
-            # Process remaining segments after download is complete
-            if video_duration:
-                remaining_segments = int(video_duration / video_service.segment_duration) + 1
-                while current_segment < remaining_segments:
-                    try:
-                        if current_segment not in video_service.processed_segments:
-                            success = video_service.convert_segment(
-                                downloaded_path,
-                                movie_dir,
-                                current_segment,
-                                video_duration
-                            )
-                            if success:
-                                current_segment += 1
-                            elif video_service.segment_retry_count.get(current_segment, 0) >= video_service.max_retries:
-                                current_segment += 1
-                    except Exception as e:
-                        logging.error(f"Error converting final segments: {e}")
-                        if video_service.segment_retry_count.get(current_segment, 0) >= video_service.max_retries:
-                            current_segment += 1
-                    time.sleep(1)
-
-            if not video_service.failed_segments:
-                movie_file.download_status = "READY"
+            self.readiness = SegmentReadiness(self.handle, torrent_info, self.file_index,
+                                              self.video_service.segment_duration)
+            self.manager.prepare_streaming(self.handle_id, self.movie_id, self.readiness)
+            self.state = "DOWNLOADING"
+            self.progress_at = time.time()
+        if self.handle.status().is_finished:
+            self.on_finished()
+
+    def on_piece_finished(self, piece):
+        with self._lock:
+            if self.state == "DOWNLOADING" and self.job is not None:
+                # Feed ffmpeg every byte whose pieces have arrived
+                self.available_bytes = self.readiness.contiguous_bytes(self.available_bytes)
+                self.job.engine.advance(self.available_bytes)
+
+    def on_state_changed(self, state):
+        # Torrents resumed complete may never send torrent_finished
+        if state in (lt.torrent_status.states.finished, lt.torrent_status.states.seeding):
+            self.on_finished()
+
+    def on_status(self, status):
+        with self._lock:
+            if self.state != "DOWNLOADING":
+                return
+            progress = status.progress * 100
+            self.movie_file.download_progress = progress
+            if status.total_wanted_done > self.downloaded_bytes:
+                self.downloaded_bytes = status.total_wanted_done
+                self.progress_at = time.time()
+            self.available_bytes = self.readiness.contiguous_bytes(self.available_bytes)
+
+            # Start the segmenter as soon as the downloaded head of the file can be probed
+            if (
+                self.job is None and not self.probing and self.available_bytes > 0
+                and time.time() - self.last_probe_time > self.probe_retry_interval
+            ):
+                self.probing = True
+                self.last_probe_time = time.time()
+                self.probe_pool.submit(self._start_segmenter)
+
+            if self.job is not None:
+                self.job.engine.advance(self.available_bytes)
+                if self.tending is None or self.tending.done():
+                    self.tending = self.probe_pool.submit(self._tend_segmenter)
+
+            progress_flusher.record(self.movie_file, "download_progress")
+            publish_movie_status(self.movie_file)
+            # Status and file path changes are mirrored where they happen, off this thread
+            self._sync_followers(("download_progress",))
+            logging.debug(f"Download progress of movie {self.movie_id}: {progress:.2f}%")
+
+    def _start_segmenter(self):
+        try:
+            # The file grows while it downloads, so one ffprobe serves the whole attempt
+            with probe_cache.pinned(self.downloaded_path):
+                if not self.video_service.get_video_duration(self.downloaded_path):
+                    return
+                record = self.video_service.probe(self.downloaded_path)
+                # Planning the streams may run ffprobe, so the alert loop is not kept waiting on the lock
+                if self.video_service.pipe_readable(self.downloaded_path):
+                    engine, is_ready = self.video_service.create_engine(self.downloaded_path, pipe=True), None
+                else:
+                    logging.info(f"{self.file_path_in_torrent} cannot be read as a stream, "
+                                 f"segmenting it from the file")
+                    engine, is_ready = self._file_chunk(0)
+                    if engine is None:
+                        return
+            with self._lock:
+                if self.state != "DOWNLOADING" or self.job is not None:
+                    return
+                self.readiness.update_probe(record)
+                self.manager.set_playhead(self.handle_id, transcode_pool.playhead(self.movie_id))
+                self.job = transcode_pool.submit(SegmentJob(self.movie_id, engine, is_ready=is_ready))
+                playable = self.first_segment_ready
+                if not playable:
+                    self.movie_file.download_status = "DL_AND_CONVERT"
+            if not playable:
+                progress_flusher.record(self.movie_file, "download_status")
+                self._sync_followers()
+            logging.info(f"Starting segmentation at {self.movie_file.download_progress:.2f}% "
+                         f"for {self.file_path_in_torrent}")
+        except Exception as e:
+            logging.debug(f"File not ready yet: {e}")
+        finally:
+            self.probing = False
+
+    def _tend_segmenter(self):
+        """
+        Mark the movie playable once its first segment is out and start seek jobs:
+        both write to the database or run ffprobe, so never on the alert loop.
+        """
+        try:
+            if not self.first_segment_ready and 0 in self.job.engine.published:
+                self.first_segment_ready = True
+                self.mark_playable()
+            with probe_cache.pinned(self.downloaded_path):
+                self._continue_segmenter()
+                self._seek_to_playhead()
+        except Exception as e:
+            logging.error(f"Error following the segmenter of movie {self.movie_id}: {str(e)}")
+
+    def _file_chunk(self, first):
+        """Engine and readiness check for the next chunk of segments cut from the file, or None."""
+        total = self.video_service.total_segments(self.downloaded_path)
+        if first >= total:
+            return None, None
+        end = min(first + self.video_service.chunk_segments, total)
+        engine = self.video_service.create_engine(self.downloaded_path, start_segment=first, end_segment=end)
+        return engine, lambda: self.readiness.is_ready(first, end)
+
+    def _continue_segmenter(self):
+        # A file ffmpeg cannot read as a stream, or whose streaming run failed, is cut
+        # from the file a chunk at a time, each as soon as its pieces are on disk. A
+        # failed chunk is left to _convert_remaining.
+        job = self.job
+        # Still running, done streaming the whole file, or a failed chunk
+        if not job.is_done() or job.success == job.engine.pipe:
+            return
+        engine, is_ready = self._file_chunk(job.engine.next_segment())
+        if engine is None:
+            return
+        with self._lock:
+            if self.state != "DOWNLOADING" or self.job is not job:
+                return
+            self.job = transcode_pool.submit(SegmentJob(self.movie_id, engine, is_ready=is_ready))
+
+    def _seek_to_playhead(self):
+        # A viewer jumped past what the streaming segmenter has reached: segment
+        # that part on its own as soon as exactly its pieces are on disk
+        playhead = transcode_pool.playhead(self.movie_id)
+        if (
+            playhead > self.job.engine.next_segment() + 1
+            and not os.path.exists(self.job.engine.segment_path(playhead))
+            and not any(seek_job.engine.start_segment <= playhead < seek_job.end_segment
+                        for seek_job in self.seek_jobs)
+        ):
+            end = min(playhead + self.video_service.chunk_segments,
+                      self.video_service.total_segments(self.downloaded_path))
+            # _convert_remaining waits for this run before it reads seek_jobs
+            if self.state != "DOWNLOADING":
+                return
+            self.seek_jobs.append(self.video_service.submit_segments(
+                self.movie_id, self.downloaded_path, playhead, end,
+                is_ready=lambda first=playhead, end=end: self.readiness.is_ready(first, end),
+            ))
+
+    def _first_segment_on_disk(self):
+        return manifest_store.get(manifest_path_for(self.downloaded_path)).segment(0) is not None
+
+    def mark_playable(self):
+        # Get the directory structure from the original file path
+        rel_path = os.path.relpath(self.downloaded_path, self.movie_dir)
+        dir_path = os.path.dirname(rel_path)
+        base_name = os.path.splitext(os.path.basename(rel_path))[0]
+
+        # Create segment path preserving directory structure
+        first_segment = f"{base_name}_segment_000.mp4"
+        if dir_path:
+            first_segment = os.path.join(dir_path, first_segment)
+
+        self.movie_file.file_path = os.path.relpath(os.path.join(self.movie_dir, first_segment), settings.DOWNLOAD_PATH)
+        self.movie_file.download_status = "PLAYABLE"
+        progress_flusher.record(self.movie_file, "file_path", "download_status")
+        self._publish_status()
+        logging.info("First segment ready, movie is now playable")
+
+    def on_finished(self):
+        with self._lock:
+            if self.state != "DOWNLOADING":
+                return
+            self.state = "FINISHING"
+            self.movie_file.download_progress = 100
+            progress_flusher.record(self.movie_file, "download_progress")
+        # The rest is transcoding, which the transcode pool bounds on its own
+        download_queue.release(self.key)
+        # Waiting for the remaining segments blocks, so it gets its own thread
+        threading.Thread(target=self._finish, daemon=True).start()
+
+    def _finish(self):
+        try:
+            self._convert_remaining()
+        except Exception as e:
+            logging.error(f"Error processing video {self.movie_id}: {str(e)}")
+            self.movie_file.download_status = "ERROR"
+            progress_flusher.record(self.movie_file, "download_status")
+            self._publish_status()
+        finally:
+            with self._lock:
+                self.state = "DONE"
+            # Followers end with this movie's final status
+            self._sync_followers()
+            self._release_followers()
+            # Only the streamed file is wanted, so the torrent is not kept around to seed
+            self.manager.remove_torrent(self.handle_id, self.movie_id)
+            self.manager.pipeline_done(self)
+
+    def _convert_remaining(self):
+        video_service = self.video_service
+        movie_file = self.movie_file
+        downloaded_path = self.downloaded_path
+
+        # No new seek job or playable mark can start once FINISHING; let the last one end
+        if self.tending is not None:
+            self.tending.result()
+
+        # The whole file is on disk now. If the streaming segmenter still has a long
+        # way to go, stop it and split the rest across the transcode pool.
+        next_segment = 0
+        job = self.job
+        if job is not None:
+            job.engine.advance(self.readiness.file_size, complete=True)
+            try:
+                remaining = video_service.total_segments(downloaded_path) - job.engine.next_segment()
+            except Exception:
+                remaining = 0
+            if remaining > video_service.chunk_segments:
+                transcode_pool.cancel(job)
+            if job.wait() and job.end_segment is None:
+                next_segment = None
+                video_service.finalize_playlist(downloaded_path)
             else:
-                if not first_segment_ready:
-                    movie_file.download_status = "ERROR"
-                logging.error(f"Failed segments: {sorted(list(video_service.failed_segments))}")
-            movie_file.save()
+                next_segment = job.engine.next_segment()
+            video_service.processed_segments.update(job.engine.published)
+        for seek_job in self.seek_jobs:
+            seek_job.wait()
+            video_service.processed_segments.update(seek_job.engine.published)
+
+        if next_segment is not None:
+            try:
+                if not self.first_segment_ready:
+                    movie_file.download_status = "CONVERTING"
+                    progress_flusher.record(movie_file, "download_status")
+                self._publish_status()
+                video_service.convert_to_mp4(downloaded_path, start_segment=next_segment, movie_id=self.movie_id,
+                                             on_progress=self._publish_status)
+            except Exception as e:
+                logging.error(f"Error converting final segments: {e}")
+
+        # Segments already in the manifest are skipped, not processed again
+        if not self.first_segment_ready and (0 in video_service.processed_segments
+                                             or self._first_segment_on_disk()):
+            self.first_segment_ready = True
+            self.mark_playable()
+
+        if not video_service.failed_segments and self.first_segment_ready:
+            movie_file.download_status = "READY"
+        else:
+            if not self.first_segment_ready:
+                movie_file.download_status = "ERROR"
+            logging.error(f"Failed segments: {sorted(list(video_service.failed_segments))}")
+        progress_flusher.record(movie_file, "download_status")
+        self._publish_status()
+
+        # The segments are all that is served from now on
+        if movie_file.download_status == "READY" and settings.MOVIE_STORAGE_MODE == "segments-only":
+            video_service.release_source(downloaded_path)
+
+
+def movie_manifest(movie_file):
+    """Segment manifest of a movie, found from the stored path of its first segment."""
+    return manifest_store.get(manifest_path_for(os.path.join("/app/downloads", movie_file.file_path)))
 
-    except Exception as e:
-        logging.error(f"Error processing video {video_id}: {str(e)}")
-        movie_file.download_status = "ERROR"
-        movie_file.save()
+
+def movie_status_data(movie_file):
+    """Status payload for a movie; served by the status view and pushed to event streams."""
+    progress_flusher.apply(movie_file)
+    response_data = {
+        "status": movie_file.download_status,
+        "progress": round(movie_file.download_progress, 1),
+        "file_path": movie_file.file_path,
+        "ready": movie_file.download_status in ["READY", "PLAYABLE"],
+        "downloading": movie_file.download_status in ["DOWNLOADING", "DL_AND_CONVERT"]
+    }
+    if movie_file.download_status == "QUEUED":
+        response_data["queue_position"] = queue_position(movie_file.id)
+    
+    # If movie is playable or ready, add segment information and total duration
+    if response_data["ready"]:
+        try:
+            manifest = movie_manifest(movie_file)
+            response_data["available_segments"] = manifest.available
+            response_data["total_duration"] = manifest.total_duration
+            response_data["segment_duration"] = manifest.segment_duration or VideoService().segment_duration
+        except Exception as e:
+            logging.error(f"Error reading segment manifest: {e}")
+
+    return response_data
+
+
+def publish_movie_status(movie_file):
+    """
+    Push a status snapshot to the movie's event stream subscribers.
+
+    The manifest is cached, so publishing every second costs one stat; unchanged
+    snapshots are dropped by the event bus.
+    """
+    event_bus.publish(movie_file.id, movie_status_data(movie_file))
+
+
+def segment_file_path(movie_file, segment):
+    """Full path of a published segment, or None if the segment is not available."""
+    return movie_manifest(movie_file).segment_path(segment)
+
+
+def rendition_file_path(movie_file, segment, name):
+    """Full path of a segment of a lower rendition, encoded on first request; None if unavailable."""
+    video_service = VideoService()
+    manifest = movie_manifest(movie_file)
+    rendition = video_service.rendition(manifest, name)
+    if rendition is None:
+        return None
+    return video_service.rendition_segment(manifest, rendition, segment)
+
+
+def prepare_rendition(movie_file, segment, throughput):
+    """Start encoding the rendition a viewer's measured throughput calls for, from the next segment on."""
+    video_service = VideoService()
+    manifest = movie_manifest(movie_file)
+    rendition = video_service.rendition_for_throughput(manifest, throughput)
+    if rendition is not None:
+        video_service.prefetch_rendition(manifest, rendition, segment + 1)
+
+
+def master_playlist(movie_file):
+    """HLS master playlist of a movie: the source and every lower rendition, best first."""
+    return render_master_playlist([
+        (f"playlist.m3u8?rendition={rendition.name}" if rendition else "playlist.m3u8", bandwidth, average, resolution)
+        for rendition, bandwidth, average, resolution in VideoService().variants(movie_manifest(movie_file))
+    ])
 
 
+def media_playlist(movie_file, name=None):
+    """HLS media playlist of the source or of a lower rendition; None for an unknown rendition."""
+    video_service = VideoService()
+    manifest = movie_manifest(movie_file)
+    if name and video_service.rendition(manifest, name) is None:
+        return None
+    query = f"&rendition={name}" if name else ""
+    return render_playlist(
+        manifest.playlist_segments(),
+        manifest.segment_duration or video_service.segment_duration,
+        manifest.finished,
+        uri=lambda segment, entry: f"stream/?segment={segment}{query}",
+        # Rendition segments are encoded on first request, so their init section is cut out then
+        init_map=lambda segment, entry: f'URI="stream/?segment={segment}{query}&init=1"',
+    )
+
+
+def start_movie_processing(movie_id, viewer=True):
+    """Queue a movie's pipeline in this process, unless it is already queued or runs."""
+    return TorrentSessionManager().start_pipeline(movie_id, viewer=viewer)
+
+
+def publish_queue_positions(movie_ids):
+    for movie_file in MovieFile.objects.filter(id__in=movie_ids, download_status="QUEUED"):
+        publish_movie_status(movie_file)
+
+
+download_queue.add_listener(publish_queue_positions)
+
+
+def prioritize_playhead(movie_id, segment):
+    """Pending transcodes and torrent pieces closest to what a viewer watches come first."""
+    torrent_manager = TorrentSessionManager()
+    transcode_pool.set_playhead(torrent_manager.leader_of(movie_id), segment)
+    handle_id = torrent_manager.handle_for_movie(movie_id)
+    if handle_id:
+        torrent_manager.set_playhead(handle_id, segment)
+
+
+# With a torrent daemon, the session and every pipeline live in that one process and
+# web workers only talk to it; otherwise each process runs its own.
+
+def start_movie(movie_id):
+    if torrent_daemon:
+        return torrent_daemon.start_movie(movie_id)
+    return start_movie_processing(movie_id)
+
+
+def update_playhead(movie_id, segment):
+    if torrent_daemon:
+        try:
+            torrent_daemon.set_playhead(movie_id, segment)
+        except DaemonError as e:
+            # Prioritising is best effort, the segment is served either way
+            logging.error(f"Could not update playhead of movie {movie_id}: {e}")
+    else:
+        prioritize_playhead(movie_id, segment)
+
+
+def queue_position(movie_id):
+    if torrent_daemon:
+        try:
+            return torrent_daemon.queue_position(movie_id)
+        except DaemonError as e:
+            logging.error(f"Could not get queue position of movie {movie_id}: {e}")
+            return None
+    return download_queue.position(movie_id)
+
+
+def restore_downloads():
+    """Pick up downloads that were running or queued when this process last stopped."""
+    if not torrent_daemon:
+        TorrentSessionManager().restore_downloads(
+            lambda movie_id: start_movie_processing(movie_id, viewer=False)
+        )
+
 
 class VideoViewSet(viewsets.ViewSet):
     """
     ViewSet for video operations.
     POST /video/{imdb}/start - Start movie download and processing data: {magnet_link, imdb_id}
-    GET /video/:id/status - Get movie streaming status
-    GET /video/:id/stream - Stream movie content
+    GET /video/:id/segments - Get segment information for the movie
+
+    GET /video/:id/status, GET /video/:id/events, GET /video/:id/stream and the HLS playlists
+    GET /video/:id/master.m3u8 and GET /video/:id/playlist.m3u8 are async views, see async_views.
     """
 
 
@@ -252,126 +1096,25 @@ class VideoViewSet(viewsets.ViewSet):
         movie_file, created = MovieFile.objects.get_or_create(
             imdb_id=imdb_id, defaults={"magnet_link": magnet_link, "download_status": "PENDING", "download_progress": 0}
         )
+        progress_flusher.apply(movie_file)
 
-        # If already processing or ready, return current status
-        if movie_file.download_status in ["DOWNLOADING", "CONVERTING", "READY"]:
-            return Response({"status": movie_file.download_status, "progress": movie_file.download_progress, "id": movie_file.id})
-
-        # Start processing in background thread
-        thread = threading.Thread(target=process_video_thread, args=(movie_file.id,))
-        thread.daemon = True
-        thread.start()
+        # If already queued, processing or ready, return current status
+        if movie_file.download_status in STARTED_STATUSES:
+            return Response({**movie_status_data(movie_file), "id": movie_file.id, "imdb_id": movie_file.imdb_id})
 
-        return Response({"status": "PENDING", "id": movie_file.id, "imdb_id": movie_file.imdb_id})
-
-    @action(detail=True, methods=["get"], url_path="status")
-    def status(self, request, pk=None):
-        """Get movie streaming status"""
+        # Queue it; the download starts as soon as a slot is free
         try:
-            movie_file = MovieFile.objects.get(id=pk)
-            
-            response_data = {
-                "status": movie_file.download_status,
-                "progress": movie_file.download_progress,
-                "file_path": movie_file.file_path,
-                "ready": movie_file.download_status in ["READY", "PLAYABLE"],
-                "downloading": movie_file.download_status in ["DOWNLOADING", "DL_AND_CONVERT"]
-            }
-            
-            # If movie is playable or ready, add segment information and total duration
-            if movie_file.download_status in ["READY", "PLAYABLE"]:
-                try:
-                    # Get the full path from the stored file path
-                    file_path = os.path.join("/app/downloads", movie_file.file_path)
-                    dir_path = os.path.dirname(file_path)
-                    base_name = os.path.splitext(os.path.basename(file_path))[0]
-                    
-                    # Remove _segment_000 suffix if it exists
-                    if base_name.endswith("_segment_000"):
-                        base_name = base_name[:-12]
-                    
-                    # Get total movie duration from original file
-                    original_file_path = None
-                    for ext in ['.mkv', '.mp4', '.avi']:
-                        test_path = os.path.join(dir_path, f"{base_name}{ext}")
-                        if os.path.exists(test_path):
-                            original_file_path = test_path
-                            break
-                    
-                    total_duration = None
-                    if original_file_path:
-                        video_service = VideoService()
-                        total_duration = video_service.get_video_duration(original_file_path)
-                    
-                    # Count available segments
-                    available_segments = 0
-                    while True:
-                        segment_filename = f"{base_name}_segment_{available_segments:03d}.mp4"
-                        segment_path = os.path.join(dir_path, segment_filename)
-                        if os.path.exists(segment_path):
-                            available_segments += 1
-                        else:
-                            break
-                    
-                    response_data["available_segments"] = available_segments
-                    response_data["total_duration"] = total_duration
-                    response_data["segment_duration"] = VideoService().segment_duration
-                except Exception as e:
-                    logging.error(f"Error counting segments: {e}")
-            
-            return Response(response_data)
-        except MovieFile.DoesNotExist:
-            return Response({"error": "Movie not found"}, status=status.HTTP_404_NOT_FOUND)
-
-    @action(detail=True, methods=["get"], url_path="stream")
-    def stream(self, request, pk=None):
-        """Stream movie content"""
-        try:
-            movie_file = MovieFile.objects.get(id=pk)
-
-            if movie_file.download_status not in ["READY", "PLAYABLE"]:
-                return Response(
-                    {"error": f"Movie is not ready for streaming (status: {movie_file.download_status})"},
-                    status=status.HTTP_400_BAD_REQUEST,
-                )
-
-            # Get segment parameter (default to 0 for first segment)
-            segment = int(request.query_params.get("segment", 0))
-            
-            # Get the full path structure from the stored file path
-            file_path = os.path.join("/app/downloads", movie_file.file_path)
-            
-            if segment != 0:  # For segments other than 0, we need to construct the segment path
-                dir_path = os.path.dirname(file_path)
-                base_name = os.path.splitext(os.path.basename(file_path))[0]
-                
-                if base_name.endswith("_segment_000"):
-                    base_name = base_name[:-12]
-                
-                segment_filename = f"{base_name}_segment_{segment:03d}.mp4"
-                file_path = os.path.join(dir_path, segment_filename)
-            
-            if not os.path.exists(file_path):
-                return Response({"error": f"Segment {segment} not found"}, status=status.HTTP_404_NOT_FOUND)
-
-            video_service = VideoService()
-
-            range_header = request.META.get("HTTP_RANGE", "").strip()
-            start_time = float(request.query_params.get("start", 0))
-
-            response = video_service.stream_video(
-                file_path=file_path,
-                range_header=range_header,
-                start_time=start_time
-            )
+            start_movie(movie_file.id)
+        except QueueFull as e:
+            logger.error(f"Could not queue movie {movie_file.id}: {e}")
+            return Response({"error": "Too many downloads waiting, try again later"},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": "60"})
+        except DaemonError as e:
+            logger.error(f"Could not start movie {movie_file.id}: {e}")
+            return Response({"error": "Torrent engine unavailable"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
-            return response
-
-        except MovieFile.DoesNotExist:
-            return Response({"error": "Movie not found"}, status=status.HTTP_404_NOT_FOUND)
-        except Exception as e:
-            logger.error(f"Streaming error: {str(e)}")
-            return Response({"error": "Internal server error"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        movie_file.refresh_from_db()
+        return Response({**movie_status_data(movie_file), "id": movie_file.id, "imdb_id": movie_file.imdb_id})
 
     @action(detail=True, methods=["get"], url_path="segments")
     def segments(self, request, pk=None):
@@ -385,54 +1128,27 @@ class VideoViewSet(viewsets.ViewSet):
                     status=status.HTTP_400_BAD_REQUEST,
                 )
             
-            # Get the full path from the stored file path
-            file_path = os.path.join("/app/downloads", movie_file.file_path)
-            dir_path = os.path.dirname(file_path)
-            base_name = os.path.splitext(os.path.basename(file_path))[0]
-            
-            # Remove _segment_000 suffix if it exists
-            if base_name.endswith("_segment_000"):
-                base_name = base_name[:-12]
-            
-            # Get total movie duration from original file
-            original_file_path = None
-            for ext in ['.mkv', '.mp4', '.avi']:
-                test_path = os.path.join(dir_path, f"{base_name}{ext}")
-                if os.path.exists(test_path):
-                    original_file_path = test_path
-                    break
-            
-            total_duration = None
-            if original_file_path:
-                video_service = VideoService()
-                total_duration = video_service.get_video_duration(original_file_path)
-            
-            # Find all available segments
-            available_segments = []
-            segment_num = 0
-            
-            while True:
-                segment_filename = f"{base_name}_segment_{segment_num:03d}.mp4"
-                segment_path = os.path.join(dir_path, segment_filename)
-                
-                if os.path.exists(segment_path):
-                    available_segments.append({
-                        "segment": segment_num,
-                        "filename": segment_filename,
-                        "size": os.path.getsize(segment_path)
-                    })
-                    segment_num += 1
-                else:
-                    break
-            
+            manifest = movie_manifest(movie_file)
+            available_segments = [
+                {"segment": segment, "filename": entry["path"], "size": entry["size"],
+                 "start": entry["start"], "duration": entry["duration"]}
+                for segment, entry in manifest.ready_segments()
+            ]
+
             video_service = VideoService()
-            segment_duration = video_service.segment_duration
-            
+            renditions = [
+                {"name": rendition.name, "resolution": resolution, "bandwidth": bandwidth}
+                for rendition, bandwidth, _, resolution in video_service.variants(manifest)
+                if rendition is not None
+            ]
+
             return Response({
                 "available_segments": available_segments,
-                "segment_duration": segment_duration,
+                "failed_segments": manifest.failed_segments(),
+                "renditions": renditions,
+                "segment_duration": manifest.segment_duration or video_service.segment_duration,
                 "total_segments": len(available_segments),
-                "total_duration": total_duration
+                "total_duration": manifest.total_duration
             })
             
         except MovieFile.DoesNotExist:
@@ -449,36 +1165,12 @@ class SubtitleViewSet(viewsets.ReadOnlyModelViewSet):
     """
     ViewSet for subtitles operations.
     GET /subtitles - Get available subtitles with the movie id and language
-    GET /subtitles/{movie_id}/file/{language}/ - Serve the subtitle VTT file
+
+    GET /subtitles/{movie_id}/file/{language}/ is an async view, see async_views.
     """
 
     subtitle_service = SubtitleService()
 
-    def get_subtitles(self, movie: MovieFile, languages: list = ['en', 'fr']) -> list:
-        """
-        Checks if VTT files exist locally. If not, downloads them.
-        Returns a list of dictionaries with 'lang' and 'url' for the frontend.
-        """
-        subtitle_data = []
-        
-        base_sub_dir = os.path.join(settings.MEDIA_ROOT, '/downloads/subtitles', str(movie.id))
-        
-        for lang in languages:
-            vtt_filename = f"{lang}.vtt"
-            local_path = os.path.join(base_sub_dir, vtt_filename)
-            
-            if os.path.exists(local_path):
-                url = os.path.join(settings.MEDIA_URL, 'subtitles', str(movie.id), vtt_filename)
-                subtitle_data.append({
-                    'lang': lang,
-                    'label': 'English' if lang == 'en' else lang.upper(),
-                    'file_path': url
-                })
-            else:
-                return None
-
-        return subtitle_data
-
     def list(self, request):
         """
         Get subtitles for a specific movie in the user's preferred language.
@@ -496,33 +1188,5 @@ class SubtitleViewSet(viewsets.ReadOnlyModelViewSet):
         except MovieFile.DoesNotExist:
             return Response([], status=status.HTTP_200_OK) 
 
-        if_local = self.get_subtitles(movie, language)
-        if if_local:
-            return Response(subtitles)
         subtitles = self.subtitle_service.fetch_subtitles(movie, language)
         return Response(subtitles)
-
-    @action(detail=False, methods=['get'], url_path=r'(?P<movie_id>\d+)/file/(?P<language>\w+)')
-    def serve_file(self, request, movie_id=None, language=None):
-        """
-        Serve the subtitle VTT file for a specific movie and language.
-        """
-        if not movie_id or not language:
-            raise Http404("Movie ID and language are required")
-
-        # Construct the file path
-        file_path = os.path.join(settings.MEDIA_ROOT, 'downloads', 'subtitles', movie_id, f'{language}.vtt')
-        
-        if not os.path.exists(file_path):
-            raise Http404("Subtitle file not found")
-
-        try:
-            with open(file_path, 'r', encoding='utf-8') as subtitle_file:
-                content = subtitle_file.read()
-            sys.stdout.write(file_path + "\n")
-            sys.stdout.flush()
-            response = HttpResponse(content, content_type='text/vtt')
-            response['Content-Disposition'] = f'inline; filename="{language}.vtt"'
-            return response
-        except Exception as e:
-            raise Http404(f"Error serving subtitle file: {str(e)}")
@@ -139,4 +139,60 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 DOWNLOAD_PATH = '/app/downloads'
-os.makedirs(DOWNLOAD_PATH, exist_ok=True)
\ No newline at end of file
+os.makedirs(DOWNLOAD_PATH, exist_ok=True)
+
+# Number of ffmpeg processes segmenting files at once across all movies; the ones fed
+# by running downloads come on top, one per active download
+TRANSCODE_WORKERS = int(os.getenv('TRANSCODE_WORKERS', os.cpu_count() or 1))
+
+# Lower renditions of the bitrate ladder as "<height>:<video kb/s>". Only rungs below the
+# source resolution are offered, and a segment of one is encoded from the source segment
+# the first time a player asks for it or its throughput calls for it, by at most
+# RENDITION_WORKERS ffmpeg processes on top of the TRANSCODE_WORKERS.
+VIDEO_RENDITIONS = [rung for rung in os.getenv('VIDEO_RENDITIONS', '1080:5000,720:2800,480:1200').split(',') if rung]
+RENDITION_WORKERS = int(os.getenv('RENDITION_WORKERS', 2))
+
+# Movies downloading at once; further ones wait in a queue of at most MAX_QUEUED_DOWNLOADS
+MAX_ACTIVE_DOWNLOADS = int(os.getenv('MAX_ACTIVE_DOWNLOADS', 4))
+MAX_QUEUED_DOWNLOADS = int(os.getenv('MAX_QUEUED_DOWNLOADS', 100))
+# Seconds a download may go without metadata or new data before it gives up its slot
+DOWNLOAD_STALL_TIMEOUT = int(os.getenv('DOWNLOAD_STALL_TIMEOUT', 15 * 60))
+
+# Seconds before the public tracker lists are fetched again, in the background
+TRACKER_LIST_TTL = int(os.getenv('TRACKER_LIST_TTL', 6 * 3600))
+
+# OpenSubtitles API and the subtitle languages fetched in the background when a download starts
+OPENSUBTITLES_API_URL = os.getenv('OPENSUBTITLES_API_URL', 'https://api.opensubtitles.com/api/v1')
+SUBTITLE_LANGUAGES = [lang for lang in os.getenv('SUBTITLE_LANGUAGES', 'en,fr').split(',') if lang]
+
+# Memory for served subtitle files and their compressed copies
+SUBTITLE_CACHE_BYTES = int(os.getenv('SUBTITLE_CACHE_BYTES', 32 * 1024 ** 2))
+
+# How finished segments are sent: "sendfile" streams them with os.sendfile through the
+# WSGI file wrapper when served by wsgi.py; under asgi.py the same mode reads them in
+# worker threads instead. "x-accel-redirect" (nginx) and "x-sendfile" (Apache, lighttpd)
+# hand the transfer to the front server, the zero-copy path under ASGI; docker-compose
+# uses x-accel-redirect. VIDEO_SENDFILE_PREFIX is the internal nginx location that maps
+# to DOWNLOAD_PATH.
+VIDEO_SENDFILE_MODE = os.getenv('VIDEO_SENDFILE_MODE', 'sendfile')
+VIDEO_SENDFILE_PREFIX = os.getenv('VIDEO_SENDFILE_PREFIX', '/internal-downloads/')
+
+# Seconds between batched writes of download progress; status changes are written at once
+PROGRESS_FLUSH_INTERVAL = float(os.getenv('PROGRESS_FLUSH_INTERVAL', 5))
+
+# Disk budget for downloaded movies. Above the high watermark the least recently watched
+# titles are deleted until usage is below the low watermark; titles not watched for
+# MOVIE_CACHE_MAX_AGE_DAYS are deleted regardless.
+MOVIE_CACHE_MAX_BYTES = int(os.getenv('MOVIE_CACHE_MAX_BYTES', 100 * 1024 ** 3))
+MOVIE_CACHE_HIGH_WATERMARK = float(os.getenv('MOVIE_CACHE_HIGH_WATERMARK', 0.9))
+MOVIE_CACHE_LOW_WATERMARK = float(os.getenv('MOVIE_CACHE_LOW_WATERMARK', 0.75))
+MOVIE_CACHE_MAX_AGE_DAYS = int(os.getenv('MOVIE_CACHE_MAX_AGE_DAYS', 30))
+
+# "keep" leaves the downloaded torrent file next to its segments. "segments-only" drops the
+# torrent and deletes the file once every segment has been verified, halving disk use.
+MOVIE_STORAGE_MODE = os.getenv('MOVIE_STORAGE_MODE', 'keep')
+
+# Unix socket of the torrent daemon (python manage.py torrentd). When set, the libtorrent
+# session and all download pipelines run in that single process and web workers send it
+# requests; when empty, every web worker runs its own session.
+TORRENT_DAEMON_SOCKET = os.getenv('TORRENT_DAEMON_SOCKET', '')
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'torrent.settings')
 
 application = get_wsgi_application()
+
+# Only server processes pick up the downloads that were running when they last stopped
+from stream.views import restore_downloads  # noqa: E402
+
+restore_downloads()